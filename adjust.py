@@ -0,0 +1,314 @@
+import os
+import re
+import csv
+import time
+import argparse
+import threading
+from datetime import datetime, timedelta
+from collections import OrderedDict
+import stock_common
+import json_decode
+import date_index
+import metrics
+import filelock
+import archive
+
+# 除權除息計算結果表（一次請求一段期間，期間內所有除權息的股票）
+ACTION_URLS = {
+    'twse': 'https://www.twse.com.tw/rwd/zh/exRight/TWT49U?startDate={start}&endDate={end}&response=json',
+    'tpex': 'https://www.tpex.org.tw/www/zh-tw/bulletin/exDailyQ?startDate={slash_start}&endDate={slash_end}&response=json',
+}
+
+# 除權息清單（輸出根目錄下 adjust/actions.csv）：每個 (代號, 除權息日) 一筆
+#   factor     除權息參考價 / 除權息前收盤價，除權息日之前的價格乘上此值才能與之後的價格比較
+#   cumulative 這次與之後所有因子的乘積，除權息日前一天（含）以前的價格乘上此值即為還原價格
+ACTIONS_FILE = 'actions.csv'
+FIELDS = ['code', 'date', 'market', 'before', 'reference', 'factor', 'cumulative']
+
+# 一次請求的天數、相鄰兩次請求的最短間隔(秒)
+FETCH_DAYS = 31
+MIN_INTERVAL = 3
+
+# 記憶體中保留的還原序列（代號數）
+ADJUSTED_CACHE = 500
+
+
+def actions_path():
+    return os.path.join(stock_common.output_dir('adjust'), ACTIONS_FILE)
+
+
+def action_url(market, start, end):
+    """某段期間 (YYYYMMDD) 的除權除息計算結果表網址"""
+    return ACTION_URLS[market].format(start=start, end=end, slash_start=f"{start[:4]}/{start[4:6]}/{start[6:]}",
+                                      slash_end=f"{end[:4]}/{end[4:6]}/{end[6:]}")
+
+
+def _gregorian(text):
+    """民國日期（114年07月03日、114/07/03、1140703）轉西元 YYYYMMDD，無法辨識時回傳None"""
+    parts = re.findall(r'\d+', text)
+    if len(parts) == 1 and len(parts[0]) in (7, 8):
+        return date_index.gregorian(parts[0])
+    if len(parts) != 3:
+        return None
+    year = int(parts[0])
+    return f"{year + 1911 if year < 1911 else year}{int(parts[1]):02d}{int(parts[2]):02d}"
+
+
+def _number(text):
+    try:
+        return float(str(text).replace(',', '').strip())
+    except ValueError:
+        return None
+
+
+def parse_actions(content, market):
+    """解析除權除息計算結果表的JSON回應
+
+    回傳:
+        [{'code', 'date', 'market', 'before', 'reference', 'factor'}, ...]；查無資料時為空列表
+    """
+    doc = json_decode.load(content)
+    table = json_decode.find_table(doc, ('代號', '前收盤價', '參考價')) if doc is not None else None
+    if table is None:
+        return []
+    fields = [str(field).replace(' ', '') for field in table[0]]
+    date_idx = next(i for i, field in enumerate(fields) if '日期' in field)
+    code_idx = next(i for i, field in enumerate(fields) if '代號' in field)
+    before_idx = next(i for i, field in enumerate(fields) if '前收盤價' in field)
+    # 「減除股利參考價」是另一個欄位
+    reference_idx = next(i for i, field in enumerate(fields) if '參考價' in field and '減除' not in field)
+
+    actions = []
+    for row in table[1]:
+        row = [str(value).strip() for value in row]
+        date_str = _gregorian(row[date_idx])
+        before, reference = _number(row[before_idx]), _number(row[reference_idx])
+        if not date_str or not before or not reference or before <= 0 or reference <= 0:
+            continue
+        actions.append({'code': row[code_idx], 'date': date_str, 'market': market, 'before': row[before_idx],
+                        'reference': row[reference_idx], 'factor': reference / before})
+    return actions
+
+
+def fetch_actions(session, market, start, end):
+    """下載並解析一段期間的除權息資料，失敗時回傳None"""
+    url = action_url(market, start, end)
+    started = time.perf_counter()
+    try:
+        response = session.get(url, headers=stock_common.HEADERS, verify=False, timeout=20)
+    except Exception as e:
+        print(f"{market} {start}~{end} 除權息資料下載失敗: {str(e)}")
+        return None
+    metrics.record(f"adjust_{market}", start, 'fetch', time.perf_counter() - started,
+                   status=response.status_code, bytes=len(response.content))
+    if response.status_code != 200:
+        print(f"{market} {start}~{end} 除權息資料下載失敗，狀態碼: {response.status_code}")
+        return None
+    return parse_actions(response.content, market)
+
+
+def load_actions(path=None):
+    """讀取除權息清單 {代號: [(除權息日, 因子), ...]}（依日期排序）"""
+    path = path or actions_path()
+    result = {}
+    if not os.path.exists(path):
+        return result
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        for entry in csv.DictReader(f):
+            result.setdefault(entry['code'], []).append((entry['date'], float(entry['factor'])))
+    for events in result.values():
+        events.sort()
+    return result
+
+
+def merge_actions(actions, path=None):
+    """把新的除權息資料併入清單（同一代號同一天以新的為準），重新計算累積因子
+
+    回傳:
+        新增或改變的代號集合
+    """
+    path = path or actions_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with filelock.locked(path):
+        entries = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8', newline='') as f:
+                entries = {(entry['code'], entry['date']): entry for entry in csv.DictReader(f)}
+        changed = set()
+        for action in actions:
+            key = (action['code'], action['date'])
+            factor = f"{action['factor']:.8f}"
+            if key not in entries or entries[key]['factor'] != factor:
+                changed.add(action['code'])
+            entries[key] = dict(action, factor=factor)
+        if not changed:
+            return changed
+
+        # 累積因子：由最後一次除權息往前連乘
+        rows = sorted(entries.values(), key=lambda entry: (entry['code'], entry['date']))
+        product = 1.0
+        for i in range(len(rows) - 1, -1, -1):
+            if i == len(rows) - 1 or rows[i + 1]['code'] != rows[i]['code']:
+                product = 1.0
+            product *= float(rows[i]['factor'])
+            rows[i]['cumulative'] = f"{product:.8f}"
+        with open(path + '.tmp', 'w', encoding='utf-8', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+        os.replace(path + '.tmp', path)
+    return changed
+
+
+def update(start, end=None, interval=MIN_INTERVAL):
+    """下載一段期間（預設只有 start 當天）上市、上櫃的除權息資料並併入清單，回傳有變動的代號集合"""
+    import urllib3
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    end = end or start
+    session = stock_common.get_session()
+    actions = []
+    day = datetime.strptime(start, '%Y%m%d')
+    last = datetime.strptime(end, '%Y%m%d')
+    first = True
+    while day <= last:
+        chunk_end = min(day + timedelta(days=FETCH_DAYS - 1), last)
+        for market in ACTION_URLS:
+            if not first:
+                time.sleep(interval)
+            first = False
+            fetched = fetch_actions(session, market, day.strftime('%Y%m%d'), chunk_end.strftime('%Y%m%d'))
+            actions.extend(fetched or [])
+        day = chunk_end + timedelta(days=1)
+    changed = merge_actions(actions)
+    print(f"{start}~{end}: {len(actions)} 筆除權息資料，{len(changed)} 個代號的因子有變動")
+    return changed
+
+
+class Adjuster:
+    """還原價格：讀取時才依除權息因子計算，結果（numpy陣列）快取在記憶體
+
+    除權息清單有變動時清除變動代號的快取；日資料檔大小或修改時間改變（有新的一天、更正或改寫）時重新計算該代號。
+
+    參數:
+        size: 快取的代號數
+        path: 除權息清單路徑，預設 D:/stock/adjust/actions.csv
+    """
+
+    def __init__(self, size=ADJUSTED_CACHE, path=None):
+        self.size = size
+        self.path = path or actions_path()
+        self._actions = {}
+        self._stamp = None
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _reload(self):
+        """除權息清單檔有變動時重新讀取，並清除因子改變的代號"""
+        try:
+            stamp = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            stamp = None
+        if stamp == self._stamp:
+            return
+        actions = load_actions(self.path)
+        for code in set(actions) | set(self._actions):
+            if actions.get(code) != self._actions.get(code):
+                self._cache.pop(code, None)
+        self._actions, self._stamp = actions, stamp
+
+    def actions(self, code):
+        """某代號的除權息 [(除權息日, 因子), ...]"""
+        with self._lock:
+            self._reload()
+            return list(self._actions.get(code, []))
+
+    def _series(self, code):
+        """(日期陣列, 還原後開高低收陣列, 原始行)，依日資料檔的日期排序（同一天多次寫入時取最後一次）"""
+        import numpy as np
+        path = os.path.join(stock_common.output_dir('txt'), f"{code}.txt")
+        try:
+            stat = os.stat(path)
+            stamp = (stat.st_size, stat.st_mtime_ns)
+        except FileNotFoundError:
+            stamp = None
+        with self._lock:
+            self._reload()
+            cached = self._cache.get(code)
+            if cached is not None and cached[0] == stamp:
+                self._cache.move_to_end(code)
+                return cached[1]
+            events = self._actions.get(code, [])
+
+        # 已封存的年度接在目前檔案之前（見 archive.py）；封存時目前檔案的大小會改變，快取跟著失效
+        rows = {}
+        for row in csv.reader(archive.history_lines(path)):
+            date_str = date_index.gregorian(row[0]) if row else None
+            if date_str and len(row) >= 6:
+                rows[int(date_str)] = row
+        dates = np.array(sorted(rows), dtype=np.int64)
+        raw = [rows[date_int] for date_int in dates.tolist()]
+        prices = np.array([[_number(value) or np.nan for value in row[1:5]] for row in raw],
+                          dtype=np.float64).reshape(len(raw), 4)
+        # 每一天的因子 = 除權息日在這天之後的所有因子的乘積
+        event_dates = np.array([int(date_str) for date_str, _ in events], dtype=np.int64)
+        suffix = np.ones(len(events) + 1)
+        for i in range(len(events) - 1, -1, -1):
+            suffix[i] = suffix[i + 1] * events[i][1]
+        factors = suffix[np.searchsorted(event_dates, dates, side='right')]
+        series = (dates, prices * factors[:, None], raw)
+
+        with self._lock:
+            self._cache[code] = (stamp, series)
+            self._cache.move_to_end(code)
+            while len(self._cache) > self.size:
+                self._cache.popitem(last=False)
+        return series
+
+    def adjusted(self, code, start=None, end=None):
+        """還原後的日資料（欄位與 txt 相同，開高低收為還原價格取到小數2位，成交量不變）
+
+        參數:
+            code: 代號
+            start, end: 西元日期 YYYYMMDD（含），預設全部
+
+        回傳:
+            [[日期, 開, 高, 低, 收, 量], ...]
+        """
+        import numpy as np
+        dates, prices, raw = self._series(code)
+        low = np.searchsorted(dates, int(start), side='left') if start else 0
+        high = np.searchsorted(dates, int(end), side='right') if end else len(dates)
+        return [[raw[i][0], *(f"{value:.2f}" for value in prices[i]), raw[i][5]] for i in range(low, high)]
+
+    def stats(self):
+        with self._lock:
+            return {'adjusted_cached': len(self._cache), 'adjusted_codes': len(self._actions)}
+
+
+def main():
+    """主程式"""
+    parser = argparse.ArgumentParser(description='除權息還原：下載除權息資料、計算累積因子、輸出還原價格')
+    sub = parser.add_subparsers(dest='command', required=True)
+    fetch = sub.add_parser('fetch', help='下載一段期間的除權息資料併入清單')
+    fetch.add_argument('start', nargs='?', default=datetime.now().strftime('%Y%m%d'), help='開始日期 (YYYYMMDD)，預設今天')
+    fetch.add_argument('end', nargs='?', help='結束日期 (YYYYMMDD)，預設同開始日期')
+    fetch.add_argument('--interval', type=float, default=MIN_INTERVAL, help='相鄰兩次請求的最短間隔(秒)')
+    show = sub.add_parser('show', help='列出某代號的除權息與還原價格')
+    show.add_argument('code')
+    show.add_argument('--start', help='開始日期 (YYYYMMDD)')
+    show.add_argument('--end', help='結束日期 (YYYYMMDD)')
+    args = parser.parse_args()
+
+    if args.command == 'fetch':
+        update(args.start, args.end, args.interval)
+        metrics.emit()
+        return
+    adjuster = Adjuster()
+    for date_str, factor in adjuster.actions(args.code):
+        print(f"除權息 {date_str}: 因子 {factor:.6f}")
+    for row in adjuster.adjusted(args.code, args.start, args.end):
+        print(','.join(f'"{value}"' for value in row))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,397 @@
+import os
+import zlib
+import struct
+import zipfile
+import shutil
+import argparse
+import tempfile
+import threading
+from datetime import datetime
+import stock_common
+import date_index
+import filelock
+
+# 封存（輸出根目錄下 archive/{family}/）：已結束的年度從個股檔案移到每年一個壓縮檔
+#   {YYYY}.zip   成員 {代號}.{family}，內容為該代號該年的行（原文、依原本順序，換行為\n）
+#   {YYYY}.idx   成員索引，每行 代號,第一天,最後一天,行數,位移,壓縮後長度，讀取時直接跳到成員資料解壓縮
+# 個股檔案只留下未封存的年度；讀取歷史時依序接上各封存年度與目前的檔案（同一天出現多次時以後面的為準）
+FAMILIES = ('txt', 'law', 'inv')
+
+COMPRESS_LEVEL = 9
+
+# zip 成員的本地檔頭：簽章、(版本~原始長度 22 bytes)、檔名長度、額外欄位長度
+_LOCAL_HEADER = struct.Struct('<4s22xHH')
+_LOCAL_SIGNATURE = b'PK\x03\x04'
+
+_cache_lock = threading.Lock()
+_years = {}      # family -> (目錄修改時間, [年份...])
+_members = {}    # (family, 年份) -> (索引修改時間, {代號: (第一天, 最後一天, 行數, 位移, 長度)})
+
+
+def archive_dir(family):
+    return os.path.join(stock_common.output_dir('archive'), family)
+
+
+def archive_path(family, year):
+    return os.path.join(archive_dir(family), f"{year}.zip")
+
+
+def index_path(family, year):
+    return os.path.join(archive_dir(family), f"{year}.idx")
+
+
+def years(family):
+    """已封存的年份（依年份排序）"""
+    directory = archive_dir(family)
+    try:
+        stamp = os.stat(directory).st_mtime_ns
+    except FileNotFoundError:
+        return []
+    with _cache_lock:
+        cached = _years.get(family)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+    found = sorted(int(name[:-len('.idx')]) for name in os.listdir(directory)
+                   if name.endswith('.idx') and name[:-len('.idx')].isdigit())
+    with _cache_lock:
+        _years[family] = (stamp, found)
+    return found
+
+
+def members(family, year):
+    """某年壓縮檔的成員索引 {代號: (第一天, 最後一天, 行數, 位移, 壓縮後長度)}，沒有時回傳空dict"""
+    path = index_path(family, year)
+    try:
+        stamp = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return {}
+    with _cache_lock:
+        cached = _members.get((family, year))
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+    entries = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            code, first, last, count, offset, size = line.rstrip('\n').rsplit(',', 5)
+            entries[code] = (first, last, int(count), int(offset), int(size))
+    with _cache_lock:
+        _members[(family, year)] = (stamp, entries)
+    return entries
+
+
+def member_name(family, code):
+    return f"{code}.{family}"
+
+
+def _read_member(f, family, year, code, entry):
+    """從已開啟的壓縮檔讀出一個成員的行；索引與壓縮檔對不上（例如正在重新封存）時改用 zipfile 查找"""
+    name = member_name(family, code)
+    f.seek(entry[3])
+    signature, name_length, extra_length = _LOCAL_HEADER.unpack(f.read(_LOCAL_HEADER.size))
+    if signature == _LOCAL_SIGNATURE and f.read(name_length) == name.encode('utf-8'):
+        f.seek(extra_length, os.SEEK_CUR)
+        data = zlib.decompress(f.read(entry[4]), -zlib.MAX_WBITS)
+    else:
+        with zipfile.ZipFile(archive_path(family, year)) as z:
+            data = z.read(name)
+    return data.decode('utf-8', errors='replace').splitlines()
+
+
+def archived_lines(family, code, since=None):
+    """某代號封存在各年份壓縮檔中的行（已去除換行），since (YYYYMMDD) 時只取這天以後的行"""
+    result = []
+    for year in years(family):
+        if since and year < int(since[:4]):
+            continue
+        entry = members(family, year).get(code)
+        if entry is None or (since and entry[1] < since):
+            continue
+        with open(archive_path(family, year), 'rb') as f:
+            lines = _read_member(f, family, year, code, entry)
+        if since:
+            lines = [line for line in lines if (date_index.line_date(line) or '') >= since]
+        result.extend(lines)
+    return result
+
+
+def history_lines(path, since=None):
+    """個股檔案的完整歷史：封存的年度接上目前檔案的行（已去除換行）
+
+    參數:
+        path: 個股檔案路徑（txt / law / inv 目錄下，檔案已不存在時只回傳封存的行）
+        since: 只需要這天 (YYYYMMDD) 以後時，目前的檔案從檔尾往前讀（見 date_index.tail_lines）
+
+    回傳:
+        [行...]，同一天出現多次時後面的為準
+    """
+    family = os.path.basename(os.path.dirname(path))
+    code = os.path.splitext(os.path.basename(path))[0]
+    lines = archived_lines(family, code, since) if family in FAMILIES else []
+    if since:
+        return lines + date_index.tail_lines(path, since)
+    try:
+        with open(path, 'r', encoding='utf-8', errors='replace', newline='') as f:
+            return lines + [line.strip() for line in f if line.strip()]
+    except FileNotFoundError:
+        return lines
+
+
+def read_day(family, date_str, latest=True):
+    """從壓縮檔讀出某日所有個股的行（date_index.read_date 讀取已封存的年度時使用）
+
+    回傳:
+        {代號: [行...]}；這一年沒有封存時回傳None
+    """
+    year = int(date_str[:4])
+    entries = members(family, year)
+    if not entries:
+        return None
+    result = {}
+    with open(archive_path(family, year), 'rb') as f:
+        for code, entry in entries.items():
+            if not entry[0] <= date_str <= entry[1]:
+                continue
+            # 與日期索引相同：相鄰同日期的行為一段，latest 時只取最後一段
+            runs = []
+            previous = None
+            for line in _read_member(f, family, year, code, entry):
+                current = date_index.line_date(line)
+                if current == date_str:
+                    if previous != date_str:
+                        runs.append([])
+                    runs[-1].append(line)
+                previous = current
+            if runs:
+                result[code] = runs[-1] if latest else [line for run in runs for line in run]
+    return result
+
+
+def paths(family):
+    """所有代號的個股檔案路徑（含已整個封存、檔案已不存在的代號），依檔名排序"""
+    directory = stock_common.output_dir(family)
+    names = {name for name in os.listdir(directory) if name.endswith(f".{family}")} \
+        if os.path.isdir(directory) else set()
+    for year in years(family):
+        names.update(member_name(family, code) for code in members(family, year))
+    return [os.path.join(directory, name) for name in sorted(names)]
+
+
+def _new_lines(existing, lines):
+    """要接在已封存的行之後的行
+
+    只略過與已封存的最後幾行完全相同的開頭（上次封存寫好壓縮檔、還沒改寫個股檔案就中斷時重新封存的情況）；
+    內容與更早的行相同的行照樣加入，例如把更正改回原值時，讀取時仍以最後一行為準
+    """
+    for count in range(min(len(existing), len(lines)), 0, -1):
+        if existing[-count:] == lines[:count]:
+            return lines[count:]
+    return lines
+
+
+def _write_year(family, year, moved):
+    """把 {代號: [行...]} 接在某年壓縮檔已有的行之後（見 _new_lines），並改寫成員索引"""
+    path = archive_path(family, year)
+    contents = {}
+    if os.path.exists(path):
+        with zipfile.ZipFile(path) as z:
+            for info in z.infolist():
+                contents[os.path.splitext(info.filename)[0]] = z.read(info).decode('utf-8').splitlines()
+    for code, lines in moved.items():
+        existing = contents.setdefault(code, [])
+        existing.extend(_new_lines(existing, lines))
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    rows = []
+    with zipfile.ZipFile(path + '.tmp', 'w', zipfile.ZIP_DEFLATED, compresslevel=COMPRESS_LEVEL) as z:
+        for code in sorted(contents):
+            z.writestr(member_name(family, code), ''.join(line + '\n' for line in contents[code]))
+        for info in z.infolist():
+            code = os.path.splitext(info.filename)[0]
+            dates = [date_str for date_str in map(date_index.line_date, contents[code]) if date_str]
+            rows.append(f"{code},{min(dates)},{max(dates)},{len(contents[code])},{info.header_offset},"
+                        f"{info.compress_size}\n")
+    with open(index_path(family, year) + '.tmp', 'w', encoding='utf-8', newline='\n') as f:
+        f.write(''.join(rows))
+    os.replace(path + '.tmp', path)
+    os.replace(index_path(family, year) + '.tmp', index_path(family, year))
+    return len(contents)
+
+
+def _strip_file(path, archived):
+    """個股檔案去掉已寫入壓縮檔的行（封存期間才附加的行保留），沒有剩下任何行時刪除檔案
+
+    回傳:
+        檔案是否仍存在
+    """
+    with filelock.locked(path):
+        with open(path, 'rb') as f:
+            raws = f.read().splitlines(True)
+        kept = [raw for raw in raws if raw.decode('utf-8', errors='replace').strip() not in archived]
+        if not any(raw.strip() for raw in kept):
+            os.remove(path)
+            return False
+        with open(path + '.tmp', 'wb') as f:
+            f.write(b''.join(kept))
+        os.replace(path + '.tmp', path)
+    return True
+
+
+def pack(family, through):
+    """把 through 年（含）以前的行從個股檔案移到各年份的壓縮檔
+
+    已有壓縮檔的年度（例如後來補上或更正的舊日期）會併入原本的壓縮檔。
+    封存年度的日期索引檔刪除（改從壓縮檔讀），其餘日期的位置重建。
+
+    參數:
+        family: 輸出目錄 (txt / law / inv)
+        through: 封存到這一年（必須是已結束的年度）
+
+    回傳:
+        {年份: 成員數}
+    """
+    if through >= datetime.now().year:
+        raise ValueError(f"只能封存已結束的年度（{through} 年尚未結束）")
+    directory = stock_common.output_dir(family)
+    names = sorted(name for name in os.listdir(directory) if name.endswith(f".{family}")) \
+        if os.path.isdir(directory) else []
+    result = {}
+    with filelock.writer():
+        moved = {}
+        for name in names:
+            code = os.path.splitext(name)[0]
+            with open(os.path.join(directory, name), 'r', encoding='utf-8', errors='replace', newline='') as f:
+                for line in f:
+                    line = line.strip()
+                    date_str = date_index.line_date(line)
+                    if date_str and int(date_str[:4]) <= through:
+                        moved.setdefault(int(date_str[:4]), {}).setdefault(code, []).append(line)
+        if not moved:
+            return result
+        # 壓縮檔都寫好後才改寫個股檔案，中途中斷時只會有重複（讀取時後面的為準），不會遺失
+        for year in sorted(moved):
+            result[year] = _write_year(family, year, moved[year])
+        changed = []
+        for code in sorted({code for codes in moved.values() for code in codes}):
+            archived = {line for codes in moved.values() for line in codes.get(code, [])}
+            path = os.path.join(directory, member_name(family, code))
+            if _strip_file(path, archived):
+                changed.append(path)
+
+        index = date_index.index_dir(family)
+        if os.path.isdir(index):
+            for name in os.listdir(index):
+                if name.endswith('.idx') and int(name[:4]) <= through:
+                    os.remove(os.path.join(index, name))
+        date_index.reindex(family, changed, f"{through + 1}0101")
+    return result
+
+
+def sizes(family):
+    """各封存年度的 (年份, 成員數, 原始大小, 壓縮後大小)"""
+    result = []
+    for year in years(family):
+        with zipfile.ZipFile(archive_path(family, year)) as z:
+            infos = z.infolist()
+        result.append((year, len(infos), sum(info.file_size for info in infos), os.path.getsize(archive_path(family, year))))
+    return result
+
+
+def _views(family, code, date_str):
+    """讀取端看到的某代號某日的記錄：完整歷史、日期索引的當日（已封存的年度由 read_day 讀取），各取最後一行"""
+    path = os.path.join(stock_common.output_dir(family), member_name(family, code))
+    history = dict(date_index.latest_rows(history_lines(path)))
+    indexed = dict(date_index.latest_rows((date_index.read_date(family, date_str) or {}).get(code) or []))
+    return history.get(date_str), indexed.get(date_str)
+
+
+def check():
+    """在暫存的輸出目錄重現「更正 -> 封存 -> 改回原值 -> 再封存」與中斷後重新封存，確認封存不改變讀到的內容
+
+    回傳:
+        問題說明的列表，沒有問題時為空列表
+    """
+    family, code, date_str = 'txt', '9999', '20240109'
+    original = '"1130109","10","13","9","12","1000"'
+    corrected = '"1130109","10","99","9","99","1000"'
+    work_dir = tempfile.mkdtemp(prefix='stock_archive_')
+    original_root = stock_common.STOCK_ROOT
+    problems = []
+
+    def append(*lines):
+        # 與 BatchWriter 相同：附加後更新日期索引
+        path = os.path.join(stock_common.output_dir(family), member_name(family, code))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        lines = [line + '\n' for line in lines]
+        with open(path, 'ab') as f:
+            offset = f.seek(0, os.SEEK_END)
+            f.write(''.join(lines).replace('\n', os.linesep).encode('utf-8'))
+        date_index.add([(path, offset, lines)])
+
+    def expect(step, close):
+        views = _views(family, code, date_str)
+        if any(view is None or view[4] != close for view in views):
+            problems.append(f"{step}: 收盤價應為 {close}，讀到 {[view and view[4] for view in views]}")
+
+    try:
+        stock_common.STOCK_ROOT = work_dir
+        append('"1130108","10","11","9","10","1000"', original, corrected, '"1140102","10","11","9","10","1000"')
+        expect('封存前', '99')
+        pack(family, 2024)
+        expect('第一次封存', '99')
+        append(original)
+        expect('改回原值', '12')
+        pack(family, 2024)
+        expect('第二次封存', '12')
+        # 中斷後重新封存：壓縮檔已寫好、個股檔案還留著相同的行，不應重複加入
+        append(corrected)
+        _write_year(family, 2024, {code: [corrected]})
+        lines = members(family, 2024)[code][2]
+        pack(family, 2024)
+        if members(family, 2024)[code][2] != lines:
+            problems.append(f"重新封存: 行數應為 {lines}，實際為 {members(family, 2024)[code][2]}")
+        expect('重新封存', '99')
+    finally:
+        stock_common.STOCK_ROOT = original_root
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return problems
+
+
+def main():
+    """主程式"""
+    parser = argparse.ArgumentParser(description='已結束的年度封存成每年一個壓縮檔，讀取時自動接上目前的檔案')
+    sub = parser.add_subparsers(dest='command', required=True)
+    packing = sub.add_parser('pack', help='封存到某一年（含）為止的資料')
+    packing.add_argument('--through', type=int, default=datetime.now().year - 1, help='封存到這一年，預設為去年')
+    packing.add_argument('--families', nargs='+', default=list(FAMILIES), choices=FAMILIES)
+    sub.add_parser('list', help='列出各封存年度的大小')
+    show = sub.add_parser('show', help='列出某代號的完整歷史（封存 + 目前檔案）')
+    show.add_argument('code')
+    show.add_argument('--family', default='txt', choices=FAMILIES)
+    show.add_argument('--since', help='只列出這天 (YYYYMMDD) 以後')
+    sub.add_parser('check', help='在暫存目錄確認封存前後讀到的內容相同（不動到輸出目錄）')
+    args = parser.parse_args()
+
+    if args.command == 'pack':
+        for family in args.families:
+            for year, count in sorted(pack(family, args.through).items()):
+                print(f"{family} {year}: 封存 {count} 個代號")
+    elif args.command == 'list':
+        for family in FAMILIES:
+            for year, count, raw, compressed in sizes(family):
+                print(f"{family} {year}: {count} 個代號，{raw:,} -> {compressed:,} bytes "
+                      f"({compressed / raw:.0%})" if raw else f"{family} {year}: 空")
+    elif args.command == 'check':
+        problems = check()
+        for problem in problems:
+            print(problem)
+        if problems:
+            raise SystemExit(1)
+        print("封存檢查通過")
+    else:
+        path = os.path.join(stock_common.output_dir(args.family), member_name(args.family, args.code))
+        for line in history_lines(path, args.since):
+            print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+import os
+import time
+import socket
+import sqlite3
+import argparse
+import threading
+from datetime import datetime
+import stock_common
+
+# 回補清單（輸出根目錄下 backfill/manifest.sqlite）：每個 (資料集, 日期) 一筆
+MANIFEST_FILE = 'manifest.sqlite'
+
+# 工作單位的狀態（依進度排列）
+STATES = ('pending', 'downloaded', 'parsed', 'committed')
+
+# 認領的有效時間(秒)：工作者每隔 LEASE/3 秒延長一次，停止更新（程序已結束）的認領過期後由其他工作者接手
+LEASE = 120
+
+# 每次認領的單位數
+CLAIM_BATCH = 20
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS units (
+    dataset TEXT NOT NULL,
+    date TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    owner TEXT,
+    claimed_at REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    updated_at TEXT,
+    PRIMARY KEY (dataset, date)
+)
+"""
+
+
+def manifest_path():
+    return os.path.join(stock_common.output_dir('backfill'), MANIFEST_FILE)
+
+
+def owner_id():
+    """工作者代號：主機名稱:程序編號"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _now():
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+class Manifest:
+    """回補清單：記錄每個 (資料集, 日期) 工作單位的狀態，中斷後重新執行時從停下的地方繼續
+
+    多個程序可以同時使用同一份清單：以 claim() 認領尚未完成的單位（SQLite交易保證不重複），
+    已完成 (committed) 的單位不會再被認領，不連網路也不寫檔。
+
+    參數:
+        path: 清單檔路徑，預設 D:/stock/backfill/manifest.sqlite
+    """
+
+    def __init__(self, path=None):
+        self.path = path or manifest_path()
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(_SCHEMA)
+        self._heartbeat = None
+
+    def close(self):
+        self.stop_heartbeat()
+        with self._lock:
+            self._db.close()
+
+    def add(self, datasets, dates):
+        """加入工作單位（已存在的單位維持原狀態），回傳新加入的數量"""
+        with self._lock:
+            before = self._db.total_changes
+            self._db.execute('BEGIN IMMEDIATE')
+            self._db.executemany('INSERT OR IGNORE INTO units (dataset, date, updated_at) VALUES (?, ?, ?)',
+                                 [(dataset, date_str, _now()) for date_str in dates for dataset in datasets])
+            self._db.execute('COMMIT')
+            return self._db.total_changes - before
+
+    def claim(self, owner, datasets, limit=CLAIM_BATCH, start=None, end=None):
+        """認領最早的未完成單位（沒有人認領或認領已過期；剛失敗的單位等 LEASE 秒後才會再被認領）
+
+        回傳:
+            [(資料集, 日期), ...]，依日期排序；沒有可認領的單位時為空列表
+        """
+        now = time.time()
+        marks = ','.join('?' * len(datasets))
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                units = self._db.execute(
+                    f"SELECT dataset, date FROM units WHERE state != 'committed' AND dataset IN ({marks})"
+                    " AND date >= ? AND date <= ? AND (claimed_at IS NULL OR claimed_at < ?)"
+                    " ORDER BY date, dataset LIMIT ?",
+                    (*datasets, start or '', end or '99999999', now - LEASE, limit)).fetchall()
+                self._db.executemany('UPDATE units SET owner = ?, claimed_at = ?, attempts = attempts + 1, updated_at = ?'
+                                     ' WHERE dataset = ? AND date = ?',
+                                     [(owner, now, _now(), dataset, date_str) for dataset, date_str in units])
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+        return units
+
+    def mark(self, dataset, date_str, state, error=None, note=None):
+        """更新單位的狀態；完成 (committed) 時釋放認領，error 欄改存備註（例如休市日沒有發布資料）"""
+        with self._lock:
+            if state == 'committed':
+                self._db.execute("UPDATE units SET state = ?, owner = NULL, claimed_at = NULL, error = ?,"
+                                 " updated_at = ? WHERE dataset = ? AND date = ?",
+                                 (state, note, _now(), dataset, date_str))
+            else:
+                self._db.execute('UPDATE units SET state = ?, error = ?, updated_at = ? WHERE dataset = ? AND date = ?',
+                                 (state, error, _now(), dataset, date_str))
+
+    def fail(self, dataset, date_str, error):
+        """單位沒有完成（例如有來源下載失敗）：記下原因並釋放，LEASE 秒後才能再被認領（避免立即重試）"""
+        with self._lock:
+            self._db.execute('UPDATE units SET owner = NULL, claimed_at = ?, error = ?, updated_at = ?'
+                             ' WHERE dataset = ? AND date = ?', (time.time(), error, _now(), dataset, date_str))
+
+    def release(self, owner=None):
+        """釋放認領（owner 為None時釋放全部，例如確定沒有其他工作者在執行時），回傳釋放的數量"""
+        with self._lock:
+            if owner is None:
+                cursor = self._db.execute('UPDATE units SET owner = NULL, claimed_at = NULL WHERE owner IS NOT NULL')
+            else:
+                cursor = self._db.execute('UPDATE units SET owner = NULL, claimed_at = NULL WHERE owner = ?', (owner,))
+            return cursor.rowcount
+
+    def reset(self, datasets, start=None, end=None):
+        """把區間內的單位改回 pending（需要重新處理已完成的日期時使用），回傳數量"""
+        marks = ','.join('?' * len(datasets))
+        with self._lock:
+            cursor = self._db.execute(
+                f"UPDATE units SET state = 'pending', owner = NULL, claimed_at = NULL, error = NULL, updated_at = ?"
+                f" WHERE dataset IN ({marks}) AND date >= ? AND date <= ?",
+                (_now(), *datasets, start or '', end or '99999999'))
+            return cursor.rowcount
+
+    def counts(self):
+        """各資料集、各狀態的單位數 {(資料集, 狀態): 數量}"""
+        with self._lock:
+            rows = self._db.execute('SELECT dataset, state, COUNT(*) FROM units GROUP BY dataset, state').fetchall()
+        return {(dataset, state): count for dataset, state, count in rows}
+
+    def errors(self, limit=20):
+        """尚未完成的單位最近的錯誤"""
+        with self._lock:
+            return self._db.execute("SELECT dataset, date, attempts, error FROM units WHERE error IS NOT NULL"
+                                    " AND state != 'committed' ORDER BY date LIMIT ?", (limit,)).fetchall()
+
+    def notes(self):
+        """已完成但有備註的單位數 {(資料集, 備註): 數量}（例如休市日）"""
+        with self._lock:
+            rows = self._db.execute("SELECT dataset, error, COUNT(*) FROM units WHERE state = 'committed'"
+                                    " AND error IS NOT NULL GROUP BY dataset, error").fetchall()
+        return {(dataset, note): count for dataset, note, count in rows}
+
+    def start_heartbeat(self, owner, interval=LEASE / 3):
+        """背景執行緒定時延長自己的認領，程序結束後認領才會過期"""
+        stop_event = threading.Event()
+
+        def beat():
+            while not stop_event.wait(interval):
+                with self._lock:
+                    self._db.execute('UPDATE units SET claimed_at = ? WHERE owner = ?', (time.time(), owner))
+
+        thread = threading.Thread(target=beat, name='backfill-heartbeat', daemon=True)
+        thread.start()
+        self._heartbeat = stop_event
+
+    def stop_heartbeat(self):
+        if self._heartbeat is not None:
+            self._heartbeat.set()
+            self._heartbeat = None
+
+
+def main():
+    """主程式"""
+    parser = argparse.ArgumentParser(description='回補清單：查看進度、釋放認領或重新處理')
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('status', help='各資料集、各狀態的單位數與最近的錯誤')
+    sub.add_parser('release', help='釋放所有認領（確定沒有工作者在執行時使用，重新啟動可立即接手）')
+    reset = sub.add_parser('reset', help='把區間內的單位改回 pending')
+    reset.add_argument('start')
+    reset.add_argument('end', nargs='?')
+    reset.add_argument('--datasets', nargs='+', default=list(stock_common.DATASETS), choices=list(stock_common.DATASETS))
+    args = parser.parse_args()
+
+    manifest = Manifest()
+    if args.command == 'status':
+        counts = manifest.counts()
+        for dataset in sorted({dataset for dataset, _ in counts}):
+            print(f"{dataset:14s} " + '  '.join(f"{state} {counts.get((dataset, state), 0)}" for state in STATES))
+        for (dataset, note), count in sorted(manifest.notes().items()):
+            print(f"  {dataset} 已完成 {count} 個: {note}")
+        for dataset, date_str, attempts, error in manifest.errors():
+            print(f"  {dataset} {date_str} 第 {attempts} 次: {error}")
+    elif args.command == 'release':
+        print(f"已釋放 {manifest.release()} 個單位")
+    else:
+        print(f"已重設 {manifest.reset(args.datasets, args.start, args.end or args.start)} 個單位")
+    manifest.close()
+
+
+if __name__ == "__main__":
+    main()
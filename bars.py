@@ -0,0 +1,250 @@
+import os
+import argparse
+from datetime import date, timedelta
+from concurrent.futures import ProcessPoolExecutor
+import stock_common
+import date_index
+import filelock
+import archive
+
+# 週K、月K（輸出根目錄下 bars/week/{代號}.txt、bars/month/{代號}.txt），格式與 txt 日資料相同：
+# "日期","開","高","低","收","量"，日期為該期最後一個交易日，最後一行是目前（可能尚未結束）的一期
+PERIODS = ('week', 'month')
+
+# 讀取最後一行時從檔尾讀取的位元組數
+LAST_LINE_BLOCK = 4096
+
+# 重建時每個工作分配的檔案數
+REBUILD_CHUNK = 50
+
+
+def enabled():
+    """是否維護週K/月K（環境變數 STOCK_BARS=0 時關閉）"""
+    return os.environ.get('STOCK_BARS', '1') != '0'
+
+
+def bars_dir(period):
+    return os.path.join(stock_common.output_dir('bars'), period)
+
+
+def bar_path(period, code):
+    return os.path.join(bars_dir(period), f"{code}.txt")
+
+
+def _day(date_str):
+    return date(int(date_str[:4]), int(date_str[4:6]), int(date_str[6:]))
+
+
+def period_key(period, date_str):
+    """日期所屬的期別：週為ISO週 (YYYYWww，週一開始)，月為 YYYYMM"""
+    if period == 'month':
+        return date_str[:6]
+    year, week, _ = _day(date_str).isocalendar()
+    return f"{year}W{week:02d}"
+
+
+def period_start(period, date_str):
+    """日期所屬那一期的第一天 (YYYYMMDD)"""
+    if period == 'month':
+        return date_str[:6] + '01'
+    day = _day(date_str)
+    return (day - timedelta(days=day.weekday())).strftime('%Y%m%d')
+
+
+def extend(bar, fields):
+    """把一天併入一期（這天要比這期已有的日期晚）；價格保留日資料原本的寫法"""
+    if bar is None:
+        return list(fields)
+    return [fields[0], bar[1], max(bar[2], fields[2], key=float), min(bar[3], fields[3], key=float), fields[4],
+            str(int(bar[5]) + int(fields[5]))]
+
+
+def aggregate(period, rows):
+    """依日期排序的 [(日期, 欄位), ...] 合併成各期的K線列表"""
+    bars = []
+    key = None
+    for date_str, fields in rows:
+        current = period_key(period, date_str)
+        if current != key:
+            bars.append(None)
+            key = current
+        bars[-1] = extend(bars[-1], fields)
+    return bars
+
+
+def format_bar(bar):
+    return ','.join(f'"{value}"' for value in bar) + '\n'
+
+
+def _encode(bars):
+    # 與 BatchWriter 相同：換行符號依作業系統轉換
+    return ''.join(format_bar(bar) for bar in bars).replace('\n', os.linesep).encode('utf-8')
+
+
+def read_last(f):
+    """已開啟的K線檔最後一行的 (位移, 欄位)；空檔案或無法解析時回傳 (檔案大小, None)"""
+    end = f.seek(0, os.SEEK_END)
+    start = max(0, end - LAST_LINE_BLOCK)
+    f.seek(start)
+    block = f.read().rstrip(b'\r\n')
+    cut = block.rfind(b'\n') + 1
+    parsed = date_index.parse_quote(block[cut:].decode('utf-8', errors='replace'))
+    return (start + cut, parsed[1]) if parsed else (end, None)
+
+
+def read_bars(period, code):
+    """讀出某代號全部的週K或月K [(西元日期, 欄位), ...]"""
+    path = bar_path(period, code)
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r', encoding='utf-8') as f:
+        return [parsed for parsed in map(date_index.parse_quote, f) if parsed]
+
+
+def _recompute(period, code, daily_path, since):
+    """從 since 所在那一期的開頭起，用日資料檔尾（已封存時含壓縮檔）重新計算並改寫K線檔（更正、補插舊日期時使用）"""
+    start = period_start(period, since)
+    bars = aggregate(period, date_index.latest_rows(archive.history_lines(daily_path, start)))
+    path = bar_path(period, code)
+    kept = b''
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            kept = b''.join(line for line in f.read().splitlines(True)
+                            if (date_index.parse_quote(line.decode('utf-8', errors='replace')) or ('',))[0] < start)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(kept + _encode(bars))
+    os.replace(path + '.tmp', path)
+    return len(bars)
+
+
+def update(period, code, daily_path, lines):
+    """把剛附加到日資料檔的行併入一個代號的週K或月K
+
+    一般情況（日期都比最後一期晚）只改寫最後一行或附加新的一期，不讀日資料；
+    有更正或較早的日期時，從受影響的那一期起以日資料檔尾重新計算。
+
+    參數:
+        period: week / month
+        code: 代號
+        daily_path: 日資料檔路徑
+        lines: 附加的行
+
+    回傳:
+        併入的日數
+    """
+    rows = date_index.latest_rows(lines)
+    if not rows:
+        return 0
+    path = bar_path(period, code)
+    with filelock.locked(path):
+        try:
+            f = open(path, 'r+b')
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            f = open(path, 'w+b')
+        with f:
+            offset, last = read_last(f)
+            last_date = date_index.gregorian(last[0]) if last else None
+            # 最後一行無法解析（例如手動修改過）、有更正或較早的日期：重新計算
+            if (last is None and offset > 0) or (last is not None and rows[0][0] <= last_date):
+                f.close()
+                return _recompute(period, code, daily_path, rows[0][0])
+            f.seek(offset)
+            f.write(_encode(_extend_last(period, last, last_date, rows)))
+            f.truncate()
+    return len(rows)
+
+
+def _extend_last(period, last, last_date, rows):
+    """新的日資料併入最後一期或開始新的一期，回傳從最後一期起要寫入的K線"""
+    key = period_key(period, last_date) if last else None
+    bars = [last] if last else []
+    for date_str, fields in rows:
+        current = period_key(period, date_str)
+        if current == key:
+            bars[-1] = extend(bars[-1], fields)
+        else:
+            bars.append(extend(None, fields))
+            key = current
+    return bars
+
+
+def add(written):
+    """BatchWriter寫入後更新 txt 個股檔案（含大盤 1000）的週K與月K
+
+    參數:
+        written: [(檔案路徑, 附加資料的起始位移, [行...]), ...]
+    """
+    if not enabled():
+        return
+    for path, _, lines in written:
+        if os.path.basename(os.path.dirname(path)) != 'txt':
+            continue
+        code = os.path.splitext(os.path.basename(path))[0]
+        split = [line for chunk in lines for line in chunk.splitlines()]
+        for period in PERIODS:
+            update(period, code, path, split)
+
+
+def refresh(paths, since):
+    """日資料檔整個改寫（例如補缺漏插入舊日期）後，從 since 所在的那一期起重新計算這些檔案的K線"""
+    if not enabled() or not paths:
+        return
+    for path in paths:
+        code = os.path.splitext(os.path.basename(path))[0]
+        for period in PERIODS:
+            with filelock.locked(bar_path(period, code)):
+                _recompute(period, code, path, since)
+
+
+def build_file(path):
+    """從整個日資料檔重建一個代號的週K與月K，回傳代號"""
+    code = os.path.splitext(os.path.basename(path))[0]
+    rows = date_index.latest_rows(archive.history_lines(path))
+    for period in PERIODS:
+        target = bar_path(period, code)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with filelock.locked(target):
+            with open(target + '.tmp', 'wb') as f:
+                f.write(_encode(aggregate(period, rows)))
+            os.replace(target + '.tmp', target)
+    return code
+
+
+def _build_chunk(paths):
+    return [build_file(path) for path in paths]
+
+
+def rebuild(workers=None):
+    """從現有的 txt 日資料（含封存的年度）重建所有週K與月K（程序池平行處理），回傳檔案數"""
+    names = archive.paths('txt')
+    chunks = [names[i:i + REBUILD_CHUNK] for i in range(0, len(names), REBUILD_CHUNK)]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for _ in executor.map(_build_chunk, chunks):
+            pass
+    print(f"已重建 {len(names)} 個檔案的週K與月K")
+    return len(names)
+
+
+def main():
+    """主程式"""
+    parser = argparse.ArgumentParser(description='週K與月K：隨日資料寫入逐筆更新，不必重新掃描日資料')
+    sub = parser.add_subparsers(dest='command', required=True)
+    build = sub.add_parser('rebuild', help='從現有的日資料重建（第一次使用或日資料被手動修改後）')
+    build.add_argument('--workers', type=int, help='程序數，預設使用所有CPU核心')
+    show = sub.add_parser('show', help='列出某代號最近的K線')
+    show.add_argument('code')
+    show.add_argument('--period', default='week', choices=PERIODS)
+    show.add_argument('--last', type=int, default=10, help='列出最後幾期')
+    args = parser.parse_args()
+
+    if args.command == 'rebuild':
+        rebuild(args.workers)
+    else:
+        for _, fields in read_bars(args.period, args.code)[-args.last:]:
+            print(format_bar(fields), end='')
+
+
+if __name__ == "__main__":
+    main()
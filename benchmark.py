@@ -0,0 +1,398 @@
+import os
+import io
+import csv
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import contextlib
+import tracemalloc
+from datetime import datetime, timedelta
+import stock_common
+import orchestrator
+import metrics
+import validation
+
+# 基準結果檔（--save-baseline 時寫入，之後每次執行自動比較）
+BASELINE_FILE = os.path.join(stock_common.SCRIPT_DIR, 'benchmark_baseline.json')
+
+# 比基準慢超過此比例時標示為退步
+REGRESSION_THRESHOLD = 0.10
+
+# 產生測試資料用的日期（內容固定，多日測試時只改變處理日期）
+FIXTURE_DATE = '20250707'
+
+
+# ---------------------------------------------------------------- 測試資料產生器
+# 格式仿照交易所實際CSV：Big5編碼、CRLF換行、每個欄位加引號，上市行情前面有多個指數/統計表
+
+def _roc(date_str):
+    return f"{int(date_str[:4]) - 1911}年{date_str[4:6]}月{date_str[6:8]}日"
+
+
+def _row(*values):
+    return ','.join(f'"{v}"' for v in values)
+
+
+def _codes(rng, count, is_otc=False):
+    """產生股票代號：一般股票、ETF/特別股（上市）、權證"""
+    codes = [str((3000 if is_otc else 1100) + i) for i in range(count)]
+    if not is_otc:
+        codes += ['0050', '00878', '00679B', '2881A']
+    codes += [f"7{i:05d}" if is_otc else f"03{i:04d}" for i in range(count // 3)]
+    return codes
+
+
+def _encode(lines):
+    return ('\r\n'.join(lines) + '\r\n').encode('big5')
+
+
+def gen_twse_quotes(date_str, count=1350, seed=1):
+    """上市 MI_INDEX：指數表、成交統計等前置表格 + 約1,800行每日收盤行情"""
+    rng = random.Random(seed)
+    lines = [_row(f"{_roc(date_str)} 價格指數(臺灣證券交易所)"),
+             _row('指數', '收盤指數', '漲跌(+/-)', '漲跌點數', '漲跌百分比(%)', '特殊處理註記')]
+    lines += [_row(f'指數{i}', '1,234.56', '+', '1.23', '0.10', '') for i in range(60)]
+    lines += ['', _row(f"{_roc(date_str)} 大盤統計資訊"),
+              _row('成交統計', '成交金額(元)', '成交股數(股)', '成交筆數'),
+              _row('1.一般股票', '300,000,000,000', '5,000,000,000', '2,000,000'), '',
+              _row(f"{_roc(date_str)} 每日收盤行情(全部(不含權證、牛熊證))"),
+              _row('證券代號', '證券名稱', '成交股數', '成交筆數', '成交金額', '開盤價', '最高價', '最低價', '收盤價',
+                   '漲跌(+/-)', '漲跌價差', '最後揭示買價', '最後揭示買量', '最後揭示賣價', '最後揭示賣量', '本益比') + ',']
+    for code in _codes(rng, count):
+        if rng.random() < 0.03:
+            lines.append(_row(code, '名稱', '0', '0', '0', '--', '--', '--', '--', ' ', '0.00', '--', '0', '--', '0', '0.00') + ',')
+            continue
+        close = round(rng.uniform(10, 900), 2)
+        volume = rng.randint(1000, 50000000)
+        lines.append(_row(code, '名稱', f"{volume:,}", f"{rng.randint(1, 9999):,}", f"{volume * 10:,}",
+                          f"{close:.2f}", f"{close * 1.02:.2f}", f"{close * 0.98:.2f}", f"{close:.2f}",
+                          '+', '0.50', f"{close:.2f}", '10', f"{close:.2f}", '5', '12.34') + ',')
+    lines += ['', _row('備註:'), _row('"漲跌價差"為當日收盤價與前一交易日收盤價比較。')]
+    return _encode(lines)
+
+
+def gen_tpex_quotes(date_str, count=900, seed=2):
+    """上櫃 dailyQuotes"""
+    rng = random.Random(seed)
+    lines = [_row('上櫃股票行情'), _row(f"資料日期:{_roc(date_str)}"),
+             _row('代號', '名稱', '收盤 ', '漲跌', '開盤 ', '最高 ', '最低', '均價 ', '成交股數  ', '成交金額(元)', '成交筆數 ',
+                  '最後買價', '最後買量(千股)', '最後賣價', '最後賣量(千股)', '發行股數 ', '次日漲停價 ', '次日跌停價')]
+    for code in _codes(rng, count, is_otc=True):
+        if rng.random() < 0.03:
+            lines.append(_row(code, '名稱', '---', '---', '---', '---', '---', '---', '0', '0', '0', '', '', '', '', '1', '', ''))
+            continue
+        close = round(rng.uniform(10, 500), 2)
+        volume = rng.randint(1000, 9000000)
+        lines.append(_row(code, '名稱', f"{close:.2f}", '+0.10', f"{close:.2f}", f"{close * 1.03:.2f}", f"{close * 0.97:.2f}",
+                          f"{close:.2f}", f"{volume:,}", f"{volume * 20:,}", '99', '1', '1', '1', '1', '1,000,000', '1', '1'))
+    lines.append(_row('管理股票'))
+    return _encode(lines)
+
+
+def gen_index_5sec(date_str, count=4000, seed=3):
+    """MI_5MINS_INDEX：每5秒一行，時間欄位為 ="09:00:00" 格式"""
+    rng = random.Random(seed)
+    lines = [_row(f"{_roc(date_str)} 每5秒指數盤後統計"),
+             _row('時間', '發行量加權股價指數', '未含金融保險股指數', '未含電子股指數', '成交金額')]
+    value = 20000.0
+    for i in range(count):
+        seconds = 9 * 3600 + i * 5
+        value += rng.uniform(-5, 5)
+        lines.append(f'="{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}",'
+                     + _row(f"{value:,.2f}", '1.00', '2.00', f"{1000000 + i * 12345:,}"))
+    lines.append(_row('說明:'))
+    return _encode(lines)
+
+
+def gen_twse_institutional(date_str, count=1350, seed=4):
+    """上市 T86 三大法人買賣超日報"""
+    rng = random.Random(seed)
+    lines = [_row(f"{_roc(date_str)} 三大法人買賣超日報"),
+             _row('證券代號', '證券名稱', '外陸資買進股數(不含外資自營商)', '外陸資賣出股數(不含外資自營商)', '外陸資買賣超股數(不含外資自營商)',
+                  '外資自營商買進股數', '外資自營商賣出股數', '外資自營商買賣超股數', '投信買進股數', '投信賣出股數', '投信買賣超股數',
+                  '自營商買賣超股數', '自營商買進股數(自行買賣)', '自營商賣出股數(自行買賣)', '自營商買賣超股數(自行買賣)',
+                  '自營商買進股數(避險)', '自營商賣出股數(避險)', '自營商買賣超股數(避險)', '三大法人買賣超股數') + ',']
+    for code in _codes(rng, count):
+        lines.append(_row(code, '名稱', *[f"{rng.choice([0, rng.randint(0, 9000000)]):,}" for _ in range(17)]) + ',')
+    lines.append(_row('說明:'))
+    return _encode(lines)
+
+
+def gen_tpex_institutional(date_str, count=900, seed=5):
+    """上櫃三大法人買賣明細"""
+    rng = random.Random(seed)
+    lines = [_row('三大法人買賣明細資訊'), _row(f"資料日期:{_roc(date_str)}"),
+             _row('代號', '名稱', '外資及陸資-買進股數', '外資及陸資-賣出股數', '外資及陸資-買賣超股數', '投信-買進股數', '投信-賣出股數',
+                  '投信-買賣超股數', '自營商(自行買賣)-買進股數', '自營商(自行買賣)-賣出股數', '自營商(自行買賣)-買賣超股數', '三大法人買賣超股數合計')]
+    for code in _codes(rng, count, is_otc=True):
+        lines.append(_row(code, '名稱', *[f"{rng.choice([0, rng.randint(0, 900000)]):,}" for _ in range(10)]))
+    return _encode(lines)
+
+
+def gen_market_institutional(date_str, seed=6):
+    """BFI82U 三大法人買賣金額統計表"""
+    rng = random.Random(seed)
+    lines = [_row(f"{_roc(date_str)} 三大法人買賣金額統計表"), _row('單位名稱', '買進金額', '賣出金額', '買賣差額')]
+    for name in ['自營商(自行買賣)', '自營商(避險)', '投信', '外資及陸資(不含外資自營商)', '外資自營商', '合計']:
+        buy, sell = rng.randint(10 ** 9, 10 ** 11), rng.randint(10 ** 9, 10 ** 11)
+        lines.append(_row(name, f"{buy:,}", f"{sell:,}", f"{buy - sell:,}"))
+    lines.append(_row('說明:'))
+    return _encode(lines)
+
+
+def gen_twse_margin(date_str, count=1350, seed=7):
+    """上市 MI_MARGN：信用交易統計 + 融資融券彙總"""
+    rng = random.Random(seed)
+    lines = [_row(f"{_roc(date_str)} 信用交易統計"), _row('項目', '買進', '賣出', '現金(券)償還', '前日餘額', '今日餘額')]
+    for name in ['融資(交易單位)', '融券(交易單位)', '融資金額(仟元)']:
+        lines.append(_row(name, f"{rng.randint(10 ** 5, 10 ** 8):,}", f"{rng.randint(10 ** 5, 10 ** 8):,}", '1,000',
+                          f"{10 ** 9:,}", f"{rng.randint(10 ** 8, 10 ** 9):,}"))
+    lines += ['', _row(f"{_roc(date_str)} 融資融券彙總 (全部)"),
+              _row('', '', '融資', '', '', '', '', '', '融券', '', '', '', '', '', '', ''),
+              _row('代號', '名稱', '買進', '賣出', '現金償還', '前日餘額', '今日餘額', '次一營業日限額',
+                   '買進', '賣出', '現券償還', '前日餘額', '今日餘額', '次一營業日限額', '資券互抵', '註記')]
+    for code in _codes(rng, count):
+        lines.append(f'="{code}",' + _row('名稱', *[f"{rng.choice([0, rng.randint(0, 90000)]):,}" for _ in range(12)], ''))
+    lines.append(_row('說明:'))
+    return _encode(lines)
+
+
+def gen_tpex_margin(date_str, count=900, seed=8):
+    """上櫃融資融券餘額"""
+    rng = random.Random(seed)
+    lines = [_row('上櫃股票融資融券餘額'), _row(f"資料日期:{_roc(date_str)}"),
+             _row('代號', '名稱', '前資餘額(張)', '資買', '資賣', '現償', '資餘額', '資屬證金', '資使用率(%)', '資限額',
+                  '前券餘額(張)', '券賣', '券買', '券償', '券餘額', '券屬證金', '券使用率(%)', '券限額', '資券相抵(張)', '備註')]
+    for code in _codes(rng, count, is_otc=True):
+        lines.append(_row(code, '名稱', *[f"{rng.choice([0, rng.randint(0, 90000)]):,}" for _ in range(17)], ''))
+    return _encode(lines)
+
+
+GENERATORS = {
+    'twse_quotes': gen_twse_quotes,
+    'tpex_quotes': gen_tpex_quotes,
+    'index_5sec': gen_index_5sec,
+    'twse_institutional': gen_twse_institutional,
+    'tpex_institutional': gen_tpex_institutional,
+    'market_institutional': gen_market_institutional,
+    'twse_margin': gen_twse_margin,
+    'tpex_margin': gen_tpex_margin,
+}
+
+
+def to_json(content):
+    """把產生的CSV轉成交易所JSON回應的格式：{"stat": "OK", "tables": [{"title", "fields", "data"}, ...]}
+
+    每個表為標題之後的第一個多欄位行（欄位名稱）到空行為止；第一欄空白的行（融資/融券分組）不列入
+    """
+    tables = []
+    title = ''
+    table = None
+    for row in csv.reader(io.StringIO(stock_common.decode_bytes(content))):
+        row = [value.lstrip('=').strip('"') for value in row]
+        if len(row) <= 1:
+            title = row[0] if row else ''
+            table = None
+        elif table is None and row[0]:
+            while not row[-1]:
+                row.pop()
+            table = {'title': title, 'fields': row, 'data': []}
+            tables.append(table)
+        elif table is not None:
+            table['data'].append((row + [''] * len(table['fields']))[:len(table['fields'])])
+    return json.dumps({'stat': 'OK', 'tables': tables}, ensure_ascii=False).encode('utf-8')
+
+
+def write_fixtures(directory, date_str=FIXTURE_DATE, keys=None, response='csv'):
+    """在指定目錄產生各來源的測試原始檔，回傳 {來源代號: 路徑}
+
+    response 為 json 時，可使用JSON回應的來源 (stock_common.JSON_SOURCES) 改存成 .json 檔
+    """
+    os.makedirs(directory, exist_ok=True)
+    paths = {}
+    for key in keys or GENERATORS:
+        path = os.path.join(directory, stock_common.SOURCES[key]['file'].format(date=date_str))
+        content = GENERATORS[key](date_str)
+        if response == 'json' and key in stock_common.JSON_SOURCES:
+            path = path[:-len('.csv')] + '.json'
+            content = to_json(content)
+        with open(path, 'wb') as f:
+            f.write(content)
+        paths[key] = path
+    return paths
+
+
+# ---------------------------------------------------------------- 各階段
+
+def stage_parse(key, path, date_str, state):
+    """解碼與解析：標題行定位、欄位對應、逐行解析與數值檢查，結果放進批次寫入器
+
+    解碼在處理函數內進行，耗時取自處理函數記錄的 decode 指標，從解析的時間中扣除（不另外再解碼一次）
+    """
+    state['writer'], records = metrics.collect(orchestrator.parse_source, key, date_str, path)
+    state['split'] = {'decode': sum(entry.get('seconds', 0) for entry in records if entry['stage'] == 'decode')}
+    return state['writer'].rows()
+
+
+def stage_validate(key, path, date_str, state):
+    """異常檢查：與前一日收盤價、成交量比較並隔離可疑的行情"""
+    validation.validate_writer(stock_common.SOURCES[key]['dataset'], date_str, state['writer'])
+    return state['writer'].rows()
+
+
+def stage_write(key, path, date_str, state):
+    """寫入：把批次寫入器的內容附加到個股檔案"""
+    return state['writer'].flush()
+
+
+# 依序執行的階段；後續新增的階段（例如異常檢查）加在這裡。decode 在 parse 中量測（見 stage_parse）
+STAGES = [
+    ('decode', None),
+    ('parse', stage_parse),
+    ('validate', stage_validate),
+    ('write', stage_write),
+]
+
+# 只有部分來源有的階段（其他來源不執行也不列入報告）：異常檢查只看上市/上櫃個股行情
+STAGE_SOURCES = {'validate': ('twse_quotes', 'tpex_quotes')}
+
+
+def applies(name, key):
+    """來源是否有這個階段"""
+    return name not in STAGE_SOURCES or key in STAGE_SOURCES[name]
+
+
+def _run_stages(paths, days, measure_memory):
+    """執行所有來源、所有日期的各階段，回傳 {來源: {階段: 統計}}"""
+    # 多日測試沿用同一份內容，只改變處理的日期（從固定日期往後連續的平日）
+    dates = []
+    day = datetime.strptime(FIXTURE_DATE, '%Y%m%d')
+    while len(dates) < days:
+        if day.weekday() < 5:
+            dates.append(day.strftime('%Y%m%d'))
+        day += timedelta(days=1)
+
+    results = {}
+    for key, path in paths.items():
+        stats = {name: {'seconds': 0.0, 'items': 0, 'peak_kb': 0} for name, _ in STAGES}
+        for date_str in dates:
+            state = {}
+            for name, func in STAGES:
+                if func is None or not applies(name, key):
+                    continue
+                if measure_memory:
+                    tracemalloc.start()
+                started = time.perf_counter()
+                items = func(key, path, date_str, state)
+                stats[name]['seconds'] += time.perf_counter() - started
+                stats[name]['items'] += items or 0
+                # 在這個階段內量測到的其他階段（decode）移過去，峰值記憶體兩者相同
+                for other, seconds in state.pop('split', {}).items():
+                    stats[other]['seconds'] += seconds
+                    stats[name]['seconds'] -= seconds
+                    if measure_memory:
+                        stats[other]['peak_kb'] = max(stats[other]['peak_kb'], tracemalloc.get_traced_memory()[1] // 1024)
+                if measure_memory:
+                    stats[name]['peak_kb'] = max(stats[name]['peak_kb'], tracemalloc.get_traced_memory()[1] // 1024)
+                    tracemalloc.stop()
+        results[key] = stats
+    return results
+
+
+def run_benchmark(days=1, verbose=False, response='csv'):
+    """產生測試資料並量測各階段，輸出寫到暫存目錄
+
+    參數:
+        response: csv / json，json 時可使用JSON回應的來源改用JSON原始檔
+
+    回傳:
+        {'days': 天數, 'response': 格式, 'sources': {來源: {'rows': 行數, 階段: {'seconds', 'rows_per_s', 'peak_kb'}}}}
+    """
+    work_dir = tempfile.mkdtemp(prefix='stock_bench_')
+    original_root = stock_common.STOCK_ROOT
+    try:
+        paths = write_fixtures(os.path.join(work_dir, 'raw'), response=response)
+        # 行數一律以CSV內容計算，兩種格式的 行/秒 可以直接比較
+        rows = {key: len(stock_common.decode_bytes(GENERATORS[key](FIXTURE_DATE)).splitlines()) for key in paths}
+
+        output = io.StringIO() if not verbose else None
+        with (contextlib.redirect_stdout(output) if output else contextlib.nullcontext()):
+            # 第一輪量測時間（不開tracemalloc以免影響速度），第二輪量測記憶體
+            stock_common.STOCK_ROOT = os.path.join(work_dir, 'timing')
+            timing = _run_stages(paths, days, measure_memory=False)
+            stock_common.STOCK_ROOT = os.path.join(work_dir, 'memory')
+            memory = _run_stages(paths, 1, measure_memory=True)
+
+        report = {'days': days, 'response': response, 'sources': {}}
+        for key in paths:
+            entry = {'rows': rows[key]}
+            for name, _ in STAGES:
+                if not applies(name, key):
+                    continue
+                seconds = timing[key][name]['seconds']
+                entry[name] = {
+                    'seconds': round(seconds, 6),
+                    'rows_per_s': round(rows[key] * days / seconds) if seconds > 0 else None,
+                    'peak_kb': memory[key][name]['peak_kb'],
+                }
+            report['sources'][key] = entry
+        return report
+    finally:
+        stock_common.STOCK_ROOT = original_root
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def print_report(report, baseline=None):
+    """列印結果；有基準時顯示速度變化，慢超過門檻的階段標示 <<"""
+    print(f"測試天數: {report['days']}  原始檔格式: {report.get('response', 'csv')}")
+    print(f"{'來源':22s} {'階段':8s} {'行數':>7s} {'秒':>9s} {'行/秒':>11s} {'峰值KB':>8s} {'對比基準':>9s}")
+    regressions = 0
+    for key, entry in report['sources'].items():
+        for name, _ in STAGES:
+            stage = entry.get(name)
+            if stage is None:
+                continue
+            change = ''
+            base = (baseline or {}).get('sources', {}).get(key, {}).get(name)
+            if base and base.get('rows_per_s') and stage['rows_per_s'] and baseline.get('days') == report['days'] \
+                    and baseline.get('response', 'csv') == report.get('response', 'csv'):
+                ratio = stage['rows_per_s'] / base['rows_per_s'] - 1
+                change = f"{ratio:+.1%}"
+                if ratio < -REGRESSION_THRESHOLD:
+                    change += ' <<'
+                    regressions += 1
+            print(f"{key:22s} {name:8s} {entry['rows']:7d} {stage['seconds']:9.4f} {stage['rows_per_s'] or 0:11,d} {stage['peak_kb']:8d} {change:>9s}")
+    return regressions
+
+
+def main():
+    """主程式"""
+    parser = argparse.ArgumentParser(description='以模擬交易所資料量測各處理階段的速度與記憶體')
+    parser.add_argument('--days', type=int, default=1, help='模擬的天數（例如 1000 模擬長期回補）')
+    parser.add_argument('--response', choices=('csv', 'json'), default='csv', help='原始檔格式（比較CSV與JSON兩種解析路徑）')
+    parser.add_argument('--save-baseline', action='store_true', help='把本次結果存成基準')
+    parser.add_argument('--verbose', action='store_true', help='顯示處理函數的原始輸出')
+    args = parser.parse_args()
+
+    report = run_benchmark(args.days, args.verbose, args.response)
+
+    baseline = None
+    if os.path.exists(BASELINE_FILE):
+        with open(BASELINE_FILE, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    regressions = print_report(report, baseline)
+    if args.save_baseline:
+        with open(BASELINE_FILE, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"已儲存基準: {BASELINE_FILE}")
+    elif regressions:
+        print(f"有 {regressions} 個階段比基準慢超過 {REGRESSION_THRESHOLD:.0%}")
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,327 @@
+import os
+import shutil
+import argparse
+import threading
+from concurrent.futures import ProcessPoolExecutor
+import stock_common
+import filelock
+
+# 建立索引的輸出目錄
+FAMILIES = ('txt', 'law', 'inv')
+
+# 重建時每個工作分配的檔案數
+REBUILD_CHUNK = 50
+
+# 從檔尾往前讀的區塊大小
+TAIL_BLOCK = 64 * 1024
+
+_lock = threading.Lock()
+
+
+def index_dir(family):
+    """索引目錄：D:/stock/index/{family}/{YYYYMMDD}.idx，每行 代號,位移,長度"""
+    return os.path.join(stock_common.output_dir('index'), family)
+
+
+def index_path(family, date_str):
+    return os.path.join(index_dir(family), f"{date_str}.idx")
+
+
+def gregorian(field):
+    """檔案第一欄的日期（民國 YYYMMDD 或西元 YYYYMMDD）轉成西元 YYYYMMDD 字串，不是日期時回傳None"""
+    if not field.isdigit():
+        return None
+    value = int(field)
+    if value < 19110000:
+        value += 19110000
+    return str(value)
+
+
+def line_date(line):
+    """一行資料（"日期","..."）的日期"""
+    if line.startswith('"'):
+        end = line.find('"', 1)
+        return gregorian(line[1:end]) if end > 0 else None
+    return gregorian(line.split(',', 1)[0])
+
+
+def parse_quote(line):
+    """一行日資料（或K線）轉成 (西元日期, [日期欄, 開, 高, 低, 收, 量])，不是完整行情時回傳None"""
+    fields = [field.strip().strip('"') for field in line.strip().split(',')]
+    if len(fields) < 6:
+        return None
+    date_str = gregorian(fields[0])
+    try:
+        for value in fields[1:5]:
+            float(value)
+        fields[5] = str(int(float(fields[5])))
+    except ValueError:
+        return None
+    return (date_str, fields[:6]) if date_str else None
+
+
+def latest_rows(lines):
+    """解析日資料行，同一天出現多次（更正）時取最後一次，依日期排序的 [(西元日期, 欄位), ...]
+
+    週K/月K (bars.py) 與技術指標 (indicators.py) 都以這個結果為準
+    """
+    rows = {}
+    for line in lines:
+        parsed = parse_quote(line)
+        if parsed is not None:
+            rows[parsed[0]] = parsed[1]
+    return sorted(rows.items())
+
+
+def tail_lines(path, since):
+    """從檔尾往前讀出日期在 since (YYYYMMDD) 以後的行，不讀整個檔案
+
+    檔案大致依日期附加：讀到整個區塊都是更早的日期時停止（檔尾附加的舊日期更正行不會提早停止）。
+
+    回傳:
+        [行...]，依檔案中的順序、已去除換行；檔案不存在時為空列表
+    """
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return []
+    found = []
+    with f:
+        end = f.seek(0, os.SEEK_END)
+        remainder = b''
+        while end > 0:
+            start = max(0, end - TAIL_BLOCK)
+            f.seek(start)
+            block = f.read(end - start) + remainder
+            raws = block.split(b'\n')
+            # 第一段可能是半行，留到下一個區塊再處理（已讀到檔頭時例外）
+            remainder = raws.pop(0) if start > 0 else b''
+            kept = []
+            older = False
+            for raw in raws:
+                line = raw.decode('utf-8', errors='replace').strip()
+                date_str = line_date(line)
+                if date_str is None:
+                    continue
+                if date_str >= since:
+                    kept.append(line)
+                else:
+                    older = True
+            found.append(kept)
+            if older and not kept:
+                break
+            end = start
+    return [line for kept in reversed(found) for line in kept]
+
+
+def blocks(lines, offset, newline=os.linesep):
+    """把附加到檔案的行依日期分段
+
+    參數:
+        lines: 依序附加的行（每個字串可包含多行，以\\n結尾）
+        offset: 第一行在檔案中的位元組位置
+        newline: 寫入時換行符號轉換成的字串
+
+    回傳:
+        [(日期, 位移, 長度), ...]，相鄰同日期的行合併成一段
+    """
+    extra = len(newline) - 1
+    result = []
+    for line in lines:
+        length = len(line.encode('utf-8')) + line.count('\n') * extra
+        date_str = line_date(line)
+        if date_str is None:
+            offset += length
+            continue
+        if result and result[-1][0] == date_str and result[-1][1] + result[-1][2] == offset:
+            result[-1] = (date_str, result[-1][1], result[-1][2] + length)
+        else:
+            result.append((date_str, offset, length))
+        offset += length
+    return result
+
+
+def _append(entries):
+    """entries: {(family, 日期): [行...]}，附加到各日期的索引檔"""
+    with _lock:
+        for (family, date_str), lines in entries.items():
+            path = index_path(family, date_str)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with filelock.locked(path), open(path, 'a', encoding='utf-8', newline='\n') as f:
+                f.write(''.join(lines))
+
+
+def add(written):
+    """BatchWriter寫入後更新索引
+
+    參數:
+        written: [(檔案路徑, 附加資料的起始位移, [行...]), ...]，只處理 txt / law / inv 目錄下的檔案
+    """
+    entries = {}
+    for path, offset, lines in written:
+        family = os.path.basename(os.path.dirname(path))
+        if family not in FAMILIES:
+            continue
+        code = os.path.splitext(os.path.basename(path))[0]
+        for date_str, start, length in blocks(lines, offset):
+            entries.setdefault((family, date_str), []).append(f"{code},{start},{length}\n")
+    if entries:
+        _append(entries)
+
+
+def lookup(family, date_str):
+    """某日在各檔案的位置 {代號: [(位移, 長度), ...]}（同一天寫入多次時依寫入順序）"""
+    path = index_path(family, date_str)
+    if not os.path.exists(path):
+        return {}
+    result = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            code, start, length = line.rstrip('\n').rsplit(',', 2)
+            result.setdefault(code, []).append((int(start), int(length)))
+    return result
+
+
+def read_date(family, date_str, latest=True):
+    """直接讀出某日所有個股的行（不掃描整個檔案）
+
+    參數:
+        family: 輸出目錄 (txt / law / inv)
+        date_str: 西元日期 (YYYYMMDD)
+        latest: 同一天寫入多次（例如更正）時只取最後一次
+
+    回傳:
+        {代號: [行...]}（行已去除換行）；沒有索引也沒有封存時回傳None
+    """
+    # 已封存的年度先從壓縮檔讀，封存後才寫入的行（例如更正）仍在個股檔案、有索引（見 archive.py）
+    import archive
+    archived = archive.read_day(family, date_str, latest)
+    positions = lookup(family, date_str)
+    if not positions and not os.path.exists(index_path(family, date_str)):
+        return archived
+    directory = stock_common.output_dir(family)
+    result = dict(archived or {})
+    for code, spans in positions.items():
+        if latest:
+            spans = spans[-1:]
+        try:
+            with open(os.path.join(directory, f"{code}.{family}"), 'rb') as f:
+                lines = []
+                for start, length in spans:
+                    f.seek(start)
+                    lines.extend(f.read(length).decode('utf-8').splitlines())
+        except FileNotFoundError:
+            continue
+        lines = [line for line in lines if line]
+        result[code] = lines if latest else result.get(code, []) + lines
+    return result
+
+
+def scan_file(path):
+    """掃描一個個股檔案，回傳 (代號, [(日期, 位移, 長度), ...])"""
+    code = os.path.splitext(os.path.basename(path))[0]
+    result = []
+    offset = 0
+    with open(path, 'rb') as f:
+        for raw in f:
+            date_str = line_date(raw.decode('utf-8', errors='replace').strip())
+            if date_str is not None:
+                if result and result[-1][0] == date_str and result[-1][1] + result[-1][2] == offset:
+                    result[-1] = (date_str, result[-1][1], result[-1][2] + len(raw))
+                else:
+                    result.append((date_str, offset, len(raw)))
+            offset += len(raw)
+    return code, result
+
+
+def _scan_chunk(paths):
+    return [scan_file(path) for path in paths]
+
+
+def reindex(family, paths, since):
+    """個股檔案整個改寫（例如補缺漏時插入舊日期的行）後，重建這些檔案的索引
+
+    參數:
+        family: 輸出目錄 (txt / law / inv)
+        paths: 改寫過的檔案
+        since: 位置有變動的最早日期 (YYYYMMDD)，更早日期的索引不受影響
+    """
+    if family not in FAMILIES or not paths:
+        return
+    codes = set()
+    entries = {}
+    for path in paths:
+        code, spans = scan_file(path)
+        codes.add(code)
+        for date_str, start, length in spans:
+            if date_str >= since:
+                entries.setdefault(date_str, []).append(f"{code},{start},{length}\n")
+    with _lock:
+        directory = index_dir(family)
+        os.makedirs(directory, exist_ok=True)
+        dates = set(entries) | {name[:-len('.idx')] for name in os.listdir(directory)
+                                if name.endswith('.idx') and name[:-len('.idx')] >= since}
+        for date_str in sorted(dates):
+            path = index_path(family, date_str)
+            with filelock.locked(path):
+                kept = []
+                if os.path.exists(path):
+                    with open(path, 'r', encoding='utf-8') as f:
+                        kept = [line for line in f if line.split(',', 1)[0] not in codes]
+                with open(path + '.tmp', 'w', encoding='utf-8', newline='\n') as f:
+                    f.write(''.join(kept + entries.get(date_str, [])))
+                os.replace(path + '.tmp', path)
+
+
+def rebuild(families=FAMILIES, workers=None):
+    """從現有的個股檔案重建索引（程序池平行掃描，主程序依日期附加）
+
+    回傳:
+        {family: 掃描的檔案數}
+    """
+    counts = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for family in families:
+            directory = stock_common.output_dir(family)
+            names = sorted(name for name in os.listdir(directory) if name.endswith(f".{family}")) \
+                if os.path.isdir(directory) else []
+            shutil.rmtree(index_dir(family), ignore_errors=True)
+            chunks = [[os.path.join(directory, name) for name in names[i:i + REBUILD_CHUNK]]
+                      for i in range(0, len(names), REBUILD_CHUNK)]
+            for results in executor.map(_scan_chunk, chunks):
+                entries = {}
+                for code, spans in results:
+                    for date_str, start, length in spans:
+                        entries.setdefault((family, date_str), []).append(f"{code},{start},{length}\n")
+                _append(entries)
+            counts[family] = len(names)
+            print(f"{family}: 已重建 {len(names)} 個檔案的日期索引")
+    return counts
+
+
+def main():
+    """主程式"""
+    parser = argparse.ArgumentParser(description='個股檔案的日期索引（日期 -> 檔案位置）')
+    sub = parser.add_subparsers(dest='command', required=True)
+    build = sub.add_parser('rebuild', help='從現有檔案重建索引')
+    build.add_argument('--families', nargs='+', default=list(FAMILIES), choices=FAMILIES)
+    build.add_argument('--workers', type=int, help='程序數，預設使用所有CPU核心')
+    show = sub.add_parser('show', help='列出某日所有個股的資料')
+    show.add_argument('date', help='日期 (YYYYMMDD)')
+    show.add_argument('--family', default='txt', choices=FAMILIES)
+    args = parser.parse_args()
+
+    if args.command == 'rebuild':
+        rebuild(args.families, args.workers)
+    else:
+        result = read_date(args.family, args.date)
+        if result is None:
+            print(f"沒有 {args.date} 的索引，請先執行 python date_index.py rebuild")
+            return
+        for code in sorted(result):
+            for line in result[code]:
+                print(f"{code}: {line}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+import os
+import csv
+import json
+import time
+import argparse
+import threading
+from datetime import datetime
+import stock_common
+import filelock
+
+# 異動檔目錄，可用環境變數 STOCK_DELTA_DIR 覆寫（預設 D:/stock/delta）
+DELTA_DIR = os.environ.get('STOCK_DELTA_DIR')
+
+# 所有異動的索引：每次寫入一行 {seq, dataset, date, offset, length, codes, corrections}
+FEED_FILE = 'feed.jsonl'
+
+# follow 模式檢查新異動的間隔(秒)
+FOLLOW_INTERVAL = 5
+
+_lock = threading.Lock()
+
+
+def enabled():
+    """是否產生異動檔（環境變數 STOCK_DELTA=0 關閉，例如離線重建時）"""
+    return os.environ.get('STOCK_DELTA', '1') != '0'
+
+
+def delta_dir():
+    return DELTA_DIR or stock_common.output_dir('delta')
+
+
+def delta_path(dataset, date_str):
+    """某資料集某日的異動檔：delta/{資料集}/{日期}.jsonl，每行一個代號"""
+    return os.path.join(delta_dir(), dataset, f"{date_str}.jsonl")
+
+
+def _parse_lines(lines):
+    """把寫入個股檔案的行轉回欄位列表"""
+    return [row for row in csv.reader(''.join(lines).splitlines()) if row]
+
+
+def read_entries(dataset, date_str):
+    """讀出某資料集某日的所有異動（依寫入順序）"""
+    path = delta_path(dataset, date_str)
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def last_seq():
+    """索引中最後一個序號（只讀檔尾），還沒有任何異動時回傳0"""
+    path = os.path.join(delta_dir(), FEED_FILE)
+    if not os.path.exists(path):
+        return 0
+    with open(path, 'rb') as f:
+        size = f.seek(0, os.SEEK_END)
+        f.seek(max(0, size - 4096))
+        lines = f.read().splitlines()
+    return json.loads(lines[-1])['seq'] if lines else 0
+
+
+def _next_seq():
+    """下一個序號（從索引最後一行接續；其他程序也會寫入，每次都重新讀取，呼叫端須持有索引的檔案鎖）"""
+    return last_seq() + 1
+
+
+def record(dataset, date_str, written):
+    """把一次寫入的內容記成異動
+
+    參數:
+        dataset: 資料集 (quotes / institutional / margin / world)
+        date_str: 日期字串 (YYYYMMDD格式)
+        written: 這次附加到各檔案的內容 {路徑: [行...]}（BatchWriter.last_flush）
+
+    同一檔案在同一天先前已有異動且內容不同時記為更正，並附上先前的記錄；內容相同則不列入。
+
+    回傳:
+        這次異動的序號，沒有任何異動時回傳None
+    """
+    if not enabled() or not written:
+        return None
+    feed_path = os.path.join(delta_dir(), FEED_FILE)
+    with _lock, filelock.locked(feed_path):
+        previous = {}
+        for entry in read_entries(dataset, date_str):
+            previous[(entry['file'], entry['code'])] = entry['records']
+
+        entries = []
+        corrections = 0
+        for path, lines in written.items():
+            family = os.path.basename(os.path.dirname(path))
+            code = os.path.splitext(os.path.basename(path))[0]
+            records = _parse_lines(lines)
+            entry = {'code': code, 'file': family, 'records': records}
+            old = previous.get((family, code))
+            if old is not None:
+                if old == records:
+                    continue
+                entry['correction'] = True
+                entry['previous'] = old
+                corrections += 1
+            entries.append(entry)
+        if not entries:
+            return None
+
+        seq = _next_seq()
+        path = delta_path(dataset, date_str)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = ''.join(json.dumps(dict(entry, seq=seq), ensure_ascii=False, separators=(',', ':')) + '\n'
+                       for entry in entries).encode('utf-8')
+        with open(path, 'ab') as f:
+            offset = f.seek(0, os.SEEK_END)
+            f.write(data)
+        feed = {'seq': seq, 'ts': datetime.now().strftime('%Y-%m-%dT%H:%M:%S'), 'dataset': dataset,
+                'date': date_str, 'offset': offset, 'length': len(data), 'codes': len(entries),
+                'corrections': corrections}
+        with open(feed_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(feed, ensure_ascii=False) + '\n')
+        return seq
+
+
+def _seek_after(f, cursor):
+    """在索引中二分搜尋cursor之後的位置（序號依寫入順序遞增）
+
+    回傳某一行開頭的位元組位置，之前的行序號都不大於cursor；剩下不到 4KB 時由呼叫端依序略過
+    """
+    low, high = 0, f.seek(0, os.SEEK_END)
+    while high - low > 4096:
+        middle = (low + high) // 2
+        f.seek(middle)
+        f.readline()  # 略過被切到的行
+        line = f.readline()
+        if not line.endswith(b'\n') or json.loads(line)['seq'] > cursor:
+            high = middle
+        else:
+            low = f.tell()
+    return low
+
+
+def tail(cursor=0, datasets=None, limit=None, offset=None):
+    """讀取序號大於cursor的異動
+
+    參數:
+        cursor: 上次處理到的序號（0為從頭開始）
+        datasets: 只取這些資料集，None為全部
+        limit: 最多回傳幾次異動
+        offset: 上次回傳的 offset（索引中的位元組位置），省略時以二分搜尋找出cursor的位置
+
+    回傳:
+        產生 {seq, dataset, date, ts, corrections, offset, entries: [{code, file, records, ...}]}；
+        處理完後以最後一個 seq（和 offset）作為下次的cursor。
+        只讀取已寫完（以換行結尾）的索引行，寫到一半的最後一行留到下次
+    """
+    path = os.path.join(delta_dir(), FEED_FILE)
+    if not os.path.exists(path):
+        return
+    count = 0
+    with open(path, 'rb') as f:
+        f.seek(_seek_after(f, cursor) if offset is None else offset)
+        while True:
+            line = f.readline()
+            if not line.endswith(b'\n'):
+                return
+            if not line.strip():
+                continue
+            feed = json.loads(line)
+            if feed['seq'] <= cursor or (datasets and feed['dataset'] not in datasets):
+                continue
+            with open(delta_path(feed['dataset'], feed['date']), 'rb') as delta_file:
+                delta_file.seek(feed['offset'])
+                chunk = delta_file.read(feed['length']).decode('utf-8')
+            yield {'seq': feed['seq'], 'dataset': feed['dataset'], 'date': feed['date'], 'ts': feed['ts'],
+                   'corrections': feed['corrections'], 'offset': f.tell(),
+                   'entries': [json.loads(entry) for entry in chunk.splitlines() if entry]}
+            count += 1
+            if limit and count >= limit:
+                return
+
+
+def follow(cursor=0, datasets=None, interval=FOLLOW_INTERVAL, stop_event=None):
+    """持續等待新的異動（類似 tail -f），stop_event 設定時結束；從上次讀到的位置接續，不重新掃描索引"""
+    offset = None
+    while stop_event is None or not stop_event.is_set():
+        for delta in tail(cursor, datasets, offset=offset):
+            cursor, offset = delta['seq'], delta['offset']
+            yield delta
+        if stop_event is not None:
+            stop_event.wait(interval)
+        else:
+            time.sleep(interval)
+
+
+def main():
+    """主程式"""
+    parser = argparse.ArgumentParser(description='讀取個股檔案的每日異動')
+    sub = parser.add_subparsers(dest='command', required=True)
+    tail_parser = sub.add_parser('tail', help='列出序號大於cursor的異動（JSON lines）')
+    tail_parser.add_argument('--cursor', type=int, default=0, help='上次處理到的序號')
+    tail_parser.add_argument('--datasets', nargs='+', help='只列出這些資料集')
+    tail_parser.add_argument('--limit', type=int, help='最多列出幾次異動')
+    tail_parser.add_argument('--follow', action='store_true', help='持續等待新的異動')
+    show = sub.add_parser('show', help='摘要某資料集某日的異動')
+    show.add_argument('dataset')
+    show.add_argument('date')
+    args = parser.parse_args()
+
+    if args.command == 'tail':
+        deltas = follow(args.cursor, args.datasets) if args.follow else tail(args.cursor, args.datasets, args.limit)
+        for delta in deltas:
+            print(json.dumps(delta, ensure_ascii=False), flush=True)
+    else:
+        entries = read_entries(args.dataset, args.date)
+        corrections = [entry for entry in entries if entry.get('correction')]
+        print(f"{args.dataset} {args.date}: {len({(e['file'], e['code']) for e in entries})} 個檔案有異動，"
+              f"{len(corrections)} 筆更正")
+        for entry in corrections:
+            print(f"  更正 {entry['file']}/{entry['code']} (seq {entry['seq']}): {entry['previous']} -> {entry['records']}")
+
+
+if __name__ == "__main__":
+    main()
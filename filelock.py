@@ -0,0 +1,141 @@
+import os
+import zlib
+import threading
+import contextlib
+import stock_common
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# 鎖定模式（環境變數 STOCK_LOCKING）：
+#   striped 每個輸出檔案依路徑分配到一個條紋鎖，不同條紋的檔案可以同時寫入（預設）
+#   single  另外以一個全域寫入鎖讓同一時間只有一個程序在寫入（每次寫入的內容在檔案中保持連續）
+#   0       不鎖定（只有一個程序在執行時）
+MODES = ('striped', 'single', '0')
+
+# 條紋數：檔案路徑的雜湊值決定使用哪一個鎖檔
+STRIPES = 64
+
+# 鎖檔目錄，可用環境變數 STOCK_LOCK_DIR 覆寫（預設 D:/stock/locks）
+LOCK_DIR = os.environ.get('STOCK_LOCK_DIR')
+
+WRITER_LOCK = 'writer.lock'
+
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def mode():
+    value = os.environ.get('STOCK_LOCKING', 'striped')
+    if value not in MODES:
+        raise ValueError(f"STOCK_LOCKING 必須是 {', '.join(MODES)}")
+    return value
+
+
+def lock_dir():
+    return LOCK_DIR or stock_common.output_dir('locks')
+
+
+def stripe_of(path):
+    """檔案路徑對應的條紋編號（同一檔案不論寫成相對或絕對路徑都相同）"""
+    key = os.path.normcase(os.path.abspath(path)).replace('\\', '/')
+    return zlib.crc32(key.encode('utf-8')) % STRIPES
+
+
+class ProcessLock:
+    """以鎖檔實作的跨程序互斥鎖（fcntl.flock / msvcrt.locking），同一程序內的執行緒也互斥，可重入
+
+    參數:
+        path: 鎖檔路徑
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._thread_lock = threading.RLock()
+        self._fd = None
+        self._pid = None
+        self._depth = 0
+
+    def _open(self):
+        # fork 出來的子程序要重新開啟：flock 以開啟的檔案為單位，沿用父程序的檔案不會互斥
+        if self._fd is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT)
+            self._pid = os.getpid()
+        return self._fd
+
+    def acquire(self):
+        self._thread_lock.acquire()
+        if self._depth == 0:
+            try:
+                fd = self._open()
+                if fcntl is not None:
+                    fcntl.flock(fd, fcntl.LOCK_EX)
+                else:
+                    os.lseek(fd, 0, os.SEEK_SET)
+                    while True:
+                        try:
+                            msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+                            break
+                        except OSError:
+                            # LK_LOCK 重試約10秒後放棄，繼續等待
+                            continue
+            except BaseException:
+                self._thread_lock.release()
+                raise
+        self._depth += 1
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            else:
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+        self._thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def _lock(name):
+    path = os.path.join(lock_dir(), name)
+    with _locks_lock:
+        lock = _locks.get(path)
+        if lock is None:
+            lock = _locks[path] = ProcessLock(path)
+        return lock
+
+
+@contextlib.contextmanager
+def locked(path):
+    """鎖住一個輸出檔案（讀取後附加、改寫或替換時使用）
+
+    同一條紋的其他檔案也會等待；不要在持有時再鎖另一個檔案（不同程序的順序不同時會互相等待）。
+    """
+    if mode() == '0':
+        yield
+        return
+    with _lock(f"stripe-{stripe_of(path):02d}.lock"):
+        yield
+
+
+@contextlib.contextmanager
+def writer():
+    """單一寫入者模式下持有全域寫入鎖（其他模式不做事），包住一次完整的寫入（個股檔案、索引、異動檔）
+
+    可重入；必須在 locked() 之外取得。
+    """
+    if mode() != 'single':
+        yield
+        return
+    with _lock(WRITER_LOCK):
+        yield
@@ -0,0 +1,204 @@
+import os
+import csv
+import bisect
+import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import stock_common
+import date_index
+import security_master
+import archive
+
+FAMILIES = ('txt', 'law', 'inv')
+
+# 交易日曆：大盤 (1000) 在各輸出目錄出現過的日期
+MARKET_CODE = '1000'
+
+# 掃描時每個工作分配的檔案數
+SCAN_CHUNK = 200
+
+# 缺漏報告（輸出根目錄下 gaps/{family}.csv），code 為 * 的行表示整天都沒有資料
+REPORT_FIELDS = ['family', 'code', 'missing', 'dates']
+
+
+def report_path(family):
+    return os.path.join(stock_common.output_dir('gaps'), f"{family}.csv")
+
+
+def scan_dates(path, since=None):
+    """讀出個股檔案中出現的日期（只看每行第一欄，不解析整行）
+
+    參數:
+        path: 個股檔案路徑
+        since: 只需要這天 (YYYYMMDD) 以後的日期時，從檔尾往前讀到更早的日期為止
+
+    回傳:
+        西元日期 (YYYYMMDD) 的集合，檔案不存在時為空集合
+    """
+    if since is not None:
+        return {date_index.line_date(line) for line in archive.history_lines(path, since)}
+    # 已封存的年度只讀壓縮檔中這個代號的成員（見 archive.py）
+    family = os.path.basename(os.path.dirname(path))
+    code = os.path.splitext(os.path.basename(path))[0]
+    dates = {date_index.line_date(line) for line in archive.archived_lines(family, code)}
+    dates.discard(None)
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        return dates
+    with f:
+        for raw in f:
+            date_str = date_index.line_date(raw.decode('utf-8', errors='replace').strip())
+            if date_str:
+                dates.add(date_str)
+    return dates
+
+
+def _scan_chunk(paths, since):
+    return [(os.path.splitext(os.path.basename(path))[0], scan_dates(path, since)) for path in paths]
+
+
+def trading_calendar(start=None, end=None):
+    """交易日曆：大盤 (1000) 在 txt / law / inv 出現過的日期，依日期排序"""
+    dates = set()
+    for family in FAMILIES:
+        dates |= scan_dates(os.path.join(stock_common.output_dir(family), f"{MARKET_CODE}.{family}"), start)
+    return sorted(date_str for date_str in dates if (not start or date_str >= start) and (not end or date_str <= end))
+
+
+def present_from_index(family, dates, workers=None):
+    """用日期索引找出各代號出現的日期 {代號: {日期...}}；有日期沒有索引檔時回傳None"""
+    paths = [date_index.index_path(family, date_str) for date_str in dates]
+    # 已封存的年度不在索引中（見 archive.py），改為掃描
+    archived = set(archive.years(family))
+    if any(int(date_str[:4]) in archived for date_str in dates) or not all(os.path.exists(path) for path in paths):
+        return None
+
+    def read(date_str):
+        return date_str, list(date_index.lookup(family, date_str))
+
+    present = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for date_str, codes in executor.map(read, dates):
+            for code in codes:
+                present.setdefault(code, set()).add(date_str)
+    return present
+
+
+def present_from_files(family, since=None, workers=None):
+    """平行掃描輸出目錄的所有個股檔案（含已封存的代號）{代號: {日期...}}（since 見 scan_dates）"""
+    names = archive.paths(family)
+    chunks = [names[i:i + SCAN_CHUNK] for i in range(0, len(names), SCAN_CHUNK)]
+    present = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for results in executor.map(_scan_chunk, chunks, [since] * len(chunks)):
+            present.update(results)
+    return present
+
+
+def detect(family, start=None, end=None, source='auto', workers=None):
+    """找出輸出目錄中缺少的 (代號, 日期)
+
+    txt 以證券主檔的掛牌期間（首次~最後出現）與交易日曆比對每個代號；
+    law / inv 只在有買賣或餘額時才寫入，個別代號沒有資料是正常的，只檢查整天都沒有資料的日期。
+
+    參數:
+        family: 輸出目錄 (txt / law / inv)
+        start, end: 檢查的日期區間 (YYYYMMDD)，預設為整個交易日曆
+        source: index 使用日期索引、scan 掃描檔案、auto 有完整索引時使用索引
+        workers: 平行工作數
+
+    回傳:
+        [(代號, [缺少的日期...]), ...]，代號 * 表示整天都沒有資料
+    """
+    calendar = trading_calendar(start, end)
+    if not calendar:
+        return []
+    present = present_from_index(family, calendar, workers) if source in ('auto', 'index') else None
+    if present is None:
+        if source == 'index':
+            raise ValueError(f"{family} 的日期索引不完整，請先執行 python date_index.py rebuild")
+        present = present_from_files(family, calendar[0], workers)
+
+    # 整天缺漏：除了大盤以外沒有任何代號有這天的資料
+    seen = set()
+    for code, dates in present.items():
+        if code != MARKET_CODE:
+            seen |= dates
+    gaps = []
+    missing_days = [date_str for date_str in calendar if date_str not in seen]
+    if missing_days:
+        gaps.append(('*', missing_days))
+    if family != 'txt':
+        return gaps
+
+    master = security_master.load()
+    missing_set = set(missing_days)
+    for code in sorted(master.entries):
+        entry = master.get(code)
+        if security_master.skipped(code):
+            continue
+        have = present.get(code, set())
+        listed = calendar[bisect.bisect_left(calendar, entry['first_seen']):bisect.bisect_right(calendar, entry['last_seen'])]
+        # 整天缺少的日期已列在 * 行，不再逐代號列出
+        dates = [date_str for date_str in listed if date_str not in have and date_str not in missing_set]
+        if dates:
+            gaps.append((code, dates))
+    return gaps
+
+
+def write_report(family, gaps, path=None):
+    """寫出缺漏報告，回傳檔案路徑"""
+    path = path or report_path(family)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'w', encoding='utf-8', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+        writer.writeheader()
+        for code, dates in gaps:
+            writer.writerow({'family': family, 'code': code, 'missing': len(dates), 'dates': ' '.join(dates)})
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def load_report(path):
+    """讀回缺漏報告
+
+    回傳:
+        ({代號: [日期...]}, [整天缺少的日期...])
+    """
+    gaps = {}
+    missing_days = []
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        for entry in csv.DictReader(f):
+            dates = entry['dates'].split()
+            if entry['code'] == '*':
+                missing_days.extend(dates)
+            else:
+                gaps[entry['code']] = dates
+    return gaps, missing_days
+
+
+def main():
+    """主程式"""
+    parser = argparse.ArgumentParser(description='檢查個股輸出檔案缺少的日期，產生缺漏報告')
+    parser.add_argument('--families', nargs='+', default=list(FAMILIES), choices=FAMILIES)
+    parser.add_argument('--start', help='開始日期 (YYYYMMDD)，只需讀取檔尾')
+    parser.add_argument('--end', help='結束日期 (YYYYMMDD)')
+    parser.add_argument('--source', default='auto', choices=('auto', 'index', 'scan'),
+                        help='使用日期索引或掃描檔案（預設有完整索引時使用索引）')
+    parser.add_argument('--workers', type=int, help='平行工作數，預設使用所有CPU核心')
+    args = parser.parse_args()
+
+    for family in args.families:
+        gaps = detect(family, args.start, args.end, args.source, args.workers)
+        path = write_report(family, gaps)
+        days = next((dates for code, dates in gaps if code == '*'), [])
+        pairs = sum(len(dates) for code, dates in gaps if code != '*')
+        print(f"{family}: {len(days)} 個整天缺漏、{pairs} 筆個股缺漏 -> {path}")
+        if days:
+            print(f"  整天缺漏請重新處理: python orchestrator.py {' '.join(days[:10])}{' ...' if len(days) > 10 else ''}")
+        if pairs and family == 'txt':
+            print(f"  個股缺漏可補抓: python repair.py --gaps {path}")
+
+
+if __name__ == "__main__":
+    main()
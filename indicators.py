@@ -0,0 +1,365 @@
+import os
+import csv
+import argparse
+import threading
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import stock_common
+import records
+import date_index
+import filelock
+import archive
+
+# 技術指標（輸出根目錄下 indicators/）：
+#   state.npz        各代號的狀態（最近60天收盤、最近9天高低、KD、RSI平均漲跌、EMA），每寫入一天只推進一步
+#   {YYYYMMDD}.csv   當天各代號的指標，選股直接讀這個檔，不必讀歷史（同一代號出現多次時以最後一行為準）
+STATE_FILE = 'state.npz'
+FIELDS = ['code', 'close', 'ma5', 'ma20', 'ma60', 'k', 'd', 'rsi', 'dif', 'macd', 'osc']
+
+# 參數（與看盤軟體常用的設定相同）
+MA_WINDOWS = (5, 20, 60)
+KD_WINDOW = 9
+RSI_PERIOD = 14
+MACD_FAST, MACD_SLOW, MACD_SIGNAL = 12, 26, 9
+
+WINDOW = max(MA_WINDOWS)
+
+# 重建時每個工作分配的檔案數
+REBUILD_CHUNK = 50
+
+# 狀態陣列與初始值（收盤/高低視窗為二維，其餘每個代號一個值）
+_ARRAYS = {
+    'date': (np.int64, 0), 'count': (np.int64, 0),
+    'closes': (np.float64, np.nan), 'highs': (np.float64, np.nan), 'lows': (np.float64, np.nan),
+    'k': (np.float64, 50.0), 'd': (np.float64, 50.0), 'prev': (np.float64, np.nan),
+    'gain': (np.float64, 0.0), 'loss': (np.float64, 0.0),
+    'fast': (np.float64, np.nan), 'slow': (np.float64, np.nan), 'signal': (np.float64, np.nan),
+}
+_WIDTHS = {'closes': WINDOW, 'highs': KD_WINDOW, 'lows': KD_WINDOW}
+
+_tables = {}
+_tables_lock = threading.Lock()
+
+
+def enabled():
+    """是否維護技術指標（環境變數 STOCK_INDICATORS=0 時關閉）"""
+    return os.environ.get('STOCK_INDICATORS', '1') != '0'
+
+
+def indicators_dir():
+    return stock_common.output_dir('indicators')
+
+
+def day_path(date_str):
+    return os.path.join(indicators_dir(), f"{date_str}.csv")
+
+
+def _format(value):
+    return '' if np.isnan(value) else f"{value:.2f}"
+
+
+class IndicatorState:
+    """所有代號的指標狀態，以 records.CODES 的編號為索引存在numpy陣列中，一次推進一整批代號
+
+    參數:
+        path: 狀態檔路徑，預設 D:/stock/indicators/state.npz
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(indicators_dir(), STATE_FILE)
+        self._stamp = None
+        self._clear()
+        self.sync()
+
+    def _clear(self):
+        for name, (dtype, initial) in _ARRAYS.items():
+            shape = (0, _WIDTHS[name]) if name in _WIDTHS else (0,)
+            setattr(self, name, np.full(shape, initial, dtype=dtype))
+
+    def _ensure(self, size):
+        """代號表變大時把陣列加長"""
+        extra = size - len(self.date)
+        if extra <= 0:
+            return
+        for name, (dtype, initial) in _ARRAYS.items():
+            shape = (extra, _WIDTHS[name]) if name in _WIDTHS else (extra,)
+            setattr(self, name, np.concatenate([getattr(self, name), np.full(shape, initial, dtype=dtype)]))
+
+    def reset(self, ids):
+        """把代號恢復成沒有任何資料的狀態"""
+        self._ensure(len(records.CODES))
+        for name, (_, initial) in _ARRAYS.items():
+            getattr(self, name)[ids] = initial
+
+    def sync(self):
+        """狀態檔被其他程序更新過時重新讀取（呼叫端持有狀態檔的檔案鎖）"""
+        try:
+            stamp = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if stamp == self._stamp:
+            return
+        with np.load(self.path, allow_pickle=False) as data:
+            ids = np.array([records.CODES.intern(str(code)) for code in data['codes']], dtype=np.int64)
+            self._clear()
+            self._ensure(len(records.CODES))
+            for name in _ARRAYS:
+                getattr(self, name)[ids] = data[name]
+        self._stamp = stamp
+
+    def save(self):
+        """寫回狀態檔（只存有資料的代號；先寫暫存檔再替換）"""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        ids = np.nonzero(self.count)[0]
+        codes = np.array([records.CODES.code(int(code_id)) for code_id in ids], dtype=str)
+        with open(self.path + '.tmp', 'wb') as f:
+            np.savez(f, codes=codes, **{name: getattr(self, name)[ids] for name in _ARRAYS})
+        os.replace(self.path + '.tmp', self.path)
+        self._stamp = os.stat(self.path).st_mtime_ns
+
+    def advance(self, ids, date_int, close, high, low):
+        """所有 ids 推進一天（ids 不可重複，日期要比各代號已有的日期晚）"""
+        self._ensure(len(records.CODES))
+        count = self.count[ids] + 1
+        first = count == 1
+
+        for name, value in (('closes', close), ('highs', high), ('lows', low)):
+            window = getattr(self, name)
+            window[ids, :-1] = window[ids, 1:]
+            window[ids, -1] = value
+
+        # KD：RSV = (收盤 - 9日最低) / (9日最高 - 9日最低)，K、D 各以 1/3 權重平滑
+        high9 = np.nanmax(self.highs[ids], axis=1)
+        low9 = np.nanmin(self.lows[ids], axis=1)
+        spread = high9 - low9
+        rsv = np.where(spread > 0, (close - low9) / np.where(spread > 0, spread, 1) * 100, 50.0)
+        self.k[ids] = self.k[ids] * 2 / 3 + rsv / 3
+        self.d[ids] = self.d[ids] * 2 / 3 + self.k[ids] / 3
+
+        # RSI (Wilder)：前 14 個漲跌取簡單平均，之後以 1/14 權重平滑
+        change = np.where(first, 0.0, close - self.prev[ids])
+        weight = np.maximum(count - 1, 1).clip(max=RSI_PERIOD)
+        self.gain[ids] = np.where(first, 0.0, self.gain[ids] + (np.maximum(change, 0) - self.gain[ids]) / weight)
+        self.loss[ids] = np.where(first, 0.0, self.loss[ids] + (np.maximum(-change, 0) - self.loss[ids]) / weight)
+        self.prev[ids] = close
+
+        # MACD：EMA 以第一天收盤為起點
+        self.fast[ids] = np.where(first, close, self.fast[ids] + (close - self.fast[ids]) * 2 / (MACD_FAST + 1))
+        self.slow[ids] = np.where(first, close, self.slow[ids] + (close - self.slow[ids]) * 2 / (MACD_SLOW + 1))
+        dif = self.fast[ids] - self.slow[ids]
+        self.signal[ids] = np.where(first, dif, self.signal[ids] + (dif - self.signal[ids]) * 2 / (MACD_SIGNAL + 1))
+
+        self.count[ids] = count
+        self.date[ids] = date_int
+
+    def rows(self, ids):
+        """目前的指標（資料天數不足的指標為空字串）"""
+        count = self.count[ids]
+        values = [self.closes[ids, -1]]
+        for window in MA_WINDOWS:
+            values.append(np.where(count >= window, self.closes[ids, -window:].mean(axis=1), np.nan))
+        ready = count >= KD_WINDOW
+        values += [np.where(ready, self.k[ids], np.nan), np.where(ready, self.d[ids], np.nan)]
+        total = self.gain[ids] + self.loss[ids]
+        rsi = np.where(total > 0, self.gain[ids] / np.where(total > 0, total, 1) * 100, 50.0)
+        values.append(np.where(count > RSI_PERIOD, rsi, np.nan))
+        ready = count >= MACD_SLOW
+        dif = self.fast[ids] - self.slow[ids]
+        values += [np.where(ready, dif, np.nan), np.where(ready, self.signal[ids], np.nan),
+                   np.where(ready, dif - self.signal[ids], np.nan)]
+        return [[records.CODES.code(int(code_id))] + [_format(column[i]) for column in values]
+                for i, code_id in enumerate(ids.tolist())]
+
+    def replay(self, code_id, path, since):
+        """從整個日資料（含封存的年度）重算一個代號（更正或較早日期寫入時），回傳 {日期: [指標行]}（since 以後的日期）"""
+        rows = date_index.latest_rows(archive.history_lines(path))
+        ids = np.array([code_id], dtype=np.int64)
+        self.reset(ids)
+        produced = {}
+        for date_str, fields in rows:
+            close, high, low = (np.array([float(fields[i])]) for i in (4, 2, 3))
+            self.advance(ids, int(date_str), close, high, low)
+            if int(date_str) >= since:
+                produced[int(date_str)] = self.rows(ids)
+        return produced
+
+    def apply(self, batch):
+        """併入剛寫入的日資料
+
+        參數:
+            batch: {日資料檔路徑: [(西元日期, 欄位), ...]}（依日期排序）
+
+        回傳:
+            {日期(int): [指標行...]}
+        """
+        self._ensure(len(records.CODES))
+        by_date = {}
+        replay = []
+        for path, rows in batch.items():
+            code_id = records.CODES.intern(os.path.splitext(os.path.basename(path))[0])
+            self._ensure(len(records.CODES))
+            if self.count[code_id] and int(rows[0][0]) <= self.date[code_id]:
+                # 更正或較早的日期：這個代號從頭重算
+                replay.append((code_id, path, int(rows[0][0])))
+                continue
+            for date_str, fields in rows:
+                by_date.setdefault(int(date_str), []).append((code_id, float(fields[4]), float(fields[2]),
+                                                              float(fields[3])))
+        produced = {}
+        for date_int in sorted(by_date):
+            ids, close, high, low = (np.array(column) for column in zip(*by_date[date_int]))
+            self.advance(ids.astype(np.int64), date_int, close, high, low)
+            produced.setdefault(date_int, []).extend(self.rows(ids.astype(np.int64)))
+        for code_id, path, since in replay:
+            for date_int, rows in self.replay(code_id, path, since).items():
+                produced.setdefault(date_int, []).extend(rows)
+        return produced
+
+
+def state():
+    """取得目前輸出根目錄的指標狀態（第一次使用時載入）"""
+    path = os.path.join(indicators_dir(), STATE_FILE)
+    with _tables_lock:
+        table = _tables.get(path)
+        if table is None:
+            table = _tables[path] = IndicatorState(path)
+    return table
+
+
+def write_days(produced, overwrite=False):
+    """把指標行寫入各日期的檔案（附加；overwrite 時整個改寫）"""
+    os.makedirs(indicators_dir(), exist_ok=True)
+    for date_int in sorted(produced):
+        path = day_path(str(date_int))
+        with filelock.locked(path), open(path, 'w' if overwrite else 'a', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            if f.tell() == 0:
+                writer.writerow(FIELDS)
+            writer.writerows(produced[date_int])
+
+
+def add(written):
+    """BatchWriter寫入後推進 txt 個股檔案的指標狀態，並寫出當天的指標
+
+    參數:
+        written: [(檔案路徑, 附加資料的起始位移, [行...]), ...]
+    """
+    if not enabled():
+        return
+    batch = {}
+    for path, _, lines in written:
+        if os.path.basename(os.path.dirname(path)) != 'txt':
+            continue
+        rows = date_index.latest_rows(line for chunk in lines for line in chunk.splitlines())
+        if rows:
+            batch[path] = rows
+    if not batch:
+        return
+    table = state()
+    # 狀態檔鎖住整個 讀取→推進→寫回，多個程序依序推進；指標檔在放開後才寫（不同時持有兩個檔案鎖）
+    with filelock.locked(table.path):
+        table.sync()
+        produced = table.apply(batch)
+        table.save()
+    write_days(produced)
+
+
+def refresh(paths, since):
+    """日資料檔整個改寫（例如補缺漏插入舊日期）後，從頭重算這些代號，並重寫 since 以後各日的指標行"""
+    if not enabled() or not paths:
+        return
+    table = state()
+    produced = {}
+    with filelock.locked(table.path):
+        table.sync()
+        for path in paths:
+            code_id = records.CODES.intern(os.path.splitext(os.path.basename(path))[0])
+            for date_int, rows in table.replay(code_id, path, int(since)).items():
+                produced.setdefault(date_int, []).extend(rows)
+        table.save()
+    write_days(produced)
+
+
+def read_day(date_str):
+    """讀出某日的指標 {代號: {欄位: 值}}，沒有檔案時回傳空dict"""
+    path = day_path(date_str)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        return {entry['code']: entry for entry in csv.DictReader(f)}
+
+
+def _load_chunk(paths):
+    result = []
+    for path in paths:
+        rows = date_index.latest_rows(archive.history_lines(path))
+        result.append((os.path.splitext(os.path.basename(path))[0],
+                       [(int(date_str), float(fields[4]), float(fields[2]), float(fields[3])) for date_str, fields in rows]))
+    return result
+
+
+def rebuild(since=None, workers=None):
+    """從現有的 txt 日資料重建所有代號的指標狀態（依日期逐日推進，每一步同時處理當天所有代號）
+
+    參數:
+        since: 這天 (YYYYMMDD) 以後的指標檔也重新寫出，預設只寫最後一天
+        workers: 讀取日資料的程序數
+
+    回傳:
+        代號數
+    """
+    names = archive.paths('txt')
+    chunks = [names[i:i + REBUILD_CHUNK] for i in range(0, len(names), REBUILD_CHUNK)]
+    by_date = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for results in executor.map(_load_chunk, chunks):
+            for code, rows in results:
+                code_id = records.CODES.intern(code)
+                for date_int, close, high, low in rows:
+                    by_date.setdefault(date_int, []).append((code_id, close, high, low))
+
+    table = state()
+    dates = sorted(by_date)
+    first_written = int(since) if since else (dates[-1] if dates else 0)
+    produced = {}
+    with filelock.locked(table.path):
+        table._clear()
+        for date_int in dates:
+            ids, close, high, low = (np.array(column) for column in zip(*by_date[date_int]))
+            ids = ids.astype(np.int64)
+            table.advance(ids, date_int, close, high, low)
+            if date_int >= first_written:
+                produced[date_int] = table.rows(ids)
+        table.save()
+    write_days(produced, overwrite=True)
+    print(f"已重建 {len(names)} 個代號的指標狀態（{len(dates)} 個交易日），寫出 {len(produced)} 天的指標檔")
+    return len(names)
+
+
+def main():
+    """主程式"""
+    parser = argparse.ArgumentParser(description='技術指標 (MA5/20/60、KD、RSI、MACD)：隨日資料寫入逐日推進')
+    sub = parser.add_subparsers(dest='command', required=True)
+    build = sub.add_parser('rebuild', help='從現有的日資料重建狀態（第一次使用或日資料被手動修改後）')
+    build.add_argument('--since', help='這天 (YYYYMMDD) 以後的指標檔也重新寫出，預設只寫最後一天')
+    build.add_argument('--workers', type=int, help='讀取日資料的程序數，預設使用所有CPU核心')
+    show = sub.add_parser('show', help='列出某日的指標')
+    show.add_argument('date', help='日期 (YYYYMMDD)')
+    show.add_argument('codes', nargs='*', help='只列出這些代號')
+    args = parser.parse_args()
+
+    if args.command == 'rebuild':
+        rebuild(args.since, args.workers)
+        return
+    day = read_day(args.date)
+    if not day:
+        print(f"沒有 {args.date} 的指標檔")
+        return
+    print(','.join(FIELDS))
+    for code in args.codes or sorted(day):
+        if code in day:
+            print(','.join(day[code][field] for field in FIELDS))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+import json
+
+# 證交所、櫃買中心JSON回應的格式：
+#   {"stat": "OK", "tables": [{"title": ..., "fields": [欄位名稱...], "data": [[欄位值...], ...]}, ...]}
+#   或只有一個表時 {"stat": "OK", "fields": [...], "data": [...]}
+# 欄位值與CSV中的文字相同（含千分位逗號），但沒有引號、="..."前綴與前言行，也不需要猜測編碼
+
+
+def load(content):
+    """解析JSON回應（UTF-8），查無資料（stat 不是 OK）或格式不符時回傳None"""
+    try:
+        doc = json.loads(content)
+    except ValueError:
+        return None
+    if not isinstance(doc, dict) or str(doc.get('stat', 'OK')).upper() != 'OK':
+        return None
+    return doc
+
+
+def tables(doc):
+    """回應中所有的 (欄位名稱, 資料列) 表"""
+    candidates = doc.get('tables') if isinstance(doc.get('tables'), list) else [doc]
+    return [(table['fields'], table.get('data') or []) for table in candidates
+            if isinstance(table, dict) and table.get('fields')]
+
+
+def find_table(doc, keywords):
+    """找出欄位名稱包含所有關鍵字的第一個表（同CSV的標題行判斷），找不到時回傳None"""
+    for fields, data in tables(doc):
+        if all(any(keyword in field for field in fields) for keyword in keywords):
+            return fields, data
+    return None
+
+
+def _text_row(row):
+    # 欄位值通常已是字串；數字型別轉成字串，與CSV的內容一致
+    return [value if isinstance(value, str) else ('' if value is None else str(value)) for value in row]
+
+
+def read_table(path, keywords):
+    """讀取JSON原始檔中符合關鍵字的表
+
+    參數:
+        path: 原始檔路徑 (.json)
+        keywords: 欄位名稱必須包含的關鍵字（stock_common.SOURCES 的 header）
+
+    回傳:
+        (欄位名稱列表, [資料列(欄位值列表)...])；查無資料或找不到表時回傳None
+    """
+    with open(path, 'rb') as f:
+        doc = load(f.read())
+    if doc is None:
+        return None
+    table = find_table(doc, keywords)
+    if table is None:
+        return None
+    fields, data = table
+    return _text_row(fields), [_text_row(row) for row in data]
+
+
+def count_rows(content, keywords):
+    """檢查下載內容：回傳 (是否找到表, 資料列數)"""
+    doc = load(content)
+    table = find_table(doc, keywords) if doc is not None else None
+    return (False, 0) if table is None else (True, len(table[1]))
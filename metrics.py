@@ -0,0 +1,138 @@
+import os
+import json
+import threading
+from datetime import datetime
+import stock_common
+import filelock
+
+# 指標輸出目錄，可用環境變數 STOCK_METRICS_DIR 覆寫（預設 D:/stock/metrics）
+METRICS_DIR = os.environ.get('STOCK_METRICS_DIR')
+
+# Prometheus textfile 檔名（給 node_exporter 的 textfile collector 讀取）
+PROM_FILE = 'stock_ingest.prom'
+
+
+class Metrics:
+    """收集各來源、各日期、各階段的耗時與數量
+
+    每筆記錄包含 source / date / stage / seconds，以及 bytes、rows、skipped 等數量；
+    emit() 時寫成JSON lines，並以最新一次的數值更新Prometheus textfile。
+    """
+
+    def __init__(self):
+        self._records = []
+        self._latest = {}
+        self._lock = threading.Lock()
+
+    def record(self, source, date_str, stage, seconds=None, **fields):
+        """記錄一個階段的結果
+
+        參數:
+            source: 資料來源代號 (stock_common.SOURCES)
+            date_str: 日期字串 (YYYYMMDD格式)
+            stage: 階段名稱，例如 http_ttfb / http_body / decode / header / rows / write
+            seconds: 耗時(秒)
+            fields: 其他數量，例如 bytes=12345, rows=1800, skipped={'not_stock': 3}
+        """
+        entry = {'ts': datetime.now().strftime('%Y-%m-%dT%H:%M:%S'), 'source': source or 'unknown',
+                 'date': date_str, 'stage': stage}
+        if seconds is not None:
+            entry['seconds'] = round(seconds, 6)
+        entry.update(fields)
+        with self._lock:
+            self._records.append(entry)
+            self._latest[(entry['source'], stage)] = entry
+
+    def records(self):
+        with self._lock:
+            return list(self._records)
+
+    def drain(self):
+        """取出並清空尚未寫出的記錄（子程序把記錄傳回主程序時使用）"""
+        with self._lock:
+            records, self._records = self._records, []
+        return records
+
+    def absorb(self, records):
+        """併入其他程序傳回的記錄"""
+        with self._lock:
+            for entry in records:
+                self._records.append(entry)
+                self._latest[(entry['source'], entry['stage'])] = entry
+
+    def emit(self, directory=None):
+        """把累積的記錄寫出（JSON lines附加、Prometheus檔覆寫），回傳寫出的筆數"""
+        with self._lock:
+            records, self._records = self._records, []
+            latest = dict(self._latest)
+        if not records:
+            return 0
+
+        directory = directory or METRICS_DIR or stock_common.output_dir('metrics')
+        os.makedirs(directory, exist_ok=True)
+
+        jsonl_path = os.path.join(directory, f"metrics-{datetime.now().strftime('%Y%m%d')}.jsonl")
+        with filelock.locked(jsonl_path), open(jsonl_path, 'a', encoding='utf-8') as f:
+            f.write(''.join(json.dumps(entry, ensure_ascii=False) + '\n' for entry in records))
+
+        prom_path = os.path.join(directory, PROM_FILE)
+        with filelock.locked(prom_path):
+            with open(prom_path + '.tmp', 'w', encoding='utf-8') as f:
+                f.write(format_prometheus(latest.values()))
+            os.replace(prom_path + '.tmp', prom_path)
+        return len(records)
+
+
+def format_prometheus(entries):
+    """把每個 (來源, 階段) 最新一筆記錄轉成Prometheus文字格式"""
+    gauges = {
+        'stock_stage_seconds': ('各階段耗時(秒)', 'seconds'),
+        'stock_stage_bytes': ('各階段處理的位元組數', 'bytes'),
+        'stock_stage_rows': ('各階段處理的行數', 'rows'),
+    }
+    lines = []
+    entries = sorted(entries, key=lambda e: (e['source'], e['stage']))
+    for name, (help_text, field) in gauges.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        for entry in entries:
+            if isinstance(entry.get(field), (int, float)):
+                lines.append(f'{name}{{source="{entry["source"]}",stage="{entry["stage"]}"}} {entry[field]}')
+
+    lines.append("# HELP stock_skipped_rows 最近一次處理時略過的行數（依原因）")
+    lines.append("# TYPE stock_skipped_rows gauge")
+    for entry in entries:
+        for reason, count in sorted((entry.get('skipped') or {}).items()):
+            lines.append(f'stock_skipped_rows{{source="{entry["source"]}",stage="{entry["stage"]}",reason="{reason}"}} {count}')
+
+    lines.append("# HELP stock_last_date 最近一次處理的資料日期")
+    lines.append("# TYPE stock_last_date gauge")
+    last_dates = {}
+    for entry in entries:
+        if entry.get('date'):
+            last_dates[entry['source']] = max(last_dates.get(entry['source'], ''), entry['date'])
+    for source, date_str in sorted(last_dates.items()):
+        lines.append(f'stock_last_date{{source="{source}"}} {date_str}')
+    return '\n'.join(lines) + '\n'
+
+
+# 程序內共用的指標收集器
+METRICS = Metrics()
+
+
+def record(source, date_str, stage, seconds=None, **fields):
+    METRICS.record(source, date_str, stage, seconds, **fields)
+
+
+def emit(directory=None):
+    return METRICS.emit(directory)
+
+
+def collect(func, *args):
+    """在子程序執行func，連同子程序累積的記錄一起傳回：(結果, 記錄)；主程序以 absorb() 併入"""
+    result = func(*args)
+    return result, METRICS.drain()
+
+
+def absorb(records):
+    METRICS.absorb(records)
@@ -0,0 +1,339 @@
+import os
+import time
+import argparse
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import stock_common
+import metrics
+import security_master
+import raw_manifest
+import delta
+import filelock
+
+# 各資料集合併時的來源順序（與原本腳本的處理順序相同：上市、上櫃、大盤）
+JOIN_ORDER = {
+    'quotes': ['twse_quotes', 'tpex_quotes', 'index_5sec'],
+    'institutional': ['twse_institutional', 'tpex_institutional', 'market_institutional'],
+    'margin': ['twse_margin', 'tpex_margin'],
+}
+
+ALL_DATASETS = list(JOIN_ORDER) + ['world']
+
+
+class NotPublished(RuntimeError):
+    """過去的日期交易所只回應很小的內容：當天休市，不會再有資料（與網路錯誤不同，不必重試）"""
+
+
+class Node:
+    """DAG中的一個步驟
+
+    參數:
+        name: 節點名稱，例如 download:twse_quotes:20250707
+        func: 執行函數，呼叫方式為 func(*args, *相依節點的結果)
+        args: 固定參數
+        deps: 相依節點名稱
+        kind: 'io' 在執行緒池執行；'cpu' 在 --processes 時改用程序池
+        after: 只決定先後順序的節點名稱：這些節點結束（不論成功、失敗或略過）後才執行，結果不傳入
+        optional: 可以缺少的相依節點名稱：結束後才執行，結果接在 deps 的結果之後傳入（失敗或略過時為None）
+    """
+
+    def __init__(self, name, func, args=(), deps=(), kind='io', after=(), optional=()):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.deps = list(deps)
+        self.kind = kind
+        self.after = list(after)
+        self.optional = list(optional)
+        self.status = 'pending'
+        self.result = None
+        self.error = None
+        self.start = None
+        self.end = None
+
+    @property
+    def duration(self):
+        if self.start is None or self.end is None:
+            return 0.0
+        return self.end - self.start
+
+
+def _timed_call(func, args):
+    """在工作執行緒/程序中執行節點並量測實際執行時間（不含排隊等待）"""
+    start = time.perf_counter()
+    result = func(*args)
+    return result, start, time.perf_counter()
+
+
+def run_dag(nodes, io_workers=8, cpu_workers=None, use_processes=False):
+    """執行DAG：相依節點完成後立即送出，失敗節點的下游全部略過（after、optional 只等待結束，不跟著略過）
+
+    參數:
+        nodes: Node列表
+        io_workers: 執行緒池大小（下載、寫入）
+        cpu_workers: 程序池大小，None為CPU核心數
+        use_processes: 解析節點是否改用程序池
+    """
+    by_name = {node.name: node for node in nodes}
+    io_pool = ThreadPoolExecutor(max_workers=io_workers)
+    if use_processes:
+        # 程序池（multiprocessing）到需要時才載入
+        from concurrent.futures import ProcessPoolExecutor
+        cpu_pool = ProcessPoolExecutor(max_workers=cpu_workers)
+    else:
+        cpu_pool = io_pool
+    running = {}
+
+    try:
+        while True:
+            for node in nodes:
+                if node.status != 'pending':
+                    continue
+                deps = [by_name[name] for name in node.deps]
+                if any(dep.status in ('failed', 'skipped') for dep in deps):
+                    node.status = 'skipped'
+                    continue
+                optional = [by_name[name] for name in node.optional]
+                if all(dep.status == 'done' for dep in deps) and \
+                        all(by_name[name].status in ('done', 'failed', 'skipped') for name in node.after + node.optional):
+                    pool = cpu_pool if node.kind == 'cpu' else io_pool
+                    args = tuple(node.args) + tuple(dep.result for dep in deps) + \
+                        tuple(dep.result if dep.status == 'done' else None for dep in optional)
+                    node.status = 'running'
+                    if pool is io_pool:
+                        future = pool.submit(_timed_call, node.func, args)
+                    else:
+                        # 子程序內記錄的階段指標隨結果一起傳回
+                        future = pool.submit(metrics.collect, _timed_call, node.func, args)
+                    running[future] = node
+
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                node = running.pop(future)
+                try:
+                    if node.kind == 'cpu' and use_processes:
+                        (node.result, node.start, node.end), records = future.result()
+                        metrics.absorb(records)
+                    else:
+                        node.result, node.start, node.end = future.result()
+                    node.status = 'done'
+                except Exception as e:
+                    node.status = 'failed'
+                    node.error = str(e)
+                    print(f"節點 {node.name} 失敗: {str(e)}")
+    finally:
+        io_pool.shutdown(wait=True)
+        if use_processes:
+            cpu_pool.shutdown(wait=True)
+    return nodes
+
+
+def critical_path(nodes):
+    """找出決定總耗時的關鍵路徑：從最晚結束的節點往回，每次選最晚結束的相依節點"""
+    by_name = {node.name: node for node in nodes}
+    finished = [node for node in nodes if node.status == 'done']
+    if not finished:
+        return []
+    node = max(finished, key=lambda n: n.end)
+    path = [node]
+    while node.deps or node.after or node.optional:
+        deps = [by_name[name] for name in node.deps + node.after + node.optional if by_name[name].status == 'done']
+        if not deps:
+            break
+        node = max(deps, key=lambda n: n.end)
+        path.append(node)
+    return list(reversed(path))
+
+
+# ---------------------------------------------------------------- 節點函數
+
+def download_source(key, date_str, refresh=False):
+    """下載單一來源的原始檔；已有正常原始檔且不是當天資料時直接使用（原始檔快取）"""
+    save_path = stock_common.source_path(key, date_str)
+    today = datetime.now().strftime('%Y%m%d')
+    cached = stock_common.find_raw(key, date_str)
+    if not refresh and date_str != today and stock_common.raw_file_ok(cached):
+        return cached
+
+    source = stock_common.SOURCES[key]
+    module = stock_common.load_script(source['dataset'])
+    os.makedirs(os.path.dirname(save_path), exist_ok=True)
+    before = os.stat(save_path).st_mtime_ns if os.path.exists(save_path) else None
+    ok = module.download_file(stock_common.source_url(key, date_str), save_path,
+                              source['label'], stock_common.get_session())
+    if not ok:
+        # 這次有收到回應（檔案剛寫入）但內容太小，且不是今天：休市日
+        if date_str < today and os.path.exists(save_path) and os.stat(save_path).st_mtime_ns != before:
+            raise NotPublished(f"{source['label']} {date_str} 沒有發布資料（休市日）")
+        raise RuntimeError(f"{source['label']}資料下載失敗或尚未發布")
+    return save_path
+
+
+def parse_source(key, date_str, raw_path):
+    """解析單一來源的原始檔，回傳尚未寫入的批次寫入器（可在子程序執行）
+
+    內容與已寫入的版本相同時（見 raw_manifest）不解碼、不解析，回傳空的寫入器
+    """
+    writer = stock_common.BatchWriter()
+    _, _, digest, unchanged = raw_manifest.check(raw_path)
+    if unchanged:
+        stock_common.log(f"{key} {date_str} 內容與已處理的版本相同，略過處理")
+        metrics.record(key, date_str, 'dedupe', unchanged=1)
+        return writer
+    source = stock_common.SOURCES[key]
+    module = stock_common.load_script(source['dataset'])
+    func_name, kwargs = source['process']
+    getattr(module, func_name)(raw_path, date_str, writer=writer, **kwargs)
+    writer.sources.append((key, date_str, digest))
+    return writer
+
+
+def join_writers(*writers):
+    """依固定來源順序合併同一資料集的解析結果"""
+    joined = stock_common.BatchWriter()
+    for writer in writers:
+        joined.merge(writer)
+    return joined
+
+
+def join_sources(dataset, date_str, *writers):
+    """合併同一資料集、同一日期各來源的解析結果（依 JOIN_ORDER 的順序傳入，失敗或未發布的來源為None）
+
+    與原本的腳本相同，各來源各自寫入：缺少的來源列出後略過，其他來源照常寫入；全部缺少時失敗
+    """
+    keys = JOIN_ORDER[dataset]
+    missing = [key for key, writer in zip(keys, writers) if writer is None]
+    if len(missing) == len(keys):
+        raise RuntimeError(f"{dataset} {date_str} 所有來源都沒有資料")
+    if missing:
+        print(f"{dataset} {date_str} 缺少來源 {', '.join(missing)}，其他來源照常寫入")
+        metrics.record(dataset, date_str, 'join', missing=missing)
+    return join_writers(*[writer for writer in writers if writer is not None])
+
+
+def write_batch(dataset, date_str, writer):
+    """把合併後的結果寫入個股檔案並記錄寫入階段的指標"""
+    # 單一寫入者模式 (STOCK_LOCKING=single) 時，檢查、寫入、索引、異動檔與主檔更新都在同一個寫入鎖內完成
+    with filelock.writer():
+        # 只有個股行情需要檢查（validation 會載入numpy，其他資料集不必載入）
+        if dataset == 'quotes':
+            import validation
+            validation.validate_writer(dataset, date_str, writer)
+        rows = writer.rows()
+        started = time.perf_counter()
+        files = writer.flush()
+        metrics.record(dataset, date_str, 'write', time.perf_counter() - started,
+                       files=files, rows=rows, bytes=writer.flushed_bytes)
+        delta.record(dataset, date_str, writer.last_flush)
+        writer.last_flush = {}
+        # 全部來源都因內容未變而略過時，主檔也不必重新讀取
+        if dataset == 'quotes' and writer.sources:
+            security_master.update(date_str)
+        raw_manifest.commit(writer)
+    return files
+
+
+def download_world():
+    """下載國際指數（只能取得當天資料）"""
+    module = stock_common.load_script('world')
+    result = module.get_financial_data()
+    if result['errors']:
+        raise RuntimeError(f"國際指數有 {len(result['errors'])} 個錯誤")
+    return os.path.join(datetime.now().strftime('%Y%m%d'), 'worldindex.csv')
+
+
+def parse_world(csv_path):
+    """把國際指數CSV拆成各指標的寫入內容"""
+    module = stock_common.load_script('world')
+    writer = stock_common.BatchWriter()
+    module.process_csv_file(csv_path, stock_common.output_dir('txt'), writer=writer)
+    return writer
+
+
+def build_nodes(dates, datasets, refresh=False):
+    """建立多個日期、多個資料集的 下載 → 解析 → 合併 → 寫入 DAG
+
+    不同日期的下載與解析可以同時進行，但同一資料集的寫入依日期先後串接，
+    讓每支股票的檔案仍然按日期附加（異常檢查的前一日收盤價表也依賴這個順序）。
+    前一天的寫入只決定順序：休市日或下載失敗的日期不會讓之後的日期被略過。
+    某個來源失敗或尚未發布時，合併只略過該來源，其他來源照常寫入。
+    """
+    nodes = []
+    last_write = {}
+    for date_str in dates:
+        for dataset in datasets:
+            if dataset == 'world':
+                if date_str != datetime.now().strftime('%Y%m%d'):
+                    continue
+                nodes.append(Node('download:world', download_world))
+                nodes.append(Node('parse:world', parse_world, deps=['download:world']))
+                nodes.append(Node('write:world', write_batch, ('world', date_str), deps=['parse:world']))
+                continue
+
+            parse_names = []
+            for key in JOIN_ORDER[dataset]:
+                download_name = f'download:{key}:{date_str}'
+                parse_name = f'parse:{key}:{date_str}'
+                nodes.append(Node(download_name, download_source, (key, date_str, refresh)))
+                nodes.append(Node(parse_name, parse_source, (key, date_str), [download_name], kind='cpu'))
+                parse_names.append(parse_name)
+
+            join_name = f'join:{dataset}:{date_str}'
+            write_name = f'write:{dataset}:{date_str}'
+            nodes.append(Node(join_name, join_sources, (dataset, date_str), optional=parse_names))
+            nodes.append(Node(write_name, write_batch, (dataset, date_str), deps=[join_name],
+                              after=[last_write[dataset]] if dataset in last_write else []))
+            last_write[dataset] = write_name
+    return nodes
+
+
+def report(nodes, elapsed):
+    """列出各節點狀態與本次執行的關鍵路徑"""
+    counts = {}
+    for node in nodes:
+        counts[node.status] = counts.get(node.status, 0) + 1
+    print("=" * 50)
+    print(f"總耗時 {elapsed:.2f} 秒，節點狀態: " + ", ".join(f"{k} {v}" for k, v in sorted(counts.items())))
+    for node in nodes:
+        if node.status in ('failed', 'skipped'):
+            print(f"  {node.status:8s} {node.name} {node.error or ''}")
+
+    path = critical_path(nodes)
+    if path:
+        print(f"關鍵路徑 ({sum(node.duration for node in path):.2f} 秒):")
+        for node in path:
+            print(f"  {node.duration:8.3f}s  {node.name}")
+    print("=" * 50)
+
+
+def main():
+    """主程式"""
+    import profiling
+    parser = argparse.ArgumentParser(description='單一程序執行所有資料集的 下載→解析→合併→寫入 DAG')
+    parser.add_argument('dates', nargs='*', default=[datetime.now().strftime('%Y%m%d')], help='日期 (YYYYMMDD)，預設今天')
+    parser.add_argument('--datasets', nargs='+', default=ALL_DATASETS, choices=ALL_DATASETS, help='要執行的資料集')
+    parser.add_argument('--workers', type=int, default=8, help='下載/寫入執行緒數')
+    parser.add_argument('--processes', action='store_true', help='解析改用程序池（使用所有CPU核心）')
+    parser.add_argument('--refresh', action='store_true', help='忽略已下載的原始檔，全部重新下載')
+    parser.add_argument('--verbose', action='store_true', help='輸出各腳本逐步的處理訊息')
+    parser.add_argument('--profile', nargs='+', choices=profiling.MODES, help='以指定方式剖析各階段，報告寫到 D:/stock/profile')
+    args = parser.parse_args()
+
+    import urllib3
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    stock_common.set_verbose(args.verbose)
+    if args.profile:
+        profiling.enable(args.profile)
+
+    nodes = build_nodes(args.dates, args.datasets, args.refresh)
+    started = time.perf_counter()
+    run_dag(nodes, io_workers=args.workers, use_processes=args.processes)
+    report(nodes, time.perf_counter() - started)
+    metrics.emit()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+import time
+import queue
+import argparse
+import threading
+from datetime import datetime, timedelta
+import stock_common
+import orchestrator
+import metrics
+import backfill
+
+# 佇列上限：下載太快時會卡在put，等解析/寫入跟上（背壓）
+PARSE_QUEUE_SIZE = 16
+WRITE_QUEUE_SIZE = 16
+
+# 寫入端最多暫存幾個日期的解析結果（較早的日期還沒到齊時）：下載超前這個範圍時先等待，記憶體不會無限增加
+WRITE_AHEAD = 8
+
+_STOP = object()
+
+
+def weekdays(start, end):
+    """列出區間內的平日 (YYYYMMDD)"""
+    day = datetime.strptime(start, '%Y%m%d')
+    last = datetime.strptime(end, '%Y%m%d')
+    dates = []
+    while day <= last:
+        if day.weekday() < 5:
+            dates.append(day.strftime('%Y%m%d'))
+        day += timedelta(days=1)
+    return dates
+
+
+class Pipeline:
+    """下載 → 解析 → 寫入 三段式管線
+
+    每個原始檔下載完立刻交給解析工作者，解析結果再交給唯一的寫入執行緒；
+    各段之間以有界佇列連接，網路等待與CPU解析可以同時進行。
+    寫入端會依資料集、日期排序後才寫入，個股檔案仍然按日期附加。
+    指定回補清單 (backfill.Manifest) 時，只處理 units 中的 (資料集, 日期)，並在清單中記錄每個單位的進度。
+    """
+
+    def __init__(self, dates, datasets, download_workers=4, parse_workers=2, use_processes=False, refresh=False,
+                 units=None, manifest=None):
+        self.dates = sorted(dates)
+        self.datasets = datasets
+        self.download_workers = download_workers
+        self.parse_workers = parse_workers
+        self.use_processes = use_processes
+        self.refresh = refresh
+        self.manifest = manifest
+        units = units or [(dataset, date_str) for date_str in self.dates for dataset in datasets]
+        self.dataset_dates = {dataset: sorted(date_str for unit_dataset, date_str in units if unit_dataset == dataset)
+                              for dataset in datasets}
+        self._progress = {}  # (dataset, date) -> {'downloaded': 來源數, 'parsed': 來源數, 'empty': 休市的來源數, 'failed': bool}
+
+        self.units = queue.Queue()
+        self.parse_queue = queue.Queue(maxsize=PARSE_QUEUE_SIZE)
+        self.write_queue = queue.Queue(maxsize=WRITE_QUEUE_SIZE)
+        self.stats = {'downloaded': 0, 'download_failed': 0, 'not_published': 0, 'parsed': 0, 'parse_failed': 0,
+                      'committed': 0, 'write_failed': 0}
+        self._stats_lock = threading.Lock()
+        # 各資料集已寫入（或寫入失敗）的日期數；下載端只處理 已寫入 + WRITE_AHEAD 以內的日期
+        self._positions = {dataset: {date_str: i for i, date_str in enumerate(dates)}
+                           for dataset, dates in self.dataset_dates.items()}
+        self._written = {dataset: 0 for dataset in datasets}
+        self._window = threading.Condition()
+
+    def _count(self, name):
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def _advance(self, key, date_str, stage, ok=True, empty=False):
+        """某來源完成（或失敗）一個階段；同一單位的所有來源都完成時更新回補清單
+
+        empty: 休市日沒有發布資料，視為沒有內容的完成
+        """
+        if self.manifest is None:
+            return
+        dataset = stock_common.SOURCES[key]['dataset']
+        with self._stats_lock:
+            progress = self._progress.setdefault((dataset, date_str),
+                                                 {'downloaded': 0, 'parsed': 0, 'empty': 0, 'failed': False})
+            if not ok:
+                progress['failed'] = True
+                return
+            progress[stage] += 1
+            if empty and stage == 'downloaded':
+                progress['empty'] += 1
+            done = progress[stage] == len(orchestrator.JOIN_ORDER[dataset]) and not progress['failed']
+        if done:
+            self.manifest.mark(dataset, date_str, stage)
+
+    def _commit(self, dataset, date_str, error=None):
+        """單位寫入完成：有來源失敗或寫入失敗時不算完成，釋放後由之後的執行重新處理（已寫入的原始檔由 raw_manifest 略過）"""
+        with self._window:
+            self._written[dataset] += 1
+            self._window.notify_all()
+        if self.manifest is None:
+            return
+        with self._stats_lock:
+            progress = self._progress.pop((dataset, date_str), {})
+        if error or progress.get('failed'):
+            self.manifest.fail(dataset, date_str, error or '有來源下載或解析失敗')
+        else:
+            # 所有來源都沒有發布（休市日）也算完成，之後的執行不再下載
+            empty = progress.get('empty') == len(orchestrator.JOIN_ORDER[dataset])
+            self.manifest.mark(dataset, date_str, 'committed', note='沒有發布資料（休市日）' if empty else None)
+
+    def _download_worker(self):
+        """下載階段：每下載完一個原始檔就放進解析佇列"""
+        while True:
+            try:
+                date_str, key = self.units.get_nowait()
+            except queue.Empty:
+                return
+            # 單位依日期順序取出，較早的日期一定已在處理中，等待不會卡死
+            dataset = stock_common.SOURCES[key]['dataset']
+            with self._window:
+                self._window.wait_for(lambda: self._positions[dataset][date_str] < self._written[dataset] + WRITE_AHEAD)
+            try:
+                raw_path = orchestrator.download_source(key, date_str, self.refresh)
+                self._count('downloaded')
+                self._advance(key, date_str, 'downloaded')
+            except orchestrator.NotPublished as e:
+                stock_common.log(str(e))
+                raw_path = None
+                self._count('not_published')
+                self._advance(key, date_str, 'downloaded', empty=True)
+                self._advance(key, date_str, 'parsed')
+            except Exception as e:
+                print(f"下載 {key} {date_str} 失敗: {str(e)}")
+                raw_path = None
+                self._count('download_failed')
+                self._advance(key, date_str, 'downloaded', ok=False)
+            self.parse_queue.put((date_str, key, raw_path))
+
+    def _parse_worker(self, executor):
+        """解析階段：取出原始檔解析成批次寫入器，交給寫入階段"""
+        while True:
+            item = self.parse_queue.get()
+            if item is _STOP:
+                return
+            date_str, key, raw_path = item
+            writer = None
+            if raw_path is not None:
+                try:
+                    if executor is not None:
+                        writer, records = executor.submit(metrics.collect, orchestrator.parse_source,
+                                                          key, date_str, raw_path).result()
+                        metrics.absorb(records)
+                    else:
+                        writer = orchestrator.parse_source(key, date_str, raw_path)
+                    self._count('parsed')
+                    self._advance(key, date_str, 'parsed')
+                except Exception as e:
+                    print(f"解析 {key} {date_str} 失敗: {str(e)}")
+                    self._count('parse_failed')
+                    self._advance(key, date_str, 'parsed', ok=False)
+            self.write_queue.put((date_str, key, writer))
+
+    def _write_worker(self):
+        """寫入階段：湊齊同一資料集、同一日期的所有來源後，依日期順序寫入"""
+        pending = {}  # (dataset, date) -> {key: writer}
+        next_index = {dataset: 0 for dataset in self.datasets}
+        dates = self.dataset_dates
+        while True:
+            item = self.write_queue.get()
+            if item is _STOP:
+                return
+            date_str, key, writer = item
+            dataset = stock_common.SOURCES[key]['dataset']
+            pending.setdefault((dataset, date_str), {})[key] = writer
+
+            # 依日期順序寫入所有已湊齊的單位（較早的日期沒到齊時，較晚的先留在記憶體）
+            keys = orchestrator.JOIN_ORDER[dataset]
+            while next_index[dataset] < len(dates[dataset]):
+                unit = (dataset, dates[dataset][next_index[dataset]])
+                parts = pending.get(unit, {})
+                if len(parts) < len(keys):
+                    break
+                del pending[unit]
+                # 一個單位寫入失敗時記錄並繼續：寫入執行緒結束的話，解析端會一直卡在已滿的佇列
+                try:
+                    joined = orchestrator.join_writers(*[parts[k] for k in keys if parts[k] is not None])
+                    orchestrator.write_batch(dataset, unit[1], joined)
+                except Exception as e:
+                    print(f"寫入 {dataset} {unit[1]} 失敗: {str(e)}")
+                    self._count('write_failed')
+                    self._commit(*unit, error=f"寫入失敗: {str(e)}")
+                else:
+                    self._count('committed')
+                    self._commit(*unit)
+                next_index[dataset] += 1
+
+    def run(self):
+        """執行管線，回傳統計數字"""
+        for date_str in self.dates:
+            for dataset in self.datasets:
+                if date_str in self.dataset_dates[dataset]:
+                    for key in orchestrator.JOIN_ORDER[dataset]:
+                        self.units.put((date_str, key))
+
+        executor = None
+        if self.use_processes:
+            from concurrent.futures import ProcessPoolExecutor
+            executor = ProcessPoolExecutor()
+        try:
+            writer_thread = threading.Thread(target=self._write_worker, name='writer')
+            parsers = [threading.Thread(target=self._parse_worker, args=(executor,), name=f'parser-{i}')
+                       for i in range(self.parse_workers)]
+            downloaders = [threading.Thread(target=self._download_worker, name=f'downloader-{i}')
+                           for i in range(self.download_workers)]
+            for thread in [writer_thread] + parsers + downloaders:
+                thread.start()
+
+            # 依序關閉各階段：下載結束 → 解析結束 → 寫入結束
+            for thread in downloaders:
+                thread.join()
+            for _ in parsers:
+                self.parse_queue.put(_STOP)
+            for thread in parsers:
+                thread.join()
+            self.write_queue.put(_STOP)
+            writer_thread.join()
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        return self.stats
+
+
+def run_manifest(dates, args):
+    """以回補清單執行：每次認領一批未完成的單位交給管線，直到沒有可認領的單位"""
+    manifest = backfill.Manifest()
+    owner = backfill.owner_id()
+    added = manifest.add(args.datasets, dates)
+    counts = manifest.counts()
+    committed = sum(counts.get((dataset, 'committed'), 0) for dataset in args.datasets)
+    print(f"回補清單: {manifest.path}（新增 {added} 個單位，全部已完成 {committed} 個）")
+    stats = {}
+    manifest.start_heartbeat(owner)
+    try:
+        while True:
+            units = manifest.claim(owner, args.datasets, args.claim, dates[0], dates[-1])
+            if not units:
+                break
+            pipeline = Pipeline(sorted({date_str for _, date_str in units}), args.datasets, args.download_workers,
+                                args.parse_workers, args.processes, args.refresh, units=units, manifest=manifest)
+            for name, value in pipeline.run().items():
+                stats[name] = stats.get(name, 0) + value
+            metrics.emit()
+    finally:
+        manifest.release(owner)
+        manifest.close()
+    return stats
+
+
+def main():
+    """主程式"""
+    import profiling
+    parser = argparse.ArgumentParser(description='下載與解析重疊執行的回補管線')
+    parser.add_argument('start', help='開始日期 (YYYYMMDD)')
+    parser.add_argument('end', nargs='?', help='結束日期 (YYYYMMDD)，預設同開始日期')
+    parser.add_argument('--datasets', nargs='+', default=list(orchestrator.JOIN_ORDER), choices=list(orchestrator.JOIN_ORDER))
+    parser.add_argument('--download-workers', type=int, default=4, help='同時下載數')
+    parser.add_argument('--parse-workers', type=int, default=2, help='同時解析數')
+    parser.add_argument('--processes', action='store_true', help='解析改在程序池執行（使用多核心）')
+    parser.add_argument('--refresh', action='store_true', help='忽略已下載的原始檔，全部重新下載')
+    parser.add_argument('--manifest', action='store_true',
+                        help='使用回補清單：中斷後重新執行會略過已完成的日期，可同時啟動多個程序分工')
+    parser.add_argument('--claim', type=int, default=backfill.CLAIM_BATCH, help='使用回補清單時每次認領的單位數')
+    parser.add_argument('--verbose', action='store_true', help='輸出各腳本逐步的處理訊息')
+    parser.add_argument('--profile', nargs='+', choices=profiling.MODES, help='以指定方式剖析各階段，報告寫到 D:/stock/profile')
+    args = parser.parse_args()
+
+    import urllib3
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    stock_common.set_verbose(args.verbose)
+    if args.profile:
+        profiling.enable(args.profile)
+
+    dates = weekdays(args.start, args.end or args.start)
+    print(f"回補 {len(dates)} 個交易日: {', '.join(args.datasets)}")
+    started = time.perf_counter()
+    if args.manifest:
+        stats = run_manifest(dates, args)
+    else:
+        pipeline = Pipeline(dates, args.datasets, args.download_workers, args.parse_workers, args.processes, args.refresh)
+        stats = pipeline.run()
+        metrics.emit()
+    print(f"完成，耗時 {time.perf_counter() - started:.1f} 秒: " + ", ".join(f"{k} {v}" for k, v in stats.items()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+import os
+import time
+import argparse
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import stock_common
+import json_decode
+import metrics
+import security_master
+
+# 輪詢間隔(秒)：有進展時回到最短間隔，沒有變化時逐步拉長
+FAST_INTERVAL = 10
+SLOW_INTERVAL = 300
+INTERVAL_GROWTH = 1.5
+
+# 最長輪詢時間(秒)，超過視為當日無資料（例如假日）
+MAX_WAIT = 6 * 60 * 60
+
+
+def check_content(key, content):
+    """檢查下載內容是否為已發布的完整資料
+
+    參數:
+        key: 資料來源代號 (stock_common.SOURCES)
+        content: 回應內容 (bytes)
+
+    回傳:
+        (是否就緒, 說明, 資料行數)
+    """
+    source = stock_common.SOURCES[key]
+    if len(content) < stock_common.MIN_RAW_SIZE:
+        return False, f"內容過小({len(content)} 字節)", 0
+
+    if stock_common.response_format(key) == 'json':
+        found, rows = json_decode.count_rows(content, source['header'])
+        if not found:
+            return False, "找不到資料表", 0
+    else:
+        text = stock_common.decode_bytes(content)
+        if text is None:
+            return False, "無法解碼內容", 0
+
+        lines = text.splitlines()
+        header_idx = -1
+        for i, line in enumerate(lines):
+            if all(keyword in line for keyword in source['header']):
+                header_idx = i
+                break
+        if header_idx == -1:
+            return False, "找不到標題行", 0
+
+        rows = sum(1 for line in lines[header_idx + 1:] if line.strip())
+    if rows < source['min_rows']:
+        return False, f"資料行數不足({rows}/{source['min_rows']})", rows
+    return True, f"共 {rows} 行資料", rows
+
+
+def probe(session, key, date_str, etag=None):
+    """探測一次資料來源
+
+    以共用連線發送請求；若伺服器支援ETag，內容未變時只會回傳304而不傳送本文
+
+    回傳:
+        (狀態碼, 內容, 新的ETag)
+    """
+    headers = dict(stock_common.HEADERS)
+    if etag:
+        headers['If-None-Match'] = etag
+    started = time.perf_counter()
+    response = session.get(stock_common.source_url(key, date_str), headers=headers, verify=False, timeout=20, stream=True)
+    ttfb = time.perf_counter() - started
+    content = response.content if response.status_code == 200 else b''
+    metrics.record(key, date_str, 'probe', time.perf_counter() - started, ttfb=round(ttfb, 6),
+                   status=response.status_code, bytes=len(content))
+    if response.status_code != 200:
+        return response.status_code, b'', etag
+    return response.status_code, content, response.headers.get('ETag')
+
+
+def save_raw(key, date_str, content):
+    """將就緒的內容寫入日期資料夾（先寫暫存檔再取代，處理中不會讀到半個檔案）"""
+    save_path = stock_common.source_path(key, date_str)
+    os.makedirs(os.path.dirname(save_path), exist_ok=True)
+    tmp_path = save_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(content)
+    os.replace(tmp_path, save_path)
+    return save_path
+
+
+def process_source(key, date_str, save_path):
+    """呼叫資料來源對應腳本的處理函數（解析並寫入個股檔案）"""
+    source = stock_common.SOURCES[key]
+    module = stock_common.load_script(source['dataset'])
+    func_name, kwargs = source['process']
+    getattr(module, func_name)(save_path, date_str, **kwargs)
+    if key in security_master.MASTER_SOURCES:
+        security_master.update(date_str, [key])
+
+
+def poll_source(session, key, date_str, max_wait=MAX_WAIT, stop_event=None):
+    """輪詢單一資料來源直到資料發布，發布後立即存檔並處理
+
+    參數:
+        session: 共用的 requests.Session
+        key: 資料來源代號
+        date_str: 日期字串 (YYYYMMDD格式)
+        max_wait: 最長輪詢秒數
+        stop_event: 外部要求停止時設定的 threading.Event
+
+    回傳:
+        資料已發布並處理完成時回傳True
+    """
+    label = stock_common.SOURCES[key]['label']
+    started = time.monotonic()
+    interval = FAST_INTERVAL
+    etag = None
+    last_size = -1
+    probes = 0
+
+    import requests
+    while True:
+        probes += 1
+        try:
+            status, content, etag = probe(session, key, date_str, etag)
+            if status == 200:
+                ready, reason, rows = check_content(key, content)
+            else:
+                ready, reason = False, f"狀態碼 {status}"
+        except requests.exceptions.RequestException as e:
+            # 連線錯誤時間隔加倍（不依內容大小調整），避免在網路中斷時頻繁重試
+            ready, reason, content = False, f"連線錯誤: {str(e)}", None
+            interval = min(interval * 2, SLOW_INTERVAL)
+
+        if ready:
+            waited = time.monotonic() - started
+            print(f"{label}資料已發布（第 {probes} 次探測，等待 {waited:.0f} 秒）: {reason}")
+            save_path = save_raw(key, date_str, content)
+            process_source(key, date_str, save_path)
+            print(f"{label}資料已處理完成，距偵測到發布 {time.monotonic() - started - waited:.1f} 秒")
+            return True
+
+        # 內容在變大表示正在發布，縮短間隔；否則逐步拉長
+        if content is not None:
+            if len(content) > last_size and last_size >= 0:
+                interval = FAST_INTERVAL
+            else:
+                interval = min(interval * INTERVAL_GROWTH, SLOW_INTERVAL)
+            last_size = len(content)
+
+        if time.monotonic() - started + interval > max_wait:
+            print(f"{label}資料在 {max_wait // 60} 分鐘內未發布，停止輪詢（{reason}）")
+            return False
+        print(f"{label}資料尚未就緒（{reason}），{interval:.0f} 秒後再探測")
+        if stop_event is not None:
+            if stop_event.wait(interval):
+                return False
+        else:
+            time.sleep(interval)
+
+
+def poll_dataset(dataset, date_str, max_wait=MAX_WAIT):
+    """同時輪詢資料集的所有來源，各來源就緒後各自立即處理
+
+    參數:
+        dataset: 資料集名稱 (quotes / institutional / margin)
+        date_str: 日期字串 (YYYYMMDD格式)
+        max_wait: 每個來源最長輪詢秒數
+
+    回傳:
+        所有來源都已發布並處理時回傳True
+    """
+    import urllib3
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    keys = stock_common.dataset_sources(dataset)
+    stop_event = threading.Event()
+    # 共用程序內的連線池：常駐工作程序 (worker.py) 重複輪詢時沿用已建立的TLS連線
+    session = stock_common.get_session()
+    with ThreadPoolExecutor(max_workers=len(keys)) as executor:
+        futures = [executor.submit(poll_source, session, key, date_str, max_wait, stop_event) for key in keys]
+        try:
+            return all([future.result() for future in futures])
+        except KeyboardInterrupt:
+            stop_event.set()
+            raise
+        finally:
+            metrics.emit()
+
+
+def main():
+    """主程式"""
+    parser = argparse.ArgumentParser(description='輪詢交易所資料，發布後立即下載並處理')
+    parser.add_argument('datasets', nargs='*', default=list(stock_common.DATASETS), help='要輪詢的資料集')
+    parser.add_argument('--date', default=datetime.now().strftime('%Y%m%d'), help='日期 (YYYYMMDD)')
+    parser.add_argument('--max-wait', type=int, default=MAX_WAIT, help='每個來源最長輪詢秒數')
+    args = parser.parse_args()
+
+    with ThreadPoolExecutor(max_workers=len(args.datasets)) as executor:
+        futures = {dataset: executor.submit(poll_dataset, dataset, args.date, args.max_wait) for dataset in args.datasets}
+        for dataset, future in futures.items():
+            print(f"{dataset}: {'完成' if future.result() else '未完成'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+import os
+import sys
+import json
+import time
+import pstats
+import argparse
+import cProfile
+import functools
+import threading
+import tracemalloc
+from datetime import datetime
+import stock_common
+
+# 可用的剖析方式
+MODES = ('cprofile', 'tracemalloc', 'sample')
+
+# 預設剖析的階段：各資料集的下載與處理函數、國際指數的下載與寫入
+DEFAULT_STAGES = sorted({f"{source['dataset']}.{source['process'][0]}" for source in stock_common.SOURCES.values()}
+                        | {f"{dataset}.download_file" for dataset in stock_common.DATASETS}
+                        | {'world.get_financial_data', 'world.process_csv_file'})
+
+# 取樣計時器的間隔(秒)
+SAMPLE_INTERVAL = 0.002
+
+# 報告中列出的筆數
+TOP_N = 25
+
+# cProfile同一時間只能有一個在執行（Python 3.12起為整個程序共用），其他執行緒遇到時略過
+_cprofile_lock = threading.Lock()
+_seq_lock = threading.Lock()
+_seq = 0
+
+
+def settings():
+    """從環境變數讀取剖析設定（子程序透過環境變數取得相同設定）
+
+    回傳:
+        (剖析方式列表, 階段列表, 報告目錄)；未啟用時剖析方式為空列表
+    """
+    modes = [m for m in os.environ.get('STOCK_PROFILE', '').split(',') if m]
+    stages = [s for s in os.environ.get('STOCK_PROFILE_STAGES', '').split(',') if s] or DEFAULT_STAGES
+    directory = os.environ.get('STOCK_PROFILE_DIR') or stock_common.output_dir('profile')
+    return modes, stages, directory
+
+
+def enable(modes, stages=None, directory=None):
+    """啟用剖析：設定環境變數，並包裝已載入的腳本（之後載入的腳本由 stock_common.load_script 包裝）
+
+    參數:
+        modes: 剖析方式 (cprofile / tracemalloc / sample)
+        stages: 要剖析的階段，格式為 資料集.函數名稱，例如 quotes.process_stock_data
+        directory: 報告目錄，預設 D:/stock/profile
+    """
+    unknown = set(modes) - set(MODES)
+    if unknown:
+        raise ValueError(f"不支援的剖析方式: {', '.join(sorted(unknown))}")
+    os.environ['STOCK_PROFILE'] = ','.join(modes)
+    if stages:
+        os.environ['STOCK_PROFILE_STAGES'] = ','.join(stages)
+    if directory:
+        os.environ['STOCK_PROFILE_DIR'] = directory
+    for dataset, module in stock_common.loaded_scripts().items():
+        wrap_module(dataset, module)
+
+
+def wrap_module(dataset, module):
+    """把模組中被指定剖析的函數換成剖析包裝（處理流程與輸出不變）"""
+    modes, stages, directory = settings()
+    if not modes:
+        return
+    for stage in stages:
+        name, _, func_name = stage.partition('.')
+        if name != dataset or not hasattr(module, func_name):
+            continue
+        func = getattr(module, func_name)
+        if getattr(func, '_profiled', False):
+            continue
+        setattr(module, func_name, _profiled(stage, func, modes, directory))
+
+
+def _call_label(args):
+    """從呼叫參數找出原始檔路徑，轉成 來源代號_日期 作為報告檔名"""
+    for arg in args:
+        if isinstance(arg, str):
+            key, date_str = stock_common.source_of(arg)
+            if key:
+                return f"{key}_{date_str}"
+    return 'call'
+
+
+def _next_seq():
+    global _seq
+    with _seq_lock:
+        _seq += 1
+        return _seq
+
+
+def _profiled(stage, func, modes, directory):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        label = _call_label(args)
+        base = os.path.join(directory, stage, f"{label}-{os.getpid()}-{_next_seq()}")
+        os.makedirs(os.path.dirname(base), exist_ok=True)
+
+        profiler = None
+        if 'cprofile' in modes and _cprofile_lock.acquire(blocking=False):
+            profiler = cProfile.Profile()
+        sampler = Sampler(threading.get_ident(), func.__name__) if 'sample' in modes else None
+        before = None
+        if 'tracemalloc' in modes:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            before = tracemalloc.take_snapshot()
+
+        started = time.perf_counter()
+        if sampler:
+            sampler.start()
+        try:
+            if profiler:
+                profiler.enable()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                if profiler:
+                    profiler.disable()
+        finally:
+            seconds = time.perf_counter() - started
+            entry = {'ts': datetime.now().strftime('%Y-%m-%dT%H:%M:%S'), 'stage': stage, 'label': label,
+                     'seconds': round(seconds, 6), 'pid': os.getpid()}
+            if sampler:
+                sampler.stop()
+                sampler.write(base + '.sample.txt', seconds)
+            if profiler:
+                _cprofile_lock.release()
+                write_cprofile(profiler, base)
+            if before is not None:
+                entry['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+                write_allocations(before, tracemalloc.take_snapshot(), base + '.mem.txt', entry['peak_bytes'])
+            with open(os.path.join(directory, 'calls.jsonl'), 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+    wrapper._profiled = True
+    return wrapper
+
+
+def write_cprofile(profiler, base):
+    """輸出cProfile結果：.prof 可用 pstats/snakeviz 開啟，.txt 列出累計耗時最多的函數"""
+    profiler.dump_stats(base + '.prof')
+    with open(base + '.cprofile.txt', 'w', encoding='utf-8') as f:
+        stats = pstats.Stats(profiler, stream=f)
+        stats.sort_stats('cumulative').print_stats(TOP_N)
+        stats.sort_stats('tottime').print_stats(TOP_N)
+
+
+def write_allocations(before, after, path, peak):
+    """輸出這次呼叫期間新增記憶體最多的程式行（多執行緒同時執行時會包含其他執行緒的配置）"""
+    stats = after.compare_to(before, 'lineno')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(f"峰值記憶體: {peak / 1024:.0f} KB\n")
+        f.write(f"新增配置最多的 {TOP_N} 行:\n")
+        for stat in stats[:TOP_N]:
+            frame = stat.traceback[0]
+            f.write(f"  {stat.size_diff / 1024:10.1f} KB  {stat.count_diff:8d} 次  {frame.filename}:{frame.lineno}\n")
+
+
+class Sampler:
+    """取樣計時器：另一個執行緒定時查看目標執行緒正在執行的程式行
+
+    除了統計最常出現的程式行，也讀取處理函數的區域變數 i / line，
+    找出花最多時間的CSV資料行（取樣次數越多代表該行處理越久）。
+    """
+
+    def __init__(self, thread_id, func_name, interval=SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.func_name = func_name
+        self.interval = interval
+        self.lines = {}
+        self.rows = {}
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.samples += 1
+            code = frame.f_code
+            key = (code.co_filename, frame.f_lineno, code.co_name)
+            self.lines[key] = self.lines.get(key, 0) + 1
+
+            # 往外找到處理函數本身的frame，記錄目前處理到第幾行資料
+            while frame is not None and frame.f_code.co_name != self.func_name:
+                frame = frame.f_back
+            if frame is not None:
+                local_vars = frame.f_locals
+                row = local_vars.get('i')
+                if isinstance(row, int):
+                    count, text = self.rows.get(row, (0, None))
+                    line = local_vars.get('line')
+                    self.rows[row] = (count + 1, text or (line[:120] if isinstance(line, str) else None))
+
+    def write(self, path, seconds):
+        per_sample = seconds / self.samples if self.samples else 0
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(f"取樣 {self.samples} 次，間隔 {self.interval * 1000:.0f} ms，總耗時 {seconds:.3f} 秒\n\n")
+            f.write(f"最常出現的 {TOP_N} 個程式行:\n")
+            for (filename, lineno, name), count in sorted(self.lines.items(), key=lambda x: -x[1])[:TOP_N]:
+                f.write(f"  {count:6d} ({count * per_sample * 1000:8.1f} ms)  {os.path.basename(filename)}:{lineno} {name}\n")
+            if self.rows:
+                f.write(f"\n最慢的 {TOP_N} 行資料 (資料行號: 取樣次數):\n")
+                for row, (count, text) in sorted(self.rows.items(), key=lambda x: -x[1][0])[:TOP_N]:
+                    f.write(f"  {row:6d}: {count:4d}  {text or ''}\n")
+
+
+def summarize(directory=None, top=TOP_N):
+    """彙整 calls.jsonl：各階段呼叫次數、總耗時，以及最慢的檔案"""
+    directory = directory or settings()[2]
+    path = os.path.join(directory, 'calls.jsonl')
+    if not os.path.exists(path):
+        print(f"找不到剖析記錄: {path}")
+        return
+    calls = [json.loads(line) for line in open(path, encoding='utf-8') if line.strip()]
+    stages = {}
+    for call in calls:
+        stages.setdefault(call['stage'], []).append(call)
+
+    print("=" * 70)
+    print(f"{'階段':40s} {'次數':>6s} {'總秒數':>10s} {'平均':>8s}")
+    for stage, items in sorted(stages.items(), key=lambda x: -sum(c['seconds'] for c in x[1])):
+        total = sum(c['seconds'] for c in items)
+        print(f"{stage:40s} {len(items):6d} {total:10.3f} {total / len(items):8.3f}")
+    print(f"\n最慢的 {top} 個檔案:")
+    for call in sorted(calls, key=lambda c: -c['seconds'])[:top]:
+        peak = f"  峰值 {call['peak_bytes'] // 1024} KB" if 'peak_bytes' in call else ''
+        print(f"  {call['seconds']:8.3f}s  {call['stage']:36s} {call['label']}{peak}")
+    print("=" * 70)
+
+
+def main():
+    """主程式"""
+    parser = argparse.ArgumentParser(description='以剖析模式執行腳本，或彙整剖析報告')
+    parser.add_argument('dataset', nargs='?', choices=list(stock_common.SCRIPTS), help='要執行的資料集（省略時只彙整報告）')
+    parser.add_argument('date', nargs='?', default=datetime.now().strftime('%Y%m%d'), help='日期 (YYYYMMDD)')
+    parser.add_argument('--mode', nargs='+', default=['cprofile'], choices=MODES, help='剖析方式')
+    parser.add_argument('--stages', nargs='+', help=f"要剖析的階段，預設: {', '.join(DEFAULT_STAGES)}")
+    parser.add_argument('--output', help='報告目錄，預設 D:/stock/profile')
+    args = parser.parse_args()
+
+    if args.dataset:
+        enable(args.mode, args.stages, args.output)
+        module = stock_common.load_script(args.dataset)
+        if args.dataset == 'world':
+            module.start_data_collection()
+        else:
+            module.run(args.date)
+    summarize(args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,311 @@
+import os
+import csv
+import json
+import time
+import argparse
+import threading
+import urllib.parse
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import stock_common
+import records
+import delta
+import date_index
+import bars
+import adjust
+import archive
+
+# 各資料集寫入的輸出目錄（國際指數與個股行情同樣在txt）
+DATASET_FAMILIES = {'quotes': 'txt', 'world': 'txt', 'institutional': 'law', 'margin': 'inv'}
+FAMILIES = ('txt', 'law', 'inv')
+
+# 大盤（加權指數、大盤法人、大盤融資）的代號
+MARKET_CODE = '1000'
+
+# 記憶體快取：最多保留的個股檔案數、最近日期的橫斷面快照數
+HOT_FILES = 4000
+RECENT_DAYS = 20
+
+# 檢查異動檔、清除快取的間隔(秒)
+WATCH_INTERVAL = 1
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+
+
+def date_key(text):
+    """把檔案中的日期（民國 YYYMMDD 或西元 YYYYMMDD）轉成可比較的西元整數 YYYYMMDD"""
+    try:
+        value = int(text)
+    except ValueError:
+        return 0
+    return value + 19110000 if value < 19110000 else value
+
+
+def read_rows(path):
+    """讀取個股檔案的全部記錄（欄位列表），檔案不存在時回傳空列表"""
+    try:
+        with open(path, 'r', encoding='utf-8', newline='') as f:
+            return [row for row in csv.reader(f) if row]
+    except FileNotFoundError:
+        return []
+
+
+def file_stamp(*paths):
+    """檔案（或目錄）的 (大小, 修改時間) 列表，快取用來判斷內容是否被改寫；不存在的路徑為None"""
+    stamps = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            stamps.append((stat.st_size, stat.st_mtime_ns))
+        except FileNotFoundError:
+            stamps.append(None)
+    return tuple(stamps)
+
+
+def _select(rows, start=None, end=None):
+    """篩選日期在 start~end（西元 YYYYMMDD，含）之間的記錄"""
+    if not start and not end:
+        return rows
+    low, high = date_key(start or '0'), date_key(end or '99999999')
+    return [row for row in rows if low <= date_key(row[0]) <= high]
+
+
+class _LRU:
+    """固定大小的LRU快取（執行緒安全）"""
+
+    def __init__(self, size):
+        self.size = size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def discard(self, predicate):
+        with self._lock:
+            for key in [key for key in self._items if predicate(key)]:
+                del self._items[key]
+
+    def __len__(self):
+        return len(self._items)
+
+
+class StockStore:
+    """個股資料查詢：歷史、某日橫斷面、大盤
+
+    個股檔案讀過一次後保留在記憶體（含已編碼的JSON），最近日期的橫斷面也保留；
+    寫入程序產生的異動檔 (delta.py) 有新的序號時，清除受影響的檔案與日期。
+    沒有留下異動的改寫（STOCK_DELTA=0 的重建、repair 併入、archive 封存）以檔案的大小與修改時間判斷。
+    """
+
+    def __init__(self, hot_files=HOT_FILES, recent_days=RECENT_DAYS):
+        self.files = _LRU(hot_files)
+        self.snapshots = _LRU(recent_days)
+        self.cursor = delta.last_seq()
+        self.offset = None  # 索引中讀到的位置，之後從這裡接續
+        self.adjuster = adjust.Adjuster()
+
+    def _file(self, family, code):
+        """(記錄列表, 完整歷史的JSON)"""
+        key = (family, code)
+        path = os.path.join(stock_common.output_dir(family), f"{code}.{family}")
+        # 封存會替換壓縮檔，封存目錄的修改時間跟著改變
+        stamp = file_stamp(path, archive.archive_dir(family))
+        cached = self.files.get(key)
+        if cached is None or cached[2] != stamp:
+            # 已封存的年度接在目前檔案之前（見 archive.py）
+            rows = [row for row in csv.reader(archive.history_lines(path)) if row]
+            body = json.dumps({'code': code, 'family': family, 'records': rows}, ensure_ascii=False).encode('utf-8')
+            cached = (rows, body, stamp)
+            self.files.put(key, cached)
+        return cached[:2]
+
+    def history(self, code, family='txt', start=None, end=None, adjusted=False):
+        """個股歷史，start/end 為西元 YYYYMMDD（含），adjusted 時為除權息還原價格（只有 txt），回傳JSON bytes"""
+        if adjusted and family == 'txt':
+            selected = self.adjuster.adjusted(code, start, end)
+            return json.dumps({'code': code, 'family': family, 'adjusted': True, 'records': selected},
+                              ensure_ascii=False).encode('utf-8')
+        rows, body = self._file(family, code)
+        if not start and not end:
+            return body
+        selected = _select(rows, start, end)
+        return json.dumps({'code': code, 'family': family, 'records': selected}, ensure_ascii=False).encode('utf-8')
+
+    def bar_history(self, code, period='week', start=None, end=None):
+        """週K或月K（bars.py 隨寫入維護，檔案很小，每次直接讀取），回傳JSON bytes"""
+        rows = _select(read_rows(bars.bar_path(period, code)), start, end)
+        return json.dumps({'code': code, 'period': period, 'records': rows}, ensure_ascii=False).encode('utf-8')
+
+    def _scan_date(self, family, date_str):
+        """找出某日所有個股的記錄（沒有異動檔的舊日期使用）：有日期索引時直接讀取該位置，否則逐檔掃描"""
+        indexed = date_index.read_date(family, date_str)
+        if indexed is not None:
+            return {code: [row for row in csv.reader(lines) if row] for code, lines in indexed.items()}
+        wanted = {date_str, records.taiwan_date(date_str)}
+        result = {}
+        directory = stock_common.output_dir(family)
+        for name in os.listdir(directory) if os.path.isdir(directory) else []:
+            code, ext = os.path.splitext(name)
+            if ext != f".{family}":
+                continue
+            rows = [row for row in read_rows(os.path.join(directory, name)) if row[0] in wanted]
+            if rows:
+                result[code] = rows
+        return result
+
+    def snapshot(self, date_str, family='txt'):
+        """某日所有個股的記錄 {代號: [記錄...]}，回傳JSON bytes
+
+        優先使用當日的異動檔（已含更正後的最新記錄），沒有時才逐檔讀取
+        """
+        key = (family, date_str)
+        # 任何寫入這天的程序都會更新當日的日期索引
+        stamp = file_stamp(date_index.index_path(family, date_str), archive.archive_dir(family))
+        cached = self.snapshots.get(key)
+        if cached is not None and cached[1] == stamp:
+            return cached[0]
+        result = {}
+        for dataset, dataset_family in DATASET_FAMILIES.items():
+            if dataset_family != family:
+                continue
+            for entry in delta.read_entries(dataset, date_str):
+                if entry['file'] == family:
+                    result[entry['code']] = entry['records']
+        if not result:
+            result = self._scan_date(family, date_str)
+        body = json.dumps({'date': date_str, 'family': family, 'records': result}, ensure_ascii=False).encode('utf-8')
+        self.snapshots.put(key, (body, stamp))
+        return body
+
+    def market(self, start=None, end=None):
+        """大盤 (1000) 在各輸出目錄的記錄，回傳JSON bytes"""
+        result = {family: _select(self._file(family, MARKET_CODE)[0], start, end) for family in FAMILIES}
+        return json.dumps({'code': MARKET_CODE, 'records': result}, ensure_ascii=False).encode('utf-8')
+
+    def refresh(self):
+        """讀取新的異動，清除受影響的個股檔案與日期快照，回傳處理的異動數"""
+        count = 0
+        for feed in delta.tail(self.cursor, offset=self.offset):
+            touched = {(entry['file'], entry['code']) for entry in feed['entries']}
+            families = {family for family, _ in touched}
+            self.files.discard(lambda key: key in touched)
+            self.snapshots.discard(lambda key: key[0] in families and key[1] == feed['date'])
+            self.cursor, self.offset = feed['seq'], feed['offset']
+            count += 1
+        return count
+
+    def watch(self, stop_event, interval=WATCH_INTERVAL):
+        """背景執行緒：定時檢查異動檔"""
+        while not stop_event.wait(interval):
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"讀取異動檔時發生錯誤: {str(e)}")
+
+    def stats(self):
+        return {'cursor': self.cursor, 'files': len(self.files), 'snapshots': len(self.snapshots),
+                'file_hits': self.files.hits, 'file_misses': self.files.misses,
+                'snapshot_hits': self.snapshots.hits, 'snapshot_misses': self.snapshots.misses,
+                **self.adjuster.stats()}
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """GET /history/{代號}、/bars/{代號}、/snapshot/{日期}、/market、/stats"""
+    store = None
+
+    def do_GET(self):
+        started = time.perf_counter()
+        url = urllib.parse.urlsplit(self.path)
+        parts = [part for part in url.path.split('/') if part]
+        query = {name: values[-1] for name, values in urllib.parse.parse_qs(url.query).items()}
+        family = query.get('family', 'txt')
+        if family not in FAMILIES:
+            return self._send(400, {'error': f"family 必須是 {', '.join(FAMILIES)}"})
+        try:
+            if len(parts) == 2 and parts[0] == 'history':
+                body = self.store.history(parts[1], family, query.get('start'), query.get('end'),
+                                          query.get('adjusted') == '1')
+            elif len(parts) == 2 and parts[0] == 'bars':
+                period = query.get('period', 'week')
+                if period not in bars.PERIODS:
+                    return self._send(400, {'error': f"period 必須是 {', '.join(bars.PERIODS)}"})
+                body = self.store.bar_history(parts[1], period, query.get('start'), query.get('end'))
+            elif len(parts) == 2 and parts[0] == 'snapshot':
+                body = self.store.snapshot(parts[1], family)
+            elif len(parts) == 1 and parts[0] == 'market':
+                body = self.store.market(query.get('start'), query.get('end'))
+            elif len(parts) == 2 and parts[0] == 'market':
+                body = self.store.market(parts[1], parts[1])
+            elif parts == ['stats']:
+                body = json.dumps(self.store.stats()).encode('utf-8')
+            else:
+                return self._send(404, {'error': '不支援的路徑'})
+        except Exception as e:
+            return self._send(500, {'error': str(e)})
+        self._send(200, body, started)
+
+    def _send(self, status, body, started=None):
+        if not isinstance(body, bytes):
+            body = json.dumps(body, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        if started is not None:
+            self.send_header('Server-Timing', f"store;dur={(time.perf_counter() - started) * 1000:.3f}")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        stock_common.log(f"{self.address_string()} {format % args}")
+
+
+def serve(host=DEFAULT_HOST, port=DEFAULT_PORT, store=None):
+    """啟動查詢服務（阻塞到 Ctrl+C）"""
+    store = store or StockStore()
+    handler = type('Handler', (QueryHandler,), {'store': store})
+    server = ThreadingHTTPServer((host, port), handler)
+    stop_event = threading.Event()
+    watcher = threading.Thread(target=store.watch, args=(stop_event,), name='delta-watch', daemon=True)
+    watcher.start()
+    print(f"查詢服務啟動: http://{host}:{port}/ （資料目錄 {stock_common.STOCK_ROOT}）")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("查詢服務停止")
+    finally:
+        stop_event.set()
+        server.server_close()
+
+
+def main():
+    """主程式"""
+    parser = argparse.ArgumentParser(description='本機HTTP/JSON查詢服務：個股歷史、某日橫斷面、大盤')
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--hot-files', type=int, default=HOT_FILES, help='記憶體中保留的個股檔案數')
+    parser.add_argument('--recent-days', type=int, default=RECENT_DAYS, help='記憶體中保留的日期快照數')
+    args = parser.parse_args()
+    stock_common.set_verbose(False)
+    serve(args.host, args.port, StockStore(args.hot_files, args.recent_days))
+
+
+if __name__ == "__main__":
+    main()
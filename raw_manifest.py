@@ -0,0 +1,95 @@
+import os
+import json
+import hashlib
+import threading
+from datetime import datetime
+import stock_common
+import filelock
+
+# 清單檔放在 {日期} 資料夾旁：{日期}.manifest.json，依輸出根目錄分別記錄各原始檔已寫入個股檔案的內容雜湊
+MANIFEST_SUFFIX = '.manifest.json'
+
+_lock = threading.Lock()
+
+
+def enabled():
+    """是否略過內容未變的原始檔（環境變數 STOCK_DEDUPE=0 關閉，例如離線重建時；雜湊仍照常登記）"""
+    return os.environ.get('STOCK_DEDUPE', '1') != '0'
+
+
+def manifest_path(date_str):
+    return os.path.join(stock_common.SCRIPT_DIR, date_str + MANIFEST_SUFFIX)
+
+
+def content_hash(path):
+    """原始檔內容的SHA-256"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load(date_str):
+    """讀取某日的清單 {來源代號: {輸出根目錄: {sha256, size, processed_at}}}"""
+    path = manifest_path(date_str)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _roots(manifest, key):
+    """某來源各輸出根目錄的登記（舊格式 {sha256, size, root, processed_at} 視為只有一個根目錄）"""
+    entry = manifest.get(key) or {}
+    if 'sha256' in entry:
+        return {entry.get('root'): {k: v for k, v in entry.items() if k != 'root'}}
+    return entry
+
+
+def is_processed(key, date_str, digest):
+    """相同內容是否已經處理並寫入目前的輸出目錄（輸出到其他目錄時不算）"""
+    entry = _roots(load(date_str), key).get(stock_common.STOCK_ROOT)
+    return bool(entry) and entry.get('sha256') == digest
+
+
+def mark_processed(key, date_str, digest):
+    """記錄原始檔內容已寫入個股檔案"""
+    path = manifest_path(date_str)
+    with _lock, filelock.locked(path):
+        manifest = load(date_str)
+        raw_path = stock_common.find_raw(key, date_str)
+        # 只更新目前輸出根目錄的登記，重建到其他目錄時不影響正式目錄的略過判斷
+        roots = manifest[key] = _roots(manifest, key)
+        roots[stock_common.STOCK_ROOT] = {
+            'sha256': digest,
+            'size': os.path.getsize(raw_path) if os.path.exists(raw_path) else None,
+            'processed_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        }
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=1)
+        os.replace(path + '.tmp', path)
+
+
+def check(raw_path):
+    """檢查原始檔是否需要處理
+
+    回傳:
+        (來源代號, 日期, 雜湊, 是否已處理過相同內容)；不是已知來源的檔案時來源代號為None
+    """
+    key, date_str = stock_common.source_of(raw_path)
+    if key is None or not os.path.exists(raw_path):
+        return key, date_str, None, False
+    digest = content_hash(raw_path)
+    return key, date_str, digest, enabled() and is_processed(key, date_str, digest)
+
+
+def commit(writer):
+    """寫入器flush之後，登記其內容來源的原始檔雜湊（未計算雜湊的來源不登記）"""
+    sources, writer.sources = writer.sources, []
+    for key, date_str, digest in sources:
+        if digest:
+            mark_processed(key, date_str, digest)
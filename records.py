@@ -0,0 +1,307 @@
+import os
+import re
+import sys
+import threading
+from abc import ABC, abstractmethod
+from array import array
+
+# 報價格式：整數或小數（不含正負號、指數、前導零），其他可轉成數字的字串保留原文
+_PRICE = re.compile(r'(0|[1-9][0-9]*)(?:\.([0-9]+))?')
+
+
+class CodeTable:
+    """股票代號表：每個代號只存一份字串（sys.intern），批次中只記錄整數編號"""
+
+    def __init__(self):
+        self._ids = {}
+        self._codes = []
+        self._lock = threading.Lock()
+
+    def intern(self, code):
+        code_id = self._ids.get(code)
+        if code_id is None:
+            with self._lock:
+                code_id = self._ids.get(code)
+                if code_id is None:
+                    code_id = len(self._codes)
+                    self._codes.append(sys.intern(code))
+                    self._ids[self._codes[-1]] = code_id
+        return code_id
+
+    def code(self, code_id):
+        return self._codes[code_id]
+
+    def __len__(self):
+        return len(self._codes)
+
+
+# 程序內共用的代號表
+CODES = CodeTable()
+
+
+def taiwan_date(date_str):
+    """YYYYMMDD 轉民國日期 YYYMMDD"""
+    return str(int(date_str[:4]) - 1911) + date_str[4:]
+
+
+# ---------------------------------------------------------------- 單筆資料型別
+
+class QuoteRecord:
+    """個股日行情（價格保留交易所原本的小數位數）"""
+    __slots__ = ('code', 'open', 'high', 'low', 'close', 'volume')
+
+    def __init__(self, code, open, high, low, close, volume):
+        self.code = code
+        self.open = open
+        self.high = high
+        self.low = low
+        self.close = close
+        self.volume = volume  # 張（股數/1000）
+
+    def __repr__(self):
+        return f"QuoteRecord({self.code} {self.open} {self.high} {self.low} {self.close} {self.volume})"
+
+
+class InstitutionalRecord:
+    """個股三大法人買賣（股數）"""
+    __slots__ = ('code', 'foreign_buy', 'foreign_sell', 'trust_buy', 'trust_sell', 'dealer_buy', 'dealer_sell')
+
+    def __init__(self, code, foreign_buy, foreign_sell, trust_buy, trust_sell, dealer_buy, dealer_sell):
+        self.code = code
+        self.foreign_buy = foreign_buy
+        self.foreign_sell = foreign_sell
+        self.trust_buy = trust_buy
+        self.trust_sell = trust_sell
+        self.dealer_buy = dealer_buy
+        self.dealer_sell = dealer_sell
+
+    def __repr__(self):
+        return f"InstitutionalRecord({self.code} {self.foreign_buy}/{self.foreign_sell} " \
+               f"{self.trust_buy}/{self.trust_sell} {self.dealer_buy}/{self.dealer_sell})"
+
+
+class MarginRecord:
+    """個股融資融券"""
+    __slots__ = ('code', 'margin_buy', 'margin_sell', 'margin_balance', 'short_buy', 'short_sell', 'short_balance')
+
+    def __init__(self, code, margin_buy, margin_sell, margin_balance, short_buy, short_sell, short_balance):
+        self.code = code
+        self.margin_buy = margin_buy
+        self.margin_sell = margin_sell
+        self.margin_balance = margin_balance
+        self.short_buy = short_buy
+        self.short_sell = short_sell
+        self.short_balance = short_balance
+
+    def __repr__(self):
+        return f"MarginRecord({self.code} {self.margin_buy}/{self.margin_sell}/{self.margin_balance} " \
+               f"{self.short_buy}/{self.short_sell}/{self.short_balance})"
+
+
+# ---------------------------------------------------------------- 當日批次
+
+class DayBatch(ABC):
+    """一個資料來源一天的解析結果
+
+    每個欄位是一個預先配置的整數陣列 (array('q'))，代號存成 CODES 的編號；
+    解析時不產生字串，寫入時 (lines) 才一次轉成原本的文字格式。
+
+    參數:
+        directory: 個股檔案所在目錄
+        date_str: 日期字串 (YYYYMMDD格式)
+        capacity: 預先配置的筆數，不夠時加倍
+    """
+    record_type = None
+    suffix = None
+
+    def __init__(self, directory, date_str, capacity=2048):
+        self.directory = directory
+        self.date_str = date_str
+        self.size = 0
+        self.codes = array('i', bytes(4 * capacity))
+        self.columns = [array('q', bytes(8 * capacity)) for _ in self.record_type.__slots__[1:]]
+
+    def __len__(self):
+        return self.size
+
+    def __getstate__(self):
+        # 子程序的代號編號在主程序無效，傳遞時改用代號字串
+        state = dict(self.__dict__)
+        state['codes'] = [CODES.code(code_id) for code_id in self.codes[:self.size]]
+        state['columns'] = [column[:self.size] for column in self.columns]
+        return state
+
+    def __setstate__(self, state):
+        state['codes'] = array('i', (CODES.intern(code) for code in state['codes']))
+        self.__dict__.update(state)
+
+    def _grow(self):
+        extra = max(len(self.codes), 64)
+        self.codes.extend(array('i', bytes(4 * extra)))
+        for column in self.columns:
+            column.extend(array('q', bytes(8 * extra)))
+        return extra
+
+    def add(self, code, *values):
+        """加入一筆資料（數值為整數）"""
+        row = self.size
+        if row == len(self.codes):
+            self._grow()
+        self.codes[row] = CODES.intern(code)
+        for column, value in zip(self.columns, values):
+            column[row] = value
+        self.size = row + 1
+
+    def remove(self, rows):
+        """移除指定的筆（例如被隔離的資料），其餘維持原順序
+
+        回傳:
+            保留的原始筆號列表
+        """
+        drop = set(rows)
+        keep = [row for row in range(self.size) if row not in drop]
+        if len(keep) == self.size:
+            return keep
+        self.codes = array('i', (self.codes[row] for row in keep))
+        self.columns = [array('q', (column[row] for row in keep)) for column in self.columns]
+        self.size = len(keep)
+        return keep
+
+    def values(self, row):
+        return [column[row] for column in self.columns]
+
+    def record(self, row):
+        """取出第row筆，轉成對應的資料型別"""
+        return self.record_type(CODES.code(self.codes[row]), *self.values(row))
+
+    def __iter__(self):
+        for row in range(self.size):
+            yield self.record(row)
+
+    def path(self, row):
+        return os.path.join(self.directory, f"{CODES.code(self.codes[row])}{self.suffix}")
+
+    @abstractmethod
+    def format_row(self, row, date):
+        """回傳第row筆要寫入的行（可能多行或不寫），子類別實作"""
+
+    def lines(self):
+        """依加入順序產生 (檔案路徑, 行)"""
+        date = taiwan_date(self.date_str)
+        for row in range(self.size):
+            text = self.format_row(row, date)
+            if text:
+                yield self.path(row), text
+
+    def line_count(self):
+        return sum(1 for _ in self.lines())
+
+
+def _price_digits(text):
+    """把報價字串轉成 (整數, 小數位數)；格式特殊時回傳 (0, -1)，由呼叫端保留原文"""
+    match = _PRICE.fullmatch(text)
+    if match is None or len(text) > 18:
+        float(text)  # 不是數字時拋出ValueError，與原本的驗證相同
+        return 0, -1
+    fraction = match.group(2) or ''
+    return int(match.group(1) + fraction), len(fraction)
+
+
+def _price_text(digits, decimals):
+    if decimals == 0:
+        return str(digits)
+    text = str(digits).rjust(decimals + 1, '0')
+    return f"{text[:-decimals]}.{text[-decimals:]}"
+
+
+class QuoteBatch(DayBatch):
+    """個股日行情批次：價格存成整數與小數位數，寫入時還原成原本的字串"""
+    record_type = QuoteRecord
+    suffix = '.txt'
+
+    def __init__(self, directory, date_str, capacity=2048):
+        super().__init__(directory, date_str, capacity)
+        self.decimals = [array('b', bytes(capacity)) for _ in range(4)]
+        self.raw = {}  # (row, 欄位) -> 原文，只有格式特殊的報價才會用到
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        state['decimals'] = [column[:self.size] for column in self.decimals]
+        return state
+
+    def _grow(self):
+        extra = super()._grow()
+        for column in self.decimals:
+            column.extend(array('b', bytes(extra)))
+        return extra
+
+    def add(self, code, open_price, high_price, low_price, close_price, volume):
+        """加入一筆行情
+
+        參數:
+            open_price ~ close_price: 報價字串（已去除引號與千分位逗號）
+            volume: 成交量（張）
+
+        價格不是數字時拋出ValueError，批次內容不變
+        """
+        prices = [_price_digits(text) for text in (open_price, high_price, low_price, close_price)]
+        row = self.size
+        if row == len(self.codes):
+            self._grow()
+        for field, (digits, decimals) in enumerate(prices):
+            self.columns[field][row] = digits
+            self.decimals[field][row] = decimals
+            if decimals < 0:
+                self.raw[(row, field)] = (open_price, high_price, low_price, close_price)[field]
+        self.columns[4][row] = volume
+        self.codes[row] = CODES.intern(code)
+        self.size = row + 1
+
+    def remove(self, rows):
+        size = self.size
+        keep = super().remove(rows)
+        if len(keep) != size:
+            self.decimals = [array('b', (column[row] for row in keep)) for column in self.decimals]
+            position = {row: new_row for new_row, row in enumerate(keep)}
+            self.raw = {(position[row], field): text for (row, field), text in self.raw.items() if row in position}
+        return keep
+
+    def price(self, row, field):
+        decimals = self.decimals[field][row]
+        if decimals < 0:
+            return self.raw[(row, field)]
+        return _price_text(self.columns[field][row], decimals)
+
+    def values(self, row):
+        return [self.price(row, field) for field in range(4)] + [self.columns[4][row]]
+
+    def format_row(self, row, date):
+        o, h, l, c, volume = self.values(row)
+        return f'"{date}","{o}","{h}","{l}","{c}","{volume}"\n'
+
+
+class InstitutionalBatch(DayBatch):
+    """個股三大法人批次：存股數，寫入時除以1000，買賣皆為0的法人不寫"""
+    record_type = InstitutionalRecord
+    suffix = '.law'
+
+    def format_row(self, row, date):
+        text = ''
+        for kind, (buy, sell) in enumerate(((0, 1), (2, 3), (4, 5)), start=1):
+            buy_value = self.columns[buy][row] / 1000
+            sell_value = self.columns[sell][row] / 1000
+            if buy_value != 0 or sell_value != 0:
+                text += f'"{date}","{buy_value}","{sell_value}","{kind}"\n'
+        return text
+
+
+class MarginBatch(DayBatch):
+    """個股融資融券批次：全部欄位為0的股票不寫"""
+    record_type = MarginRecord
+    suffix = '.inv'
+
+    def format_row(self, row, date):
+        values = self.values(row)
+        if not any(values):
+            return ''
+        return f'"{date}",' + ','.join(f'"{value}"' for value in values) + '\n'
@@ -0,0 +1,281 @@
+import os
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import stock_common
+import json_decode
+import records
+import metrics
+import delta
+import date_index
+import security_master
+import filelock
+import bars
+import archive
+
+# 個股月資料：一次請求取得一個代號一個月的日行情
+MONTH_URLS = {
+    'twse': 'https://www.twse.com.tw/rwd/zh/afterTrading/STOCK_DAY?date={date}&stockNo={code}&response=json',
+    'tpex': 'https://www.tpex.org.tw/www/zh-tw/afterTrading/tradingStock?code={code}&date={slash_date}&response=json',
+}
+
+# 同時進行的請求數、同一交易所相鄰兩次請求的最短間隔(秒)（請求太頻繁時交易所會暫時封鎖IP）
+MAX_CONCURRENT = 3
+MIN_INTERVAL = 0.6
+
+# 補缺漏寫入的資料在異動檔中的資料集名稱
+DELTA_DATASET = 'repair'
+
+
+class Limiter:
+    """請求限制：同時進行的請求數上限，且相鄰兩次請求至少間隔 interval 秒"""
+
+    def __init__(self, concurrency=MAX_CONCURRENT, interval=MIN_INTERVAL):
+        self.interval = interval
+        self._slots = threading.Semaphore(concurrency)
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def __enter__(self):
+        self._slots.acquire()
+        with self._lock:
+            now = time.monotonic()
+            wait = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+        return self
+
+    def __exit__(self, *exc):
+        self._slots.release()
+
+
+def month_url(market, code, month):
+    """某代號某月 (YYYYMM) 的月資料網址"""
+    return MONTH_URLS[market].format(code=code, date=f"{month}01", slash_date=f"{month[:4]}/{month[4:]}/01")
+
+
+def parse_month(content):
+    """解析月資料的JSON回應
+
+    回傳:
+        {西元日期 YYYYMMDD: (開, 高, 低, 收, 成交量(張))}，價格為去除千分位逗號的字串；查無資料時回傳空dict
+    """
+    doc = json_decode.load(content)
+    table = json_decode.find_table(doc, ('開盤', '收盤')) if doc is not None else None
+    if table is None:
+        return {}
+    fields = [field.replace(' ', '') for field in table[0]]
+    date_idx = next(i for i, field in enumerate(fields) if '日期' in field)
+    open_idx, high_idx, low_idx, close_idx = (next(i for i, field in enumerate(fields) if name in field)
+                                              for name in ('開盤', '最高', '最低', '收盤'))
+    # 證交所為成交股數，櫃買中心為成交張數
+    volume_idx = next(i for i, field in enumerate(fields) if '成交股數' in field or '成交張數' in field)
+    in_shares = '股數' in fields[volume_idx]
+
+    result = {}
+    for row in table[1]:
+        row = [str(value).strip().replace(',', '') for value in row]
+        parts = ''.join(ch for ch in row[date_idx] if ch.isdigit() or ch == '/').split('/')
+        prices = [row[open_idx], row[high_idx], row[low_idx], row[close_idx]]
+        if len(parts) != 3 or not row[volume_idx] or any('--' in price for price in prices):
+            continue
+        date_str = f"{int(parts[0]) + 1911}{int(parts[1]):02d}{int(parts[2]):02d}"
+        volume = int(float(row[volume_idx]))
+        result[date_str] = (*prices, round(volume / 1000) if in_shares else volume)
+    return result
+
+
+def format_line(date_str, values):
+    """轉成與每日處理相同的 txt 行"""
+    o, h, l, c, volume = values
+    return f'"{records.taiwan_date(date_str)}","{o}","{h}","{l}","{c}","{volume}"\n'
+
+
+def fetch_month(session, limiters, market, code, month):
+    """下載並解析某代號某月的資料，失敗時回傳None"""
+    url = month_url(market, code, month)
+    started = time.perf_counter()
+    try:
+        with limiters[market]:
+            response = session.get(url, headers=stock_common.HEADERS, verify=False, timeout=20)
+        content = response.content
+    except Exception as e:
+        print(f"{code} {month} 月資料下載失敗: {str(e)}")
+        return None
+    metrics.record(f"repair_{market}", f"{month}01", 'fetch', time.perf_counter() - started,
+                   status=response.status_code, bytes=len(content))
+    if response.status_code != 200:
+        print(f"{code} {month} 月資料下載失敗，狀態碼: {response.status_code}")
+        return None
+    return parse_month(content)
+
+
+def merge_file(path, lines_by_date):
+    """把缺少的日期依日期順序插入個股檔案（已有的日期不覆蓋，既有行的順序不變）
+
+    每一行插在第一個日期比它晚的既有行之前；檔案先寫暫存檔再替換。
+
+    參數:
+        path: 個股檔案路徑
+        lines_by_date: {西元日期: 行}
+
+    回傳:
+        (插入的 {日期: 行}, 位置有變動的最早日期)；沒有插入時為 ({}, None)
+    """
+    with filelock.locked(path):
+        return _merge_locked(path, lines_by_date)
+
+
+def _merge_locked(path, lines_by_date):
+    existing = []
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            existing = f.read().splitlines(True)
+    dates = [date_index.gregorian(line.decode('utf-8', errors='replace').split(',', 1)[0].strip().strip('"'))
+             for line in existing]
+    # 已封存的日期也算已有（見 archive.py）
+    present = set(dates)
+    if lines_by_date:
+        present.update(date_index.line_date(line) for line in archive.archived_lines(
+            'txt', os.path.splitext(os.path.basename(path))[0], min(lines_by_date)))
+    added = {date_str: line for date_str, line in sorted(lines_by_date.items()) if date_str not in present}
+    if not added:
+        return {}, None
+    if existing and not existing[-1].endswith(b'\n'):
+        existing[-1] += os.linesep.encode('utf-8')
+
+    newline = os.linesep.encode('utf-8')
+    merged = []
+    position = 0
+    first_insert = None
+    for date_str, line in added.items():
+        while position < len(existing) and (dates[position] is None or dates[position] <= date_str):
+            merged.append(existing[position])
+            position += 1
+        if first_insert is None:
+            first_insert = position
+        merged.append(line.rstrip('\n').encode('utf-8') + newline)
+    merged.extend(existing[position:])
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(b''.join(merged))
+    os.replace(path + '.tmp', path)
+    # 插入點之後的行位置都變了（包含較晚附加的更正行），從其中最早的日期開始重建索引
+    moved = [date_str for date_str in dates[first_insert:] if date_str] + list(added)
+    return added, min(moved)
+
+
+def plan(gaps):
+    """把缺漏的日期換成要請求的 (代號, 月份) 列表"""
+    return sorted({(code, date_str[:6]) for code, dates in gaps.items() for date_str in dates})
+
+
+def repair(gaps, workers=MAX_CONCURRENT, interval=MIN_INTERVAL):
+    """以個股月資料補上 txt 檔缺少的日期
+
+    參數:
+        gaps: {代號: [缺少的日期 (YYYYMMDD)...]}
+        workers: 同時進行的請求數
+        interval: 同一交易所相鄰兩次請求的最短間隔(秒)
+
+    回傳:
+        {代號: 補上的日期數}
+    """
+    master = security_master.load()
+    limiters = {market: Limiter(workers, interval) for market in MONTH_URLS}
+    session = stock_common.get_session()
+    tasks = plan(gaps)
+    print(f"{len(gaps)} 個代號共需請求 {len(tasks)} 個月的資料")
+
+    def fetch(task):
+        code, month = task
+        market = master.market(code)
+        if market is not None:
+            return task, fetch_month(session, limiters, market, code, month)
+        # 主檔中沒有的代號：先試上市，查無資料再試上櫃
+        return task, fetch_month(session, limiters, 'twse', code, month) or \
+            fetch_month(session, limiters, 'tpex', code, month)
+
+    fetched = {code: {} for code in gaps}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for (code, month), rows in executor.map(fetch, tasks):
+            wanted = {date_str for date_str in gaps[code] if date_str.startswith(month)}
+            for date_str, values in (rows or {}).items():
+                if date_str in wanted:
+                    fetched[code][date_str] = format_line(date_str, values)
+    return insert(fetched)
+
+
+def insert(lines, dataset=DELTA_DATASET):
+    """把行依日期順序插入 txt 個股檔案（已有的日期不覆蓋），並重建索引、週K/月K、技術指標，記錄異動
+
+    參數:
+        lines: {代號: {西元日期: 行}}
+        dataset: 異動檔中的資料集名稱
+
+    回傳:
+        {代號: 插入的日數}
+    """
+    directory = stock_common.output_dir('txt')
+    result = {}
+    changed = []
+    since = None
+    by_date = {}
+    with filelock.writer():
+        for code in sorted(lines):
+            path = os.path.join(directory, f"{code}.txt")
+            added, moved_from = merge_file(path, lines[code])
+            result[code] = len(added)
+            if not added:
+                continue
+            changed.append(path)
+            since = moved_from if since is None else min(since, moved_from)
+            for date_str, line in added.items():
+                by_date.setdefault(date_str, {})[path] = [line]
+        date_index.reindex('txt', changed, since)
+        bars.refresh(changed, since)
+        if changed:
+            import indicators
+            indicators.refresh(changed, since)
+        # 異動檔依日期記錄（補缺漏時資料集為 repair，查詢服務據此清除快取）
+        for date_str in sorted(by_date):
+            delta.record(dataset, date_str, by_date[date_str])
+    return result
+
+
+def main():
+    """主程式"""
+    import pipeline
+    import gaps
+    parser = argparse.ArgumentParser(description='以個股月資料補上個股行情 (txt) 缺少的日期')
+    parser.add_argument('codes', nargs='*', help='股票代號')
+    parser.add_argument('--start', help='開始日期 (YYYYMMDD)')
+    parser.add_argument('--end', help='結束日期 (YYYYMMDD)')
+    parser.add_argument('--gaps', help='改用缺漏報告 (gaps.py 產生的 txt.csv) 中的代號與日期')
+    parser.add_argument('--workers', type=int, default=MAX_CONCURRENT, help='同時進行的請求數')
+    parser.add_argument('--interval', type=float, default=MIN_INTERVAL, help='相鄰兩次請求的最短間隔(秒)')
+    args = parser.parse_args()
+
+    import urllib3
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    if args.gaps:
+        targets, _ = gaps.load_report(args.gaps)
+        if args.codes:
+            targets = {code: dates for code, dates in targets.items() if code in args.codes}
+    elif args.codes and args.start and args.end:
+        # 區間內的每個平日都列為候選，交易所有資料而檔案中沒有的日期才會寫入
+        dates = pipeline.weekdays(args.start, args.end)
+        targets = {code: dates for code in args.codes}
+    else:
+        parser.error('請指定代號與 --start/--end，或 --gaps 缺漏報告')
+    result = repair(targets, args.workers, args.interval)
+    for code, count in result.items():
+        print(f"{code}: 補上 {count} 天")
+    metrics.emit()
+
+
+if __name__ == "__main__":
+    main()
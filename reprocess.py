@@ -0,0 +1,118 @@
+import os
+import re
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import stock_common
+import orchestrator
+import metrics
+
+# 各資料集寫入的輸出目錄
+FAMILIES = {'quotes': 'txt', 'institutional': 'law', 'margin': 'inv'}
+
+
+def archived_dates(start=None, end=None):
+    """列出程式目錄下已存在的 {YYYYMMDD} 原始資料夾（依日期排序）"""
+    dates = []
+    for name in os.listdir(stock_common.SCRIPT_DIR):
+        if not re.fullmatch(r'\d{8}', name):
+            continue
+        if not os.path.isdir(os.path.join(stock_common.SCRIPT_DIR, name)):
+            continue
+        if (start and name < start) or (end and name > end):
+            continue
+        dates.append(name)
+    return sorted(dates)
+
+
+def parse_date(date_str, datasets):
+    """在子程序中解析某日所有現存的原始檔，回傳 {資料集: 批次寫入器}（不連網路、不寫檔）"""
+    results = {}
+    for dataset in datasets:
+        writers = []
+        for key in orchestrator.JOIN_ORDER[dataset]:
+            raw_path = stock_common.find_raw(key, date_str)
+            if stock_common.raw_file_ok(raw_path):
+                writers.append(orchestrator.parse_source(key, date_str, raw_path))
+        results[dataset] = orchestrator.join_writers(*writers)
+    return results
+
+
+def _parse_date_quiet(date_str, datasets):
+    """子程序版本：關閉逐行訊息，避免多個程序同時輸出大量文字"""
+    import contextlib
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        batches, records = metrics.collect(parse_date, date_str, datasets)
+        return date_str, batches, records
+
+
+def existing_outputs(datasets):
+    """檢查輸出目錄是否已有檔案（重建時附加到舊檔會造成重複資料）"""
+    found = []
+    for dataset in datasets:
+        directory = stock_common.output_dir(FAMILIES[dataset])
+        if os.path.isdir(directory) and os.listdir(directory):
+            found.append(directory)
+    return found
+
+
+def reprocess(dates, datasets, workers=None):
+    """以程序池平行解析各日期，再依日期先後寫入
+
+    參數:
+        dates: 日期列表（已排序）
+        datasets: 要重建的資料集
+        workers: 程序數，None為所有CPU核心
+    """
+    written = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # map依輸入順序回傳結果，前面的日期一解析完就寫入，後面的日期同時在其他核心解析
+        chunksize = max(1, len(dates) // ((workers or os.cpu_count() or 1) * 8))
+        results = executor.map(_parse_date_quiet, dates, [datasets] * len(dates), chunksize=chunksize)
+        for date_str, batches, records in results:
+            metrics.absorb(records)
+            for dataset in datasets:
+                written += orchestrator.write_batch(dataset, date_str, batches[dataset])
+            print(f"已重建 {date_str}")
+    return written
+
+
+def main():
+    """主程式"""
+    parser = argparse.ArgumentParser(description='從已下載的日期資料夾離線重建個股檔案（不連網路）')
+    parser.add_argument('--start', help='開始日期 (YYYYMMDD)')
+    parser.add_argument('--end', help='結束日期 (YYYYMMDD)')
+    parser.add_argument('--datasets', nargs='+', default=list(FAMILIES), choices=list(FAMILIES))
+    parser.add_argument('--output-root', help='輸出根目錄（建議指定新目錄重建，完成後再替換 D:/stock）')
+    parser.add_argument('--workers', type=int, help='程序數，預設使用所有CPU核心')
+    parser.add_argument('--append', action='store_true', help='輸出目錄已有檔案時仍然附加')
+    args = parser.parse_args()
+
+    if args.output_root:
+        # 子程序透過環境變數取得相同的輸出目錄
+        os.environ['STOCK_ROOT'] = args.output_root
+        stock_common.STOCK_ROOT = args.output_root
+    # 重建時每個原始檔都要解析，不依清單略過（雜湊登記在重建的輸出根目錄下）；也不產生異動檔
+    os.environ['STOCK_DEDUPE'] = '0'
+    os.environ['STOCK_DELTA'] = '0'
+    # 異常只記錄不隔離：重建的是已發布的歷史，隔離會讓歷史資料默默缺漏（明確指定時不覆寫）
+    os.environ.setdefault('STOCK_VALIDATE', 'report')
+
+    existing = existing_outputs(args.datasets)
+    if existing and not args.append:
+        parser.error(f"輸出目錄已有檔案: {', '.join(existing)}；請指定 --output-root 到新目錄，或加上 --append")
+
+    dates = archived_dates(args.start, args.end)
+    if not dates:
+        print("找不到任何日期資料夾")
+        return
+
+    print(f"重建 {dates[0]} ~ {dates[-1]} 共 {len(dates)} 天: {', '.join(args.datasets)} -> {stock_common.STOCK_ROOT}")
+    started = time.perf_counter()
+    written = reprocess(dates, args.datasets, args.workers)
+    metrics.emit()
+    print(f"重建完成，耗時 {time.perf_counter() - started:.1f} 秒，共寫入 {written} 次檔案")
+
+
+if __name__ == "__main__":
+    main()
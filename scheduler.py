@@ -0,0 +1,236 @@
+import os
+import json
+import time
+import argparse
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+import stock_common
+import filelock
+
+# 各資料集的預定發布時間 (時, 分)，到點後自動觸發
+PUBLISH_TIMES = {
+    'quotes': (14, 0),          # 上市/上櫃收盤行情、大盤五秒
+    'institutional': (15, 0),   # 三大法人 (T86)
+    'margin': (21, 0),          # 融資融券 (MI_MARGN)
+}
+
+# 排程狀態檔（已排入的日期、重試佇列、放棄的工作、--enqueue 送來還沒併入的工作）
+STATE_FILE = os.path.join(stock_common.SCRIPT_DIR, 'scheduler_state.json')
+
+# 重試設定：第n次失敗後等待 BACKOFF_BASE * 2^(n-1) 秒，最多 BACKOFF_MAX 秒
+BACKOFF_BASE = 10 * 60
+BACKOFF_MAX = 6 * 60 * 60
+MAX_ATTEMPTS = 8
+
+# 停機期間最多補排幾天
+MAX_CATCHUP_DAYS = 10
+
+# 主迴圈檢查間隔(秒)
+POLL_INTERVAL = 30
+
+
+def load_state():
+    """讀取排程狀態檔，不存在時回傳空狀態"""
+    state = {'scheduled': {}, 'queue': [], 'failed': [], 'inbox': []}
+    if os.path.exists(STATE_FILE):
+        try:
+            with open(STATE_FILE, 'r', encoding='utf-8') as f:
+                state.update(json.load(f))
+        except Exception as e:
+            print(f"讀取排程狀態檔失敗，使用空狀態: {str(e)}")
+    return state
+
+
+def save_state(state):
+    """寫入排程狀態檔（先寫暫存檔再取代，避免中斷時損毀）"""
+    tmp_path = STATE_FILE + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, STATE_FILE)
+
+
+def sync_state(state):
+    """併入 --enqueue 送來的工作後寫回狀態檔
+
+    排程執行中時狀態以記憶體為準；其他程序只能附加到 inbox，
+    在鎖內重新讀檔取出，避免寫回時蓋掉手動加入的工作。
+    """
+    with filelock.locked(STATE_FILE):
+        for job in load_state()['inbox']:
+            enqueue(state, job['dataset'], job['date'])
+        state['inbox'] = []
+        save_state(state)
+
+
+def send_job(dataset, date_str):
+    """把手動加入的工作放進狀態檔的 inbox，由排程下一次檢查時併入佇列"""
+    with filelock.locked(STATE_FILE):
+        state = load_state()
+        if {'dataset': dataset, 'date': date_str} not in state['inbox']:
+            state['inbox'].append({'dataset': dataset, 'date': date_str})
+        save_state(state)
+    print(f"已送出排程工作: {dataset} {date_str}")
+
+
+def backoff_seconds(attempts):
+    """計算第attempts次失敗後的等待秒數"""
+    return min(BACKOFF_BASE * 2 ** (attempts - 1), BACKOFF_MAX)
+
+
+def enqueue(state, dataset, date_str):
+    """將 (資料集, 日期) 加入佇列並立即可執行，已存在則忽略
+
+    參數:
+        state: 排程狀態
+        dataset: 資料集名稱
+        date_str: 日期字串 (YYYYMMDD格式)
+    """
+    for job in state['queue']:
+        if job['dataset'] == dataset and job['date'] == date_str:
+            return
+    state['queue'].append({
+        'dataset': dataset,
+        'date': date_str,
+        'attempts': 0,
+        'next_try': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'last_error': None,
+    })
+    print(f"加入排程佇列: {dataset} {date_str}")
+
+
+def schedule_due(state, now):
+    """依發布時間排入今天的工作，並補排停機期間錯過的交易日"""
+    today = now.strftime('%Y%m%d')
+    for dataset, (hour, minute) in PUBLISH_TIMES.items():
+        last = state['scheduled'].get(dataset)
+
+        # 補排錯過的日期（只排平日，假日由重試失敗後放棄）
+        if last is not None:
+            day = max(datetime.strptime(last, '%Y%m%d') + timedelta(days=1),
+                      now - timedelta(days=MAX_CATCHUP_DAYS))
+            while day.strftime('%Y%m%d') < today:
+                if day.weekday() < 5:
+                    enqueue(state, dataset, day.strftime('%Y%m%d'))
+                state['scheduled'][dataset] = day.strftime('%Y%m%d')
+                day += timedelta(days=1)
+
+        # 今天到發布時間後排入
+        publish_time = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        if now >= publish_time and state['scheduled'].get(dataset) != today:
+            if now.weekday() < 5:
+                enqueue(state, dataset, today)
+            state['scheduled'][dataset] = today
+
+
+def run_job(dataset, date_str, poll=False):
+    """執行單一資料集某日的下載與處理
+
+    參數:
+        poll: 為True且是當天資料時，改用輪詢模式等待交易所發布後立即處理
+    """
+    if poll and date_str == datetime.now().strftime('%Y%m%d'):
+        import poller
+        return poller.poll_dataset(dataset, date_str)
+    module = stock_common.load_script(dataset)
+    return module.run(date_str)
+
+
+def finish_job(state, job, ok, error=None):
+    """根據執行結果更新佇列：成功移除，失敗則依退避時間重排或放棄"""
+    state['queue'].remove(job)
+    if ok:
+        print(f"排程工作完成: {job['dataset']} {job['date']}")
+        return
+
+    job['attempts'] += 1
+    job['last_error'] = error or '原始檔缺少或大小異常'
+    if job['attempts'] >= MAX_ATTEMPTS:
+        print(f"排程工作 {job['dataset']} {job['date']} 已失敗 {job['attempts']} 次，放棄重試")
+        state['failed'].append(job)
+        return
+
+    wait = backoff_seconds(job['attempts'])
+    job['next_try'] = (datetime.now() + timedelta(seconds=wait)).strftime('%Y-%m-%d %H:%M:%S')
+    state['queue'].append(job)
+    print(f"排程工作 {job['dataset']} {job['date']} 失敗({job['attempts']}/{MAX_ATTEMPTS})，{wait // 60} 分鐘後重試")
+
+
+def due_jobs(state, now, running):
+    """取出可執行的工作：同一資料集一次只跑一個日期，並依日期先後執行"""
+    jobs = []
+    busy = set(running)
+    for job in sorted(state['queue'], key=lambda j: j['date']):
+        if job['dataset'] in busy:
+            continue
+        if datetime.strptime(job['next_try'], '%Y-%m-%d %H:%M:%S') <= now:
+            jobs.append(job)
+            busy.add(job['dataset'])
+    return jobs
+
+
+def serve(once=False, workers=3, poll=False):
+    """排程主迴圈
+
+    參數:
+        once: 只執行目前到期的工作後結束（適合搭配系統排程器）
+        workers: 同時執行的資料集數量
+        poll: 當天資料改用輪詢模式（見 poller.py）
+    """
+    state = load_state()
+    running = {}  # dataset -> (job, future)
+    sync_state(state)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            for dataset, (job, future) in list(running.items()):
+                if not future.done():
+                    continue
+                del running[dataset]
+                try:
+                    finish_job(state, job, future.result())
+                except Exception as e:
+                    print(f"排程工作 {job['dataset']} {job['date']} 發生錯誤: {str(e)}")
+                    finish_job(state, job, False, str(e))
+
+            now = datetime.now()
+            schedule_due(state, now)
+            for job in due_jobs(state, now, running):
+                print(f"開始執行排程工作: {job['dataset']} {job['date']}")
+                running[job['dataset']] = (job, executor.submit(run_job, job['dataset'], job['date'], poll))
+            sync_state(state)
+
+            if once and not running:
+                break
+            time.sleep(1 if once else POLL_INTERVAL)
+
+
+def main():
+    """主程式"""
+    parser = argparse.ArgumentParser(description='台股資料自動排程（取代手動輸入日期）')
+    parser.add_argument('--once', action='store_true', help='只執行目前到期的工作後結束')
+    parser.add_argument('--workers', type=int, default=len(PUBLISH_TIMES), help='同時執行的資料集數量')
+    parser.add_argument('--poll', action='store_true', help='當天資料以輪詢方式等待發布後立即處理')
+    parser.add_argument('--enqueue', nargs=2, metavar=('DATASET', 'YYYYMMDD'), help='手動加入一筆工作')
+    args = parser.parse_args()
+
+    if args.enqueue:
+        dataset, date_str = args.enqueue
+        if dataset not in stock_common.DATASETS:
+            parser.error(f"未知的資料集: {dataset}")
+        try:
+            datetime.strptime(date_str, '%Y%m%d')
+        except ValueError:
+            parser.error(f"日期格式錯誤（應為 YYYYMMDD）: {date_str}")
+        send_job(dataset, date_str)
+        return
+
+    print("=" * 50)
+    print(f"排程啟動: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    for dataset, (hour, minute) in PUBLISH_TIMES.items():
+        print(f"  {dataset}: 每個交易日 {hour:02d}:{minute:02d} 後執行")
+    print("=" * 50)
+    serve(once=args.once, workers=args.workers, poll=args.poll)
+
+
+if __name__ == "__main__":
+    main()
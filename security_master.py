@@ -0,0 +1,257 @@
+import os
+import re
+import csv
+import io
+import argparse
+import threading
+import stock_common
+import json_decode
+import filelock
+
+# 證券主檔（輸出根目錄下 master/securities.csv，UTF-8，可手動修改類別）
+MASTER_FILE = 'securities.csv'
+FIELDS = ['code', 'market', 'name', 'type', 'first_seen', 'last_seen']
+
+# 維護主檔使用的每日行情來源與市場
+MASTER_SOURCES = {'twse_quotes': 'twse', 'tpex_quotes': 'tpex'}
+
+# 處理時略過的商品類別，可用環境變數 STOCK_SKIP_TYPES 覆寫（逗號分隔，空字串為全部保留）
+SKIP_TYPES = set(t for t in os.environ.get('STOCK_SKIP_TYPES', 'warrant').split(',') if t)
+
+# 權證：上市 03xxxx~08xxxx、上櫃 7xxxxx，認售權證結尾P、牛熊證結尾C/B/X/Y
+_WARRANT = re.compile(r'(0[3-8][0-9]{3}|7[0-9]{4})[0-9PCBXYF]')
+
+
+def classify(code, name=''):
+    """依代號規則（必要時參考名稱）判斷商品類別
+
+    回傳:
+        stock / preferred / etf / etn / tdr / warrant / other
+    """
+    if len(code) == 6 and _WARRANT.fullmatch(code):
+        return 'warrant'
+    if code.startswith('00'):
+        return 'etf'
+    if len(code) == 6 and code.startswith('02'):
+        return 'etn'
+    if len(code) == 6 and name and ('購' in name or '售' in name):
+        return 'warrant'
+    if code.startswith('91') and code[:4].isdigit():
+        return 'tdr'
+    if len(code) == 4 and code.isdigit():
+        return 'stock'
+    if len(code) == 5 and code[:4].isdigit() and code[4].isalpha():
+        return 'preferred'
+    return 'other'
+
+
+def master_path():
+    return os.path.join(stock_common.output_dir('master'), MASTER_FILE)
+
+
+def read_listing(raw_path):
+    """從每日行情原始檔讀出 [(代號, 名稱), ...]（代號不是數字開頭的行不列入）"""
+    if stock_common.is_json(raw_path):
+        table = json_decode.read_table(raw_path, ('代號', '名稱'))
+        if table is None:
+            return []
+        header, rows = table
+        code_idx = next(i for i, part in enumerate(header) if '代號' in part)
+        name_idx = next(i for i, part in enumerate(header) if '名稱' in part)
+        return [(row[code_idx].strip(), row[name_idx].strip()) for row in rows
+                if len(row) > max(code_idx, name_idx) and row[code_idx].strip()[:1].isdigit()]
+    with open(raw_path, 'rb') as f:
+        text = stock_common.decode_bytes(f.read())
+    if text is None:
+        return []
+    listing = []
+    code_idx = name_idx = None
+    for line in text.splitlines():
+        if code_idx is None:
+            if '代號' in line and '名稱' in line:
+                header = [part.strip().strip('"') for part in next(csv.reader(io.StringIO(line)))]
+                code_idx = next(i for i, part in enumerate(header) if '代號' in part)
+                name_idx = next(i for i, part in enumerate(header) if '名稱' in part)
+            continue
+        if not line.strip():
+            continue
+        row = next(csv.reader(io.StringIO(line)))
+        if len(row) <= max(code_idx, name_idx):
+            continue
+        code = row[code_idx].strip().replace('="', '').replace('"', '')
+        if code and code[0].isdigit():
+            listing.append((code, row[name_idx].strip()))
+    return listing
+
+
+class SecurityMaster:
+    """證券主檔：代號 -> 市場、名稱、類別、首次/最後出現日期
+
+    參數:
+        path: 主檔路徑，預設 D:/stock/master/securities.csv
+    """
+
+    def __init__(self, path=None):
+        self.path = path or master_path()
+        self.entries = {}
+        self._lock = threading.Lock()
+        if os.path.exists(self.path):
+            with open(self.path, 'r', encoding='utf-8', newline='') as f:
+                for entry in csv.DictReader(f):
+                    self.entries[entry['code']] = entry
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, code):
+        return code in self.entries
+
+    def get(self, code):
+        return self.entries.get(code)
+
+    def market(self, code):
+        """代號所屬市場 (twse / tpex)，未知時回傳None"""
+        entry = self.entries.get(code)
+        return entry['market'] if entry else None
+
+    def instrument_type(self, code):
+        entry = self.entries.get(code)
+        return entry['type'] if entry else classify(code)
+
+    def observe(self, code, market, name, date_str):
+        """記錄某日出現的證券：新代號加入，舊代號更新最後出現日期與最新名稱"""
+        with self._lock:
+            entry = self.entries.get(code)
+            if entry is None:
+                self.entries[code] = {'code': code, 'market': market, 'name': name, 'type': classify(code, name),
+                                      'first_seen': date_str, 'last_seen': date_str}
+                return
+            if date_str >= entry['last_seen']:
+                entry['last_seen'] = date_str
+                entry['market'] = market
+                entry['name'] = name or entry['name']
+            if date_str < entry['first_seen']:
+                entry['first_seen'] = date_str
+
+    def update_from_raw(self, key, date_str, raw_path):
+        """用一個每日行情原始檔更新主檔，回傳讀到的證券數"""
+        listing = read_listing(raw_path)
+        for code, name in listing:
+            self.observe(code, MASTER_SOURCES[key], name, date_str)
+        return len(listing)
+
+    def listed_on(self, date_str):
+        """某日在掛牌期間內（首次~最後出現）的代號"""
+        return [code for code, entry in self.entries.items() if entry['first_seen'] <= date_str <= entry['last_seen']]
+
+    def _merge_file(self):
+        """併入其他程序寫回的主檔：加入沒有的代號，已有的代號放寬首次/最後出現日期"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8', newline='') as f:
+            for other in csv.DictReader(f):
+                entry = self.entries.get(other['code'])
+                if entry is None:
+                    self.entries[other['code']] = other
+                    continue
+                if other['last_seen'] > entry['last_seen']:
+                    entry.update(last_seen=other['last_seen'], market=other['market'], name=other['name'] or entry['name'])
+                if other['first_seen'] < entry['first_seen']:
+                    entry['first_seen'] = other['first_seen']
+
+    def save(self):
+        """寫回主檔（先寫暫存檔再替換，避免中斷時留下不完整的檔案；其他程序的更新先併入）"""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with filelock.locked(self.path), self._lock:
+            self._merge_file()
+            rows = [self.entries[code] for code in sorted(self.entries)]
+            with open(self.path + '.tmp', 'w', encoding='utf-8', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=FIELDS)
+                writer.writeheader()
+                writer.writerows(rows)
+            os.replace(self.path + '.tmp', self.path)
+
+
+_master = None
+_master_lock = threading.Lock()
+_types = {}
+
+
+def load():
+    """取得程序內共用的主檔（第一次使用時載入）"""
+    global _master
+    with _master_lock:
+        if _master is None:
+            _master = SecurityMaster()
+        return _master
+
+
+def skipped(code):
+    """處理時是否略過這個代號（類別在 SKIP_TYPES 中），結果依代號快取"""
+    if not SKIP_TYPES:
+        return False
+    instrument_type = _types.get(code)
+    if instrument_type is None:
+        instrument_type = _types[code] = load().instrument_type(code)
+    return instrument_type in SKIP_TYPES
+
+
+def update(date_str, keys=None):
+    """用某日已下載的每日行情原始檔更新並儲存主檔，回傳讀到的證券數
+
+    參數:
+        date_str: 日期字串 (YYYYMMDD格式)
+        keys: 要讀取的來源，預設上市、上櫃行情
+    """
+    master = load()
+    count = 0
+    for key in keys or MASTER_SOURCES:
+        raw_path = stock_common.find_raw(key, date_str)
+        if stock_common.raw_file_ok(raw_path):
+            count += master.update_from_raw(key, date_str, raw_path)
+    if count:
+        master.save()
+    return count
+
+
+def main():
+    """主程式"""
+    parser = argparse.ArgumentParser(description='證券主檔：從每日行情原始檔建立，或查詢代號')
+    sub = parser.add_subparsers(dest='command', required=True)
+    build = sub.add_parser('build', help='掃描已下載的日期資料夾重建主檔')
+    build.add_argument('--start', help='開始日期 (YYYYMMDD)')
+    build.add_argument('--end', help='結束日期 (YYYYMMDD)')
+    show = sub.add_parser('show', help='查詢代號')
+    show.add_argument('codes', nargs='+')
+    sub.add_parser('stats', help='各市場、各類別的證券數')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        import reprocess
+        master = load()
+        dates = reprocess.archived_dates(args.start, args.end)
+        for date_str in dates:
+            for key in MASTER_SOURCES:
+                raw_path = stock_common.find_raw(key, date_str)
+                if stock_common.raw_file_ok(raw_path):
+                    master.update_from_raw(key, date_str, raw_path)
+        master.save()
+        print(f"已從 {len(dates)} 個日期資料夾建立主檔，共 {len(master)} 檔證券: {master.path}")
+    elif args.command == 'show':
+        master = load()
+        for code in args.codes:
+            entry = master.get(code)
+            if entry:
+                print(f"{code} {entry['name']} {entry['market']} {entry['type']} {entry['first_seen']}~{entry['last_seen']}")
+            else:
+                print(f"{code} 不在主檔中（依代號判斷類別: {classify(code)}）")
+    else:
+        counts = {}
+        for entry in load().entries.values():
+            counts[(entry['market'], entry['type'])] = counts.get((entry['market'], entry['type']), 0) + 1
+        for (market, instrument_type), count in sorted(counts.items()):
+            print(f"{market:5s} {instrument_type:10s} {count:6d}")
+
+
+if __name__ == "__main__":
+    main()
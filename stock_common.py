@@ -0,0 +1,396 @@
+import os
+import re
+import time
+import functools
+import importlib.util
+import urllib.parse
+import threading
+
+# 程式所在目錄（日期資料夾都建立在這裡）
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# 各資料集對應的腳本檔案
+DATASETS = {
+    'quotes': '上櫃+上市+5秒.py',
+    'institutional': '上櫃+上市+大盤法人.py',
+    'margin': '上櫃+上市融資.py',
+}
+
+# 個股輸出根目錄（txt / law / inv），可用環境變數 STOCK_ROOT 覆寫
+STOCK_ROOT = os.environ.get('STOCK_ROOT', 'D:/stock')
+
+# 下載時使用的請求標頭
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8'
+}
+
+# 所有可載入的腳本（含國際指數）
+SCRIPTS = dict(DATASETS, world='worldindex-today.py')
+
+# 小於此大小的原始檔視為「查無資料」
+MIN_RAW_SIZE = 100
+
+# 讀取原始CSV時依序嘗試的編碼
+ENCODINGS = ['big5', 'cp950', 'utf-8-sig', 'utf-8', 'gbk']
+
+# 是否輸出逐步的處理訊息，可用環境變數 STOCK_VERBOSE=0 關閉（錯誤訊息一律輸出）
+VERBOSE = os.environ.get('STOCK_VERBOSE', '1') != '0'
+
+_loaded_scripts = {}
+_load_lock = threading.Lock()
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def output_dir(family):
+    """個股輸出目錄，例如 output_dir('txt') -> D:/stock/txt"""
+    return f"{STOCK_ROOT}/{family}"
+
+
+def set_verbose(flag):
+    """開關逐步訊息（同時設定環境變數，讓之後建立的子程序一致）"""
+    global VERBOSE
+    VERBOSE = bool(flag)
+    os.environ['STOCK_VERBOSE'] = '1' if flag else '0'
+
+
+def log(*args):
+    """輸出逐步處理訊息，VERBOSE關閉時不輸出"""
+    if VERBOSE:
+        print(*args)
+
+
+def get_session():
+    """取得共用的HTTP連線池（同一程序內的所有下載共用，可重複使用TLS連線）"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            _session = session
+        return _session
+
+
+def load_script(dataset):
+    """載入資料集對應的腳本模組（檔名含中文、+號或-號，無法直接import）
+
+    參數:
+        dataset: 資料集名稱 (quotes / institutional / margin / world)
+    """
+    with _load_lock:
+        if dataset not in _loaded_scripts:
+            script_path = os.path.join(SCRIPT_DIR, SCRIPTS[dataset])
+            spec = importlib.util.spec_from_file_location(f"stock_{dataset}", script_path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            if os.environ.get('STOCK_PROFILE'):
+                # 剖析模式：把指定的函數換成剖析包裝（見 profiling.py）
+                import profiling
+                profiling.wrap_module(dataset, module)
+            _loaded_scripts[dataset] = module
+        return _loaded_scripts[dataset]
+
+
+def loaded_scripts():
+    """已載入的腳本模組 {資料集: 模組}"""
+    with _load_lock:
+        return dict(_loaded_scripts)
+
+
+def decode_bytes(content):
+    """依序嘗試各種編碼解碼原始內容，全部失敗時回傳None"""
+    for encoding in ENCODINGS:
+        try:
+            return content.decode(encoding)
+        except UnicodeDecodeError:
+            continue
+    return None
+
+
+def raw_file_ok(path):
+    """檢查原始檔是否存在且大小正常"""
+    return os.path.exists(path) and os.path.getsize(path) >= MIN_RAW_SIZE
+
+
+# 各資料來源的下載設定（依原本的下載順序排列）
+#   url: {date} 為 YYYYMMDD，{slash_date} 為URL編碼後的 YYYY/MM/DD（櫃買中心使用）
+#   header: 標題行必須包含的關鍵字
+#   min_rows: 標題行之後至少要有幾行資料才視為已發布
+#   process: (處理函數名稱, 額外參數)
+SOURCES = {
+    'tpex_quotes': {
+        'dataset': 'quotes', 'label': '上櫃', 'file': '櫃買_{date}.csv',
+        'url': 'https://www.tpex.org.tw/www/zh-tw/afterTrading/dailyQuotes?date={slash_date}&id=&response=csv',
+        'header': ('代號', '名稱', '收盤', '開盤', '最高', '最低'), 'min_rows': 500,
+        'process': ('process_stock_data', {'is_otc': True}),
+    },
+    'index_5sec': {
+        'dataset': 'quotes', 'label': '大盤五秒', 'file': '大盤5秒_{date}.csv',
+        'url': 'https://www.twse.com.tw/rwd/zh/TAIEX/MI_5MINS_INDEX?date={date}&response=csv',
+        'header': ('時間', '發行量加權股價指數'), 'min_rows': 3000,
+        'process': ('process_index_5sec_data', {}),
+    },
+    'twse_quotes': {
+        'dataset': 'quotes', 'label': '上市', 'file': '上市_{date}.csv',
+        'url': 'https://www.twse.com.tw/rwd/zh/afterTrading/MI_INDEX?date={date}&type=ALLBUT0999&response=csv',
+        'header': ('證券代號',), 'min_rows': 500,
+        'process': ('process_stock_data', {'is_otc': False}),
+    },
+    'tpex_institutional': {
+        'dataset': 'institutional', 'label': '上櫃法人', 'file': '櫃買法人_{date}.csv',
+        'url': 'https://www.tpex.org.tw/www/zh-tw/insti/dailyTrade?type=Daily&sect=EW&date={slash_date}&id=&response=csv',
+        'header': ('代號', '名稱'), 'min_rows': 300,
+        'process': ('process_stock_data', {'is_otc': True}),
+    },
+    'market_institutional': {
+        'dataset': 'institutional', 'label': '大盤法人', 'file': '大盤法人_{date}.csv',
+        'url': 'https://www.twse.com.tw/rwd/zh/fund/BFI82U?type=day&dayDate={date}&response=csv',
+        'header': ('單位名稱',), 'min_rows': 5,
+        'process': ('process_index_data', {}),
+    },
+    'twse_institutional': {
+        'dataset': 'institutional', 'label': '上市法人', 'file': '上市法人_{date}.csv',
+        'url': 'https://www.twse.com.tw/rwd/zh/fund/T86?date={date}&selectType=ALLBUT0999&response=csv',
+        'header': ('代號', '名稱'), 'min_rows': 500,
+        'process': ('process_stock_data', {'is_otc': False}),
+    },
+    'tpex_margin': {
+        'dataset': 'margin', 'label': '上櫃融資', 'file': '櫃買融資_{date}.csv',
+        'url': 'https://www.tpex.org.tw/www/zh-tw/margin/balance?date={slash_date}&id=&response=csv',
+        'header': ('代號', '名稱'), 'min_rows': 300,
+        'process': ('process_stock_data', {'is_otc': True}),
+    },
+    'twse_margin': {
+        'dataset': 'margin', 'label': '上市融資', 'file': '上市融資_{date}.csv',
+        'url': 'https://www.twse.com.tw/rwd/zh/marginTrading/MI_MARGN?date={date}&selectType=ALL&response=csv',
+        'header': ('代號', '名稱'), 'min_rows': 500,
+        'process': ('process_stock_data', {'is_otc': False}),
+    },
+}
+
+
+# 可改用JSON回應的來源（處理函數可直接讀取 fields/data），以環境變數 STOCK_RESPONSE 選擇：
+#   json 為全部改用JSON，或列出來源代號（逗號分隔）只讓這些來源使用JSON；預設為CSV
+JSON_SOURCES = ('tpex_quotes', 'twse_quotes', 'tpex_institutional', 'twse_institutional', 'tpex_margin', 'twse_margin')
+
+
+def response_format(key):
+    """資料來源使用的回應格式 (csv / json)"""
+    selected = [name for name in os.environ.get('STOCK_RESPONSE', 'csv').split(',') if name]
+    if key in JSON_SOURCES and ('json' in selected or key in selected):
+        return 'json'
+    return 'csv'
+
+
+def is_json(path):
+    return path.endswith('.json')
+
+
+def dataset_sources(dataset):
+    """取得資料集包含的資料來源代號（依下載順序）"""
+    return [key for key, source in SOURCES.items() if source['dataset'] == dataset]
+
+
+def source_url(key, date_str):
+    """組出資料來源在指定日期的下載網址"""
+    slash_date = urllib.parse.quote(f"{date_str[:4]}/{date_str[4:6]}/{date_str[6:8]}")
+    url = SOURCES[key]['url'].format(date=date_str, slash_date=slash_date)
+    if response_format(key) == 'json':
+        url = url.replace('response=csv', 'response=json')
+    return url
+
+
+def source_path(key, date_str, response=None):
+    """資料來源在指定日期的原始檔路徑（位於日期資料夾內，JSON格式的副檔名為 .json）"""
+    name = SOURCES[key]['file'].format(date=date_str)
+    if (response or response_format(key)) == 'json':
+        name = name[:-len('.csv')] + '.json'
+    return os.path.join(SCRIPT_DIR, date_str, name)
+
+
+def find_raw(key, date_str):
+    """已下載的原始檔：優先使用目前設定的格式，沒有時改用另一種格式的檔案"""
+    path = source_path(key, date_str)
+    if not os.path.exists(path) and key in JSON_SOURCES:
+        other = source_path(key, date_str, 'csv' if is_json(path) else 'json')
+        if os.path.exists(other):
+            return other
+    return path
+
+
+def source_of(path):
+    """由原始檔路徑反查 (資料來源代號, 日期)，無法辨識時回傳 (None, None)"""
+    name = os.path.basename(path)
+    for key, source in SOURCES.items():
+        prefix, _, suffix = source['file'].partition('{date}')
+        match = re.fullmatch(re.escape(prefix) + r'(\d{8})' + re.escape(suffix[:-len('.csv')]) + r'\.(?:csv|json)', name)
+        if match:
+            return key, match.group(1)
+    return None, None
+
+
+class BatchWriter:
+    """批次寫入器
+
+    解析時先把每個檔案要附加的行累積在記憶體，flush時每個檔案只開啟一次；
+    多個資料來源可以各自解析後再用merge合併，最後一次寫入。
+    個股資料以當日批次 (records.DayBatch) 加入，flush時才轉成文字。
+    sources 記錄內容來自哪些原始檔 (來源代號, 日期, 雜湊)，寫入後由 raw_manifest.commit 登記。
+    """
+
+    def __init__(self):
+        # 依加入順序排列：{路徑: [行...]} 或 DayBatch，同一檔案的行維持加入順序
+        self._parts = []
+        self._lock = threading.Lock()
+        self.flushed_bytes = 0
+        self.last_flush = {}
+        self.sources = []
+
+    def __getstate__(self):
+        # 讓寫入器可以從子程序傳回（鎖無法pickle）
+        return {'_parts': self._parts, 'sources': self.sources}
+
+    def __setstate__(self, state):
+        self._parts = state['_parts']
+        self._lock = threading.Lock()
+        self.flushed_bytes = 0
+        self.last_flush = {}
+        self.sources = state.get('sources', [])
+
+    def __len__(self):
+        return len(self._collect(list(self._parts)))
+
+    def append(self, path, line):
+        """記錄要附加到檔案的一行（自動補上換行）"""
+        if not line.endswith('\n'):
+            line += '\n'
+        with self._lock:
+            if not self._parts or not isinstance(self._parts[-1], dict):
+                self._parts.append({})
+            self._parts[-1].setdefault(path, []).append(line)
+
+    def add_batch(self, batch):
+        """加入一個當日批次（records.DayBatch）"""
+        with self._lock:
+            self._parts.append(batch)
+
+    def batches(self):
+        """尚未寫入的當日批次"""
+        with self._lock:
+            return [part for part in self._parts if not isinstance(part, dict)]
+
+    def merge(self, other):
+        """把另一個寫入器尚未寫入的內容接在後面"""
+        with self._lock:
+            self._parts.extend(other._parts)
+            self.sources.extend(other.sources)
+            other._parts = []
+            other.sources = []
+
+    def rows(self):
+        """尚未寫入的筆數（當日批次以資料筆數計）"""
+        with self._lock:
+            parts = list(self._parts)
+        return sum(sum(len(lines) for lines in part.values()) if isinstance(part, dict) else len(part)
+                   for part in parts)
+
+    @staticmethod
+    def _collect(parts):
+        """把各部分依順序合併成 {路徑: [行...]}，當日批次在這裡才轉成文字"""
+        pending = {}
+        for part in parts:
+            if isinstance(part, dict):
+                for path, lines in part.items():
+                    pending.setdefault(path, []).extend(lines)
+            else:
+                for path, line in part.lines():
+                    pending.setdefault(path, []).append(line)
+        return pending
+
+    def flush(self):
+        """把累積的內容附加到各檔案，回傳寫入的檔案數
+
+        寫入的位元組數記在 flushed_bytes，寫入的內容 {路徑: [行...]} 留在 last_flush 供產生異動檔
+        每個檔案在「檢查結尾、附加」期間持有該檔案的跨程序鎖 (filelock.locked)，其他程序同時寫入同一檔案時會等待
+        """
+        import filelock
+        import date_index
+        import bars
+        with self._lock:
+            parts, self._parts = self._parts, []
+        pending = self._collect(parts)
+        self.last_flush = pending
+
+        self.flushed_bytes = 0
+        written = []
+        with filelock.writer():
+            for path, lines in pending.items():
+                directory = os.path.dirname(path)
+                if directory and not os.path.exists(directory):
+                    os.makedirs(directory, exist_ok=True)
+                # 與文字模式寫入相同：換行符號依作業系統轉換（Windows為\r\n）
+                data = ''.join(lines).replace('\n', os.linesep).encode('utf-8')
+                with filelock.locked(path), open(path, 'ab+') as f:
+                    # 舊檔案最後沒有換行時先補上，避免兩筆資料黏在同一行
+                    size = f.seek(0, os.SEEK_END)
+                    offset = size
+                    if size > 0:
+                        f.seek(size - 1)
+                        if f.read(1) != b'\n':
+                            data = os.linesep.encode('utf-8') + data
+                            offset += len(os.linesep)
+                    f.write(data)
+                written.append((path, offset, lines))
+                self.flushed_bytes += len(data)
+            # 依寫入位置更新日期索引，讀取某日資料時可以直接跳到該位置
+            date_index.add(written)
+            # 週K/月K只改寫最後一期（見 bars.py）
+            bars.add(written)
+            # 技術指標每個代號只推進一天（見 indicators.py）；有個股行情時才載入（需要numpy）
+            if any(os.path.basename(os.path.dirname(path)) == 'txt' for path, _, _ in written):
+                import indicators
+                indicators.add(written)
+        return len(pending)
+
+
+def batched(func):
+    """處理函數未指定writer時，自動建立批次寫入器並在函數結束後寫入檔案"""
+    @functools.wraps(func)
+    def wrapper(*args, writer=None, **kwargs):
+        if writer is not None:
+            return func(*args, writer=writer, **kwargs)
+        import metrics
+        import raw_manifest
+        import delta
+        import filelock
+        key, date_str, digest, unchanged = (raw_manifest.check(args[0]) if args and isinstance(args[0], str)
+                                            else (None, None, None, False))
+        if unchanged:
+            log(f"{os.path.basename(args[0])} 內容與已處理的版本相同，略過處理")
+            metrics.record(key, date_str, 'dedupe', unchanged=1)
+            return None
+        writer = BatchWriter()
+        # 解析失敗時不寫入任何內容：寫入一部分又沒登記雜湊的話，重新執行會再附加一次相同的行
+        result = func(*args, writer=writer, **kwargs)
+        with filelock.writer():
+            # 只有個股行情需要檢查（validation 會載入numpy，其他資料集不必載入）
+            if key and SOURCES[key]['dataset'] == 'quotes':
+                import validation
+                validation.validate_writer(SOURCES[key]['dataset'], date_str, writer)
+            rows = writer.rows()
+            started = time.perf_counter()
+            files = writer.flush()
+            metrics.record(key or func.__name__, date_str, 'write', time.perf_counter() - started,
+                           files=files, rows=rows, bytes=writer.flushed_bytes)
+            if key:
+                delta.record(SOURCES[key]['dataset'], date_str, writer.last_flush)
+            if digest:
+                raw_manifest.mark_processed(key, date_str, digest)
+        return result
+    return wrapper
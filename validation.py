@@ -0,0 +1,352 @@
+import os
+import csv
+import time
+import argparse
+import threading
+import numpy as np
+import stock_common
+import records
+import metrics
+import filelock
+import security_master
+
+# 檢查模式（環境變數 STOCK_VALIDATE）：quarantine 可疑資料不寫入並列入報告、report 只列入報告、0 不檢查
+MODES = ('quarantine', 'report', '0')
+
+# 漲跌幅限制與誤差（漲跌停價依升降單位取整，實際幅度可能略超過10%）
+PRICE_LIMIT = float(os.environ.get('STOCK_PRICE_LIMIT', '0.10'))
+LIMIT_TOLERANCE = 0.005
+
+# 新上市（櫃）前5個交易日沒有漲跌幅限制
+NEW_LISTING_DAYS = 5
+
+# 成交量為前一日的幾倍以上視為異常；只檢查前一日至少有 VOLUME_BASE 張的代號（冷門股由1張變100張是常態）
+VOLUME_SPIKE = 100
+VOLUME_BASE = 100
+
+# 只有這些原因會隔離（不寫入）；漲跌幅與成交量可能是正常的市場狀況（除權息、新上市、追蹤國外指數的ETF），只列入報告
+QUARANTINE_REASONS = ('ohlc',)
+
+# 前一日收盤價、成交量表（輸出根目錄下 master/last_quotes.csv）
+LAST_FILE = 'last_quotes.csv'
+
+REPORT_FIELDS = ['code', 'reasons', 'prev_date', 'prev_close', 'prev_volume',
+                 'open', 'high', 'low', 'close', 'volume', 'path', 'line']
+
+_tables = {}
+_tables_lock = threading.Lock()
+_actions = {}    # 除權息清單路徑 -> (修改時間, {代號: [(除權息日, 因子), ...]})
+
+
+def mode():
+    value = os.environ.get('STOCK_VALIDATE', 'quarantine')
+    if value not in MODES:
+        raise ValueError(f"STOCK_VALIDATE 必須是 {', '.join(MODES)}")
+    return value
+
+
+def quarantine_path(date_str):
+    return os.path.join(stock_common.output_dir('quarantine'), f"{date_str}.csv")
+
+
+class LastQuotes:
+    """每個代號最近一個交易日的收盤價、成交量與已有的交易日數（最多記到 NEW_LISTING_DAYS）
+
+    以 records.CODES 的編號為索引存在numpy陣列中，檢查時整批直接取值，不讀個股歷史檔案。
+
+    參數:
+        path: 檔案路徑，預設 D:/stock/master/last_quotes.csv
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(stock_common.output_dir('master'), LAST_FILE)
+        self.date = np.zeros(0, dtype=np.int64)
+        self.close = np.zeros(0, dtype=np.float64)
+        self.volume = np.zeros(0, dtype=np.int64)
+        self.days = np.zeros(0, dtype=np.int64)
+        self._lock = threading.Lock()
+        self._merge_file(newer_only=False)
+
+    def _merge_file(self, newer_only=True):
+        """讀入檔案中的資料；newer_only 時只取日期比記憶體中新的代號（其他程序寫入的較新資料）"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8', newline='') as f:
+            entries = list(csv.DictReader(f))
+        ids = np.array([records.CODES.intern(entry['code']) for entry in entries], dtype=np.int64)
+        dates = np.array([int(entry['date']) for entry in entries], dtype=np.int64)
+        self._ensure(len(records.CODES))
+        keep = dates > self.date[ids] if newer_only else np.ones(len(ids), dtype=bool)
+        entries = [entry for entry, kept in zip(entries, keep) if kept]
+        ids = ids[keep]
+        self.date[ids] = dates[keep]
+        self.close[ids] = [float(entry['close']) for entry in entries]
+        self.volume[ids] = [int(entry['volume']) for entry in entries]
+        # 舊版檔案沒有 days 欄，視為已上市一段時間
+        self.days[ids] = [int(entry.get('days') or NEW_LISTING_DAYS) for entry in entries]
+
+    def _ensure(self, size):
+        """代號表變大時把陣列加長（新代號的日期為0，代表沒有前一日資料）"""
+        extra = size - len(self.date)
+        if extra > 0:
+            self.date = np.concatenate([self.date, np.zeros(extra, dtype=np.int64)])
+            self.close = np.concatenate([self.close, np.zeros(extra, dtype=np.float64)])
+            self.volume = np.concatenate([self.volume, np.zeros(extra, dtype=np.int64)])
+            self.days = np.concatenate([self.days, np.zeros(extra, dtype=np.int64)])
+
+    def lookup(self, ids):
+        """回傳 (日期, 收盤價, 成交量, 交易日數) 陣列"""
+        with self._lock:
+            self._ensure(len(records.CODES))
+            return self.date[ids], self.close[ids], self.volume[ids], self.days[ids]
+
+    def update(self, ids, date_int, close, volume):
+        """記錄某日的收盤價與成交量（已有更新日期的代號不覆蓋）"""
+        with self._lock:
+            self._ensure(len(records.CODES))
+            newer = self.date[ids] <= date_int
+            ids = ids[newer]
+            self.days[ids] = np.minimum(self.days[ids] + (self.date[ids] < date_int), NEW_LISTING_DAYS)
+            self.date[ids] = date_int
+            self.close[ids] = close[newer]
+            self.volume[ids] = volume[newer]
+
+    def save(self):
+        """寫回檔案；其他程序在這段期間寫入的較新日期會先併入，不會被覆蓋"""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with filelock.locked(self.path), self._lock:
+            self._merge_file()
+            ids = np.nonzero(self.date)[0]
+            rows = [(records.CODES.code(code_id), int(self.date[code_id]), repr(float(self.close[code_id])),
+                     int(self.volume[code_id]), int(self.days[code_id])) for code_id in ids]
+            with open(self.path + '.tmp', 'w', encoding='utf-8', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['code', 'date', 'close', 'volume', 'days'])
+                writer.writerows(sorted(rows))
+            os.replace(self.path + '.tmp', self.path)
+
+
+def last_quotes():
+    """取得目前輸出根目錄的前一日表（第一次使用時載入）"""
+    path = os.path.join(stock_common.output_dir('master'), LAST_FILE)
+    with _tables_lock:
+        table = _tables.get(path)
+        if table is None:
+            table = _tables[path] = LastQuotes(path)
+        return table
+
+
+def ex_rights():
+    """除權息清單 {代號: [(除權息日, 因子), ...]}（adjust.py 維護，檔案有變動時重新讀取）"""
+    import adjust
+    path = adjust.actions_path()
+    try:
+        stamp = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return {}
+    with _tables_lock:
+        cached = _actions.get(path)
+        if cached is None or cached[0] != stamp:
+            cached = _actions[path] = (stamp, adjust.load_actions(path))
+        return cached[1]
+
+
+def reference_prices(ids, prev_date, prev_close, date_int, actions):
+    """漲跌幅的參考價：前一日收盤價，期間有除權息時乘上除權息因子（因子 = 除權息參考價 / 前一日收盤價）"""
+    reference = prev_close.copy()
+    if not actions:
+        return reference
+    for row, code_id in enumerate(ids.tolist()):
+        events = actions.get(records.CODES.code(code_id))
+        if events:
+            for date_str, factor in events:
+                if prev_date[row] < int(date_str) <= date_int:
+                    reference[row] *= factor
+    return reference
+
+
+def batch_prices(batch):
+    """把當日行情批次的開高低收轉成 (筆數, 4) 的浮點陣列，成交量為整數陣列"""
+    size = len(batch)
+    digits = np.stack([np.frombuffer(column, dtype=np.int64, count=size) for column in batch.columns[:4]], axis=1)
+    decimals = np.stack([np.frombuffer(column, dtype=np.int8, count=size) for column in batch.decimals], axis=1)
+    prices = digits / np.power(10.0, np.maximum(decimals, 0))
+    for (row, field), text in batch.raw.items():
+        prices[row, field] = float(text)
+    volume = np.frombuffer(batch.columns[4], dtype=np.int64, count=size)
+    return prices, volume
+
+
+def check(batch, date_str, table, actions=None):
+    """整批檢查當日行情
+
+    參數:
+        actions: 除權息清單（見 ex_rights），有除權息的代號以除權息參考價檢查漲跌幅
+
+    回傳:
+        (代號編號陣列, 價格陣列, 成交量陣列, 前一日資料, {筆號: [原因...]})
+        原因: ohlc（開高低收不一致）、limit（超過漲跌幅限制）、volume（成交量暴增）
+    """
+    size = len(batch)
+    ids = np.frombuffer(batch.codes, dtype=np.int32, count=size).astype(np.int64)
+    prices, volume = batch_prices(batch)
+    prev_date, prev_close, prev_volume, prev_days = table.lookup(ids)
+    date_int = int(date_str)
+
+    o, h, l, c = prices[:, 0], prices[:, 1], prices[:, 2], prices[:, 3]
+    flags = {
+        'ohlc': (prices <= 0).any(axis=1) | (h < np.maximum(o, c)) | (l > np.minimum(o, c)),
+    }
+    # 只和更早日期的收盤價比較（同日重跑或補舊日期時不檢查漲跌幅）
+    has_prev = (prev_date > 0) & (prev_date < date_int) & (prev_close > 0)
+    reference = reference_prices(ids, prev_date, prev_close, date_int, actions)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        move = np.maximum(np.abs(h / reference - 1), np.abs(l / reference - 1))
+    # 新上市（櫃）前幾個交易日沒有漲跌幅限制
+    flags['limit'] = has_prev & (prev_days >= NEW_LISTING_DAYS) & (move > PRICE_LIMIT + LIMIT_TOLERANCE)
+    flags['volume'] = has_prev & (prev_volume >= VOLUME_BASE) & (volume >= VOLUME_SPIKE * prev_volume)
+
+    flagged = {}
+    for reason, mask in flags.items():
+        for row in np.nonzero(mask)[0]:
+            # ETF 可能追蹤國外指數，沒有漲跌幅限制
+            if reason == 'limit' and security_master.classify(records.CODES.code(int(ids[row]))) == 'etf':
+                continue
+            flagged.setdefault(int(row), []).append(reason)
+    return ids, prices, volume, (prev_date, prev_close, prev_volume), flagged
+
+
+def write_report(date_str, entries):
+    """把可疑資料附加到隔離報告 D:/stock/quarantine/{日期}.csv"""
+    path = quarantine_path(date_str)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with filelock.locked(path), open(path, 'a', encoding='utf-8', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+        if f.tell() == 0:
+            writer.writeheader()
+        writer.writerows(entries)
+
+
+def validate_batch(batch, date_str, table=None, action=None):
+    """檢查一個當日行情批次並更新前一日表
+
+    參數:
+        batch: records.QuoteBatch
+        date_str: 日期字串 (YYYYMMDD格式)
+        table: 前一日表，預設為目前輸出根目錄的表
+        action: quarantine / report，預設依 STOCK_VALIDATE
+
+    回傳:
+        可疑的筆數（quarantine時其中原因屬於 QUARANTINE_REASONS 的筆已從批次移除）
+    """
+    table = table or last_quotes()
+    action = action or mode()
+    if not len(batch):
+        return 0
+    ids, prices, volume, (prev_date, prev_close, prev_volume), flagged = check(batch, date_str, table, ex_rights())
+    if flagged:
+        date = records.taiwan_date(date_str)
+        entries = []
+        for row, reasons in sorted(flagged.items()):
+            o, h, l, c, vol = batch.values(row)
+            entries.append({'code': records.CODES.code(int(ids[row])), 'reasons': '+'.join(reasons),
+                            'prev_date': int(prev_date[row]) or '', 'prev_close': float(prev_close[row]) or '',
+                            'prev_volume': int(prev_volume[row]), 'open': o, 'high': h, 'low': l, 'close': c,
+                            'volume': vol, 'path': batch.path(row), 'line': batch.format_row(row, date).rstrip('\n')})
+        write_report(date_str, entries)
+    if flagged and action == 'quarantine':
+        removed = {row: reasons for row, reasons in flagged.items()
+                   if any(reason in QUARANTINE_REASONS for reason in reasons)}
+        if removed:
+            batch.remove(removed)
+    # 隔離的筆也記錄收盤價：真的跳空（例如除權息）後，之後每天都和舊的收盤價比較會一直被列為可疑
+    table.update(ids, int(date_str), prices[:, 3], volume)
+    return len(flagged)
+
+
+def validate_writer(dataset, date_str, writer):
+    """寫入前檢查寫入器中的當日行情批次（只檢查個股行情），回傳可疑的筆數"""
+    if dataset != 'quotes' or mode() == '0':
+        return 0
+    started = time.perf_counter()
+    table = last_quotes()
+    flagged = rows = 0
+    for batch in writer.batches():
+        if isinstance(batch, records.QuoteBatch):
+            rows += len(batch)
+            flagged += validate_batch(batch, date_str, table)
+    if rows:
+        table.save()
+        metrics.record(dataset, date_str, 'validate', time.perf_counter() - started, rows=rows, quarantined=flagged)
+        if flagged:
+            print(f"{date_str} 有 {flagged} 筆可疑行情，已列入 {quarantine_path(date_str)}")
+    return flagged
+
+
+def release(date_str, codes=None):
+    """把隔離報告中的資料寫入個股檔案（確認資料正確時使用），回傳放行的筆數
+
+    與補缺漏相同，依日期順序插入（見 repair.insert），已寫入的日期（只列入報告的筆）不重複寫入；
+    放行的收盤價也記入前一日表。
+
+    參數:
+        date_str: 日期字串 (YYYYMMDD格式)
+        codes: 只寫入這些代號，None為全部
+    """
+    import repair
+    path = quarantine_path(date_str)
+    if not os.path.exists(path):
+        return 0
+    with filelock.writer():
+        with filelock.locked(path), open(path, 'r', encoding='utf-8', newline='') as f:
+            entries = list(csv.DictReader(f))
+        remaining = []
+        released = []
+        for entry in entries:
+            (remaining if codes and entry['code'] not in codes else released).append(entry)
+        repair.insert({entry['code']: {date_str: entry['line'] + '\n'} for entry in released}, 'quotes')
+        if released:
+            table = last_quotes()
+            ids = np.array([records.CODES.intern(entry['code']) for entry in released], dtype=np.int64)
+            table.update(ids, int(date_str), np.array([float(entry['close']) for entry in released]),
+                         np.array([int(entry['volume']) for entry in released], dtype=np.int64))
+            table.save()
+        # 讀取後其他程序附加的項目也要保留
+        with filelock.locked(path):
+            with open(path, 'r', encoding='utf-8', newline='') as f:
+                remaining.extend(list(csv.DictReader(f))[len(entries):])
+            with open(path + '.tmp', 'w', encoding='utf-8', newline='') as f:
+                report = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+                report.writeheader()
+                report.writerows(remaining)
+            os.replace(path + '.tmp', path)
+    return len(entries) - len(remaining)
+
+
+def main():
+    """主程式"""
+    parser = argparse.ArgumentParser(description='行情異常檢查：查看隔離報告或放行')
+    sub = parser.add_subparsers(dest='command', required=True)
+    show = sub.add_parser('show', help='列出某日被隔離的資料')
+    show.add_argument('date')
+    allow = sub.add_parser('release', help='確認無誤後寫入個股檔案')
+    allow.add_argument('date')
+    allow.add_argument('codes', nargs='*', help='只放行這些代號，省略為全部')
+    args = parser.parse_args()
+
+    if args.command == 'show':
+        path = quarantine_path(args.date)
+        if not os.path.exists(path):
+            print(f"{args.date} 沒有被隔離的資料")
+            return
+        with open(path, 'r', encoding='utf-8', newline='') as f:
+            for entry in csv.DictReader(f):
+                print(f"{entry['code']:8s} {entry['reasons']:18s} 前收 {entry['prev_close'] or '-':>10} "
+                      f"開高低收 {entry['open']}/{entry['high']}/{entry['low']}/{entry['close']} "
+                      f"量 {entry['volume']} (前 {entry['prev_volume']})")
+    else:
+        print(f"已寫入 {release(args.date, args.codes)} 筆")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+import os
+import sys
+import json
+import socket
+import argparse
+import threading
+from datetime import datetime
+
+# 常駐工作程序：啟動時先載入各資料集腳本、連線池、證券主檔與前一日收盤價表，
+# 之後 python worker.py <工作> 只把工作經本機socket送過去執行，不必每次重新載入 requests / numpy / pandas
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = int(os.environ.get('STOCK_WORKER_PORT', '8766'))
+
+# 用戶端連線的等待秒數，逾時（沒有常駐程序）時改在本程序執行
+CONNECT_TIMEOUT = 0.5
+
+# 可執行的工作：
+#   run DATASET [日期]          下載並處理某資料集某日（同各腳本的 run）
+#   poll DATASET [日期]         輪詢到交易所發布後立即處理（見 poller.py）
+#   process KEY [日期]          重新處理一個已下載的原始檔（例如 index_5sec）
+#   refresh CODE START [END]    以個股月資料補抓單一代號（見 repair.py）
+#   world                       國際指數
+#   adjust [START] [END]        除權息資料（見 adjust.py）
+#   ping                        回傳常駐程序的程序編號
+JOBS = ('run', 'poll', 'process', 'refresh', 'world', 'adjust', 'ping')
+
+# 各工作至少需要的參數個數
+REQUIRED_ARGS = {'run': 1, 'poll': 1, 'process': 1, 'refresh': 2}
+
+# 同一時間只執行一個工作（工作的輸出整段轉送給送出工作的用戶端）
+_job_lock = threading.Lock()
+
+
+def run_job(job, args):
+    """執行一個工作，回傳可轉成JSON的結果；重量級套件都在這裡才載入"""
+    if len(args) < REQUIRED_ARGS.get(job, 0):
+        raise ValueError(f"{job} 需要 {REQUIRED_ARGS[job]} 個參數")
+    import stock_common
+    date_str = args[1] if len(args) > 1 else datetime.now().strftime('%Y%m%d')
+    if job == 'ping':
+        return os.getpid()
+    if job == 'run':
+        return stock_common.load_script(args[0]).run(date_str)
+    if job == 'poll':
+        import poller
+        return poller.poll_dataset(args[0], date_str)
+    if job == 'process':
+        import poller
+        poller.process_source(args[0], date_str, stock_common.find_raw(args[0], date_str))
+        return True
+    if job == 'refresh':
+        import repair
+        import pipeline
+        import metrics
+        result = repair.repair({args[0]: pipeline.weekdays(args[1], args[2] if len(args) > 2 else args[1])})
+        metrics.emit()
+        return result
+    if job == 'adjust':
+        import adjust
+        import metrics
+        changed = adjust.update(args[0] if args else date_str, args[1] if len(args) > 1 else None)
+        metrics.emit()
+        return sorted(changed)
+    if job == 'world':
+        _, errors = stock_common.load_script('world').start_data_collection()
+        return not errors
+    raise ValueError(f"未知的工作: {job}（可用 {', '.join(JOBS)}）")
+
+
+def preload():
+    """常駐程序啟動時先載入所有腳本與常用資料，之後的工作直接使用"""
+    import stock_common
+    import security_master
+    import validation
+    import poller
+    import repair
+    import urllib3
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    for dataset in stock_common.SCRIPTS:
+        stock_common.load_script(dataset)
+    for name in ('pandas', 'yfinance'):
+        try:
+            __import__(name)
+        except ImportError:
+            print(f"未安裝 {name}，國際指數工作執行時會失敗")
+    stock_common.get_session()
+    security_master.load()
+    if validation.mode() != '0':
+        validation.last_quotes()
+
+
+class _Output:
+    """把工作印出的文字逐段送回用戶端（用戶端已離開時丟棄，工作繼續執行）"""
+
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self._lock = threading.Lock()
+
+    def write(self, text):
+        if text:
+            with self._lock:
+                try:
+                    self.wfile.write((json.dumps({'out': text}, ensure_ascii=False) + '\n').encode('utf-8'))
+                except OSError:
+                    pass
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+def serve(host=DEFAULT_HOST, port=DEFAULT_PORT):
+    """啟動常駐工作程序（阻塞到 Ctrl+C）"""
+    import contextlib
+    import traceback
+    import socketserver
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            request = json.loads(self.rfile.readline() or b'{}')
+            job, args = request.get('job'), request.get('args', [])
+            with _job_lock:
+                print(f"{datetime.now().strftime('%H:%M:%S')} 開始工作: {job} {' '.join(args)}")
+                try:
+                    with contextlib.redirect_stdout(_Output(self.wfile)):
+                        reply = {'ok': True, 'result': run_job(job, args)}
+                except Exception as e:
+                    traceback.print_exc()
+                    reply = {'ok': False, 'error': str(e)}
+            try:
+                self.wfile.write((json.dumps(reply, ensure_ascii=False, default=str) + '\n').encode('utf-8'))
+            except OSError:
+                pass
+
+    started = datetime.now()
+    preload()
+    server = socketserver.ThreadingTCPServer((host, port), Handler)
+    server.daemon_threads = True
+    print(f"常駐工作程序啟動: {host}:{port}（載入 {(datetime.now() - started).total_seconds():.1f} 秒）")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("常駐工作程序停止")
+    finally:
+        server.server_close()
+
+
+def submit(job, args, host=DEFAULT_HOST, port=DEFAULT_PORT):
+    """把工作送到常駐程序並轉印輸出
+
+    回傳:
+        {'ok': ..., 'result' / 'error': ...}；沒有常駐程序時回傳None
+    """
+    try:
+        sock = socket.create_connection((host, port), timeout=CONNECT_TIMEOUT)
+    except OSError:
+        return None
+    with sock:
+        sock.settimeout(None)
+        sock.sendall((json.dumps({'job': job, 'args': args}) + '\n').encode('utf-8'))
+        for line in sock.makefile('r', encoding='utf-8'):
+            message = json.loads(line)
+            if 'out' in message:
+                sys.stdout.write(message['out'])
+                continue
+            return message
+    return {'ok': False, 'error': '常駐程序中斷連線'}
+
+
+def main():
+    """主程式"""
+    parser = argparse.ArgumentParser(description='常駐工作程序：預先載入腳本與套件，排程的短工作送過來直接執行')
+    parser.add_argument('job', choices=('serve',) + JOBS, help='serve 啟動常駐程序，其他為要執行的工作')
+    parser.add_argument('args', nargs='*', help='工作參數（資料集/來源/代號、日期）')
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--local', action='store_true', help='不送到常駐程序，直接在本程序執行')
+    args = parser.parse_args()
+
+    if args.job == 'serve':
+        serve(args.host, args.port)
+        return
+    reply = None if args.local else submit(args.job, args.args, args.host, args.port)
+    if reply is None:
+        try:
+            reply = {'ok': True, 'result': run_job(args.job, args.args)}
+        except Exception as e:
+            reply = {'ok': False, 'error': str(e)}
+    if not reply['ok']:
+        print(f"工作失敗: {reply['error']}")
+    sys.exit(0 if reply['ok'] and reply['result'] is not False else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,16 @@
-import pandas as pd
 from datetime import datetime, timedelta
 import os
-import yfinance as yf
 import time
 import random
 import csv
+import stock_common
 
 def get_ticker_data(ticker, start_date, end_date, retry_count=3, delay=10):
     """
     獲取單一股票代碼數據，含重試機制
     """
+    # yfinance / pandas 載入很慢，只在實際下載時才載入（process_csv_file 只需要 csv）
+    import yfinance as yf
     for attempt in range(retry_count):
         try:
             # 加入超時設定
@@ -35,6 +36,7 @@ def get_ticker_data(ticker, start_date, end_date, retry_count=3, delay=10):
     return None  # 所有重試都失敗
 
 def get_financial_data():
+    import pandas as pd
     # 設定日期範圍（只取當天）
     end_date = datetime.now()
     start_date = end_date - timedelta(days=5)  # 修改為獲取最近5天的數據，增加獲取成功機率
@@ -92,7 +94,7 @@ def get_financial_data():
     
     print("\n正在獲取數據...")
     for name, ticker in bonds.items():
-        print(f"  處理 {name} ({ticker})...")
+        stock_common.log(f"  處理 {name} ({ticker})...")
         # 隨機延遲 1-3 秒，避免請求過於頻繁
         time.sleep(random.uniform(1, 3))
         
@@ -109,7 +111,7 @@ def get_financial_data():
             latest_high = latest_data['High']*10
             latest_low = latest_data['Low']*10
             latest_date = data.index[-1].strftime('%Y-%m-%d')
-            print(f"  {name}: 開:{latest_open:.2f} 高:{latest_high:.2f} 低:{latest_low:.2f} 收:{latest_close:.2f}")
+            stock_common.log(f"  {name}: 開:{latest_open:.2f} 高:{latest_high:.2f} 低:{latest_low:.2f} 收:{latest_close:.2f}")
             
             # 將數據添加到結果DataFrame
             all_results_df = pd.concat([all_results_df, pd.DataFrame({
@@ -161,7 +163,8 @@ def get_financial_data():
     return {"data": all_results_df, "errors": errors}  # 返回字典
 
 #資料切割
-def process_csv_file(csv_file_path, output_directory):
+@stock_common.batched
+def process_csv_file(csv_file_path, output_directory, writer=None):
     # 確保輸出目錄存在
     if not os.path.exists(output_directory):
         os.makedirs(output_directory)
@@ -189,11 +192,10 @@ def process_csv_file(csv_file_path, output_directory):
                 # 創建輸出行，格式: "日期","開盤","最高","最低","收盤","成交量(固定為1000)"
                 output_line = f'"{update_date}","{open_price}","{high_price}","{low_price}","{close_price}","1000"\n'
                 
-                # 寫入到對應的文件
-                with open(output_file_path, 'a', encoding='utf-8') as output_file:
-                    output_file.write(output_line)
+                # 加入批次寫入，全部處理完後一次寫入
+                writer.append(output_file_path, output_line)
                 
-                print(f"已處理 {index_name}，寫入到 {output_file_path}")
+                stock_common.log(f"已處理 {index_name}，寫入到 {output_file_path}")
 
 def start_data_collection():
     """啟動數據收集主函數，含錯誤處理"""
@@ -215,7 +217,7 @@ def start_data_collection():
             # 獲取當前日期作為目錄名稱
             date_folder = datetime.now().strftime("%Y%m%d")
             csv_file_path = os.path.join(date_folder, "worldindex.csv")
-            output_directory = "D:/stock/txt"  # 你的輸出目錄
+            output_directory = stock_common.output_dir('txt')  # 你的輸出目錄
             
             # 調用 process_csv_file 處理數據並寫入文件
             try:
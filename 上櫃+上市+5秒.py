@@ -1,18 +1,24 @@
-import requests
-import urllib3
 import os
-import urllib.parse
 from datetime import datetime
 import csv
 import io
+import time
+from collections import Counter
+import stock_common
+import json_decode
+import metrics
+import records
+import security_master
 
-def download(date_str=None):
+def download(date_str=None, session=None):
     """下載台灣股市資料（上市、上櫃、大盤五秒）
     
     參數:
         date_str: 日期字串 (YYYYMMDD格式)，若為None則使用當天日期
+        session: 共用的連線池 (requests.Session)，未指定時每個檔案各自連線
     """
-    # 禁用SSL驗證警告
+    # 禁用SSL驗證警告（requests/urllib3 到下載時才載入，只處理已下載的原始檔時不需要）
+    import urllib3
     urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
     # 如果未提供日期，使用當天日期
@@ -20,12 +26,7 @@ def download(date_str=None):
         today = datetime.now()
         date_str = today.strftime('%Y%m%d')
     
-    print(f"下載日期: {date_str}")
-
-    # 獲取櫃買中心所需的格式化日期
-    formatted_date = f"{date_str[:4]}/{date_str[4:6]}/{date_str[6:8]}"
-    encoded_date = urllib.parse.quote(formatted_date)  # URL編碼
-    print(f"格式化日期: {formatted_date}, 編碼: {encoded_date}")
+    stock_common.log(f"下載日期: {date_str}")
 
     # 設定保存目錄和檔名 - 使用相對路徑
     # 獲取當前腳本所在目錄
@@ -35,62 +36,60 @@ def download(date_str=None):
     date_folder = os.path.join(current_dir, date_str)
     if not os.path.exists(date_folder):
         os.makedirs(date_folder)
-        print(f"創建日期資料夾: {date_folder}")
-
-    # 1. 下載上櫃資料
-    print("開始下載上櫃資料...")
-    otc_save_path = os.path.join(date_folder, f'櫃買_{date_str}.csv')
-    otc_url = f"https://www.tpex.org.tw/www/zh-tw/afterTrading/dailyQuotes?date={encoded_date}&id=&response=csv"
-    download_file(otc_url, otc_save_path, "上櫃")
+        stock_common.log(f"創建日期資料夾: {date_folder}")
 
-    # 2. 下載大盤五秒資料
-    print("開始下載大盤五秒資料...")
-    index_save_path = os.path.join(date_folder, f'大盤5秒_{date_str}.csv')
-    index_url = f"https://www.twse.com.tw/rwd/zh/TAIEX/MI_5MINS_INDEX?date={date_str}&response=csv"
-    download_file(index_url, index_save_path, "大盤五秒")
+    # 依序下載各來源資料（網址與檔名定義在 stock_common.SOURCES）
+    for key in stock_common.dataset_sources('quotes'):
+        label = stock_common.SOURCES[key]['label']
+        stock_common.log(f"開始下載{label}資料...")
+        save_path = stock_common.source_path(key, date_str)
+        download_file(stock_common.source_url(key, date_str), save_path, label, session)
 
-    # 3. 下載上市資料
-    print("開始下載上市資料...")
-    twse_save_path = os.path.join(date_folder, f'上市_{date_str}.csv')
-    twse_url = f"https://www.twse.com.tw/rwd/zh/afterTrading/MI_INDEX?date={date_str}&type=ALLBUT0999&response=csv"
-    download_file(twse_url, twse_save_path, "上市")
-
-    print("所有資料下載完成")
+    stock_common.log("所有資料下載完成")
     return date_folder
 
 
-def download_file(url, save_path, file_type):
+def download_file(url, save_path, file_type, session=None):
     """下載檔案並儲存
     
     參數:
         url: 下載連結
         save_path: 儲存路徑
         file_type: 檔案類型描述（用於日誌顯示）
+        session: 共用的連線池 (requests.Session)，未指定時每次建立新連線
+
+    回傳:
+        下載成功且檔案大小正常時回傳True
     """
+    import requests
     try:
-        print(f"下載{file_type}資料，URL: {url}")
+        stock_common.log(f"下載{file_type}資料，URL: {url}")
         # 設定請求標頭和超時
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8'
-        }
-    
-        response = requests.get(url, headers=headers, verify=False, timeout=20)
-        print(f"{file_type}資料請求完成，狀態碼: {response.status_code}")
+        key, date_str = stock_common.source_of(save_path)
+        started = time.perf_counter()
+        # stream=True 時收到回應標頭就返回：前段為連線+等待首位元組，後段為下載內容
+        response = (session or requests).get(url, headers=stock_common.HEADERS, verify=False, timeout=20, stream=True)
+        ttfb = time.perf_counter() - started
+        content = response.content
+        metrics.record(key, date_str, 'http_ttfb', ttfb, status=response.status_code)
+        metrics.record(key, date_str, 'http_body', time.perf_counter() - started - ttfb, bytes=len(content))
+        stock_common.log(f"{file_type}資料請求完成，狀態碼: {response.status_code}")
 
         # 檢查是否成功
         if response.status_code == 200:
             # 保存檔案
             with open(save_path, 'wb') as f:
-                f.write(response.content)
-            print(f"已下載{file_type}資料到: {save_path}")
+                f.write(content)
+            stock_common.log(f"已下載{file_type}資料到: {save_path}")
 
             # 檢查檔案大小
             file_size = os.path.getsize(save_path)
-            print(f"{file_type}檔案大小: {file_size} 字節")
+            stock_common.log(f"{file_type}檔案大小: {file_size} 字節")
             
-            if file_size < 100:
+            if file_size < stock_common.MIN_RAW_SIZE:
                 print(f"警告: {file_type}檔案大小異常小，請檢查內容是否正確")
+                return False
+            return True
         else:
             print(f"{file_type}資料下載失敗，狀態碼: {response.status_code}")
             print(f"回應內容: {response.text[:500]}")
@@ -100,66 +99,90 @@ def download_file(url, save_path, file_type):
         print(f"{file_type}資料下載出現SSL錯誤: {e}")
     except Exception as e:
         print(f"{file_type}資料下載時發生錯誤: {str(e)}")
+    return False
 
 
-def process_stock_data(csv_file_path, date_str, is_otc=False):
+@stock_common.batched
+def process_stock_data(csv_file_path, date_str, is_otc=False, writer=None):
     """處理台灣股市資料函數
     
     參數:
         csv_file_path: CSV檔案路徑
         date_str: 日期字串 (YYYYMMDD格式)
         is_otc: 是否為上櫃資料 (預設False為上市資料)
+        writer: 批次寫入器，未指定時處理完畢後直接寫入檔案
     """
-    print(f"開始處理{'上櫃' if is_otc else '上市'}公司資料，檔案: {csv_file_path}")
+    stock_common.log(f"開始處理{'上櫃' if is_otc else '上市'}公司資料，檔案: {csv_file_path}")
     
     # 確保目標目錄存在
-    target_dir = "D:/stock/txt"
+    target_dir = stock_common.output_dir('txt')
     if not os.path.exists(target_dir):
         os.makedirs(target_dir)
-        print(f"創建目標目錄: {target_dir}")
-    
-    # 嘗試不同的編碼讀取CSV文件內容
-    encodings_to_try = ['big5', 'cp950', 'utf-8-sig', 'utf-8', 'gbk']
-    lines = None
+        stock_common.log(f"創建目標目錄: {target_dir}")
+    
+    source, _ = stock_common.source_of(csv_file_path)
+    is_json = stock_common.is_json(csv_file_path)
+    if is_json:
+        # JSON格式：欄位名稱與資料列已分開，不需猜測編碼、尋找標題行與去除引號
+        started = time.perf_counter()
+        table = json_decode.read_table(csv_file_path, stock_common.SOURCES[source]['header'])
+        if table is None:
+            print(f"JSON檔案中找不到資料表: {csv_file_path}")
+            return
+        lines = [table[0]] + table[1]
+        metrics.record(source, date_str, 'decode', time.perf_counter() - started,
+                       bytes=os.path.getsize(csv_file_path), rows=len(lines))
+    else:
+        # 嘗試不同的編碼讀取CSV文件內容
+        encodings_to_try = ['big5', 'cp950', 'utf-8-sig', 'utf-8', 'gbk']
+        lines = None
     
-    for encoding in encodings_to_try:
-        try:
-            print(f"嘗試使用 {encoding} 編碼讀取檔案...")
-            with open(csv_file_path, 'r', encoding=encoding) as file:
-                lines = file.readlines()
-                print(f"成功使用 {encoding} 編碼讀取檔案，共 {len(lines)} 行")
-                break  # 如果成功讀取則跳出迴圈
-        except UnicodeDecodeError:
-            print(f"{encoding} 編碼無法讀取檔案")
-        except Exception as e:
-            print(f"使用 {encoding} 編碼讀取時發生錯誤: {str(e)}")
+        started = time.perf_counter()
+        for encoding in encodings_to_try:
+            try:
+                stock_common.log(f"嘗試使用 {encoding} 編碼讀取檔案...")
+                with open(csv_file_path, 'r', encoding=encoding) as file:
+                    lines = file.readlines()
+                    stock_common.log(f"成功使用 {encoding} 編碼讀取檔案，共 {len(lines)} 行")
+                    break  # 如果成功讀取則跳出迴圈
+            except UnicodeDecodeError:
+                stock_common.log(f"{encoding} 編碼無法讀取檔案")
+            except Exception as e:
+                print(f"使用 {encoding} 編碼讀取時發生錯誤: {str(e)}")
     
-    if lines is None:
-        print("所有讀取方式均失敗，無法處理檔案")
-        return
+        if lines is None:
+            print("所有讀取方式均失敗，無法處理檔案")
+            return
+        metrics.record(source, date_str, 'decode', time.perf_counter() - started,
+                       bytes=os.path.getsize(csv_file_path), rows=len(lines))
     
     # 尋找標題行 (上市和上櫃的標題行格式不同)
-    header_idx = -1
-    for i, line in enumerate(lines):
-        if is_otc:  # 上櫃資料
-            if "代號" in line and "名稱" in line and "收盤" in line and "開盤" in line and "最高" in line and "最低" in line:
-                header_idx = i
-                break
-        else:  # 上市資料
-            if "證券代號" in line:
-                header_idx = i
-                break
+    started = time.perf_counter()
+    if is_json:
+        header_idx = 0
+        header_parts = lines[0]
+    else:
+        header_idx = -1
+        for i, line in enumerate(lines):
+            if is_otc:  # 上櫃資料
+                if "代號" in line and "名稱" in line and "收盤" in line and "開盤" in line and "最高" in line and "最低" in line:
+                    header_idx = i
+                    break
+            else:  # 上市資料
+                if "證券代號" in line:
+                    header_idx = i
+                    break
     
-    if header_idx == -1:
-        print(f"無法在CSV文件中找到{'上櫃' if is_otc else '上市'}資料的標題行")
-        return
+        if header_idx == -1:
+            print(f"無法在CSV文件中找到{'上櫃' if is_otc else '上市'}資料的標題行")
+            return
     
-    print(f"找到標題行，行號: {header_idx}")
-    print(f"標題行內容: {lines[header_idx].strip()}")
+        stock_common.log(f"找到標題行，行號: {header_idx}")
+        stock_common.log(f"標題行內容: {lines[header_idx].strip()}")
     
-    # 解析標題行
-    header_parts = lines[header_idx].strip().split(',')
-    header_parts = [part.strip('"') for part in header_parts]
+        # 解析標題行
+        header_parts = lines[header_idx].strip().split(',')
+        header_parts = [part.strip('"') for part in header_parts]
     
     # 尋找需要的列索引
     try:
@@ -185,7 +208,7 @@ def process_stock_data(csv_file_path, date_str, is_otc=False):
             elif "成交股數" in part or "成交量" in part:
                 volume_idx = i
     
-        print(f"欄位索引: 代號({code_idx}) 開盤({open_idx}) 最高({high_idx}) 最低({low_idx}) 收盤({close_idx}) 成交量({volume_idx})")
+        stock_common.log(f"欄位索引: 代號({code_idx}) 開盤({open_idx}) 最高({high_idx}) 最低({low_idx}) 收盤({close_idx}) 成交量({volume_idx})")
         
         # 確認所有需要的列都找到了
         required_indices = [code_idx, open_idx, high_idx, low_idx, close_idx, volume_idx]
@@ -205,25 +228,28 @@ def process_stock_data(csv_file_path, date_str, is_otc=False):
         print(f"處理標題行時出錯: {str(e)}")
         return
     
+    metrics.record(source, date_str, 'header', time.perf_counter() - started, line=header_idx)
+
     # 從標題行後開始處理數據
+    started = time.perf_counter()
     processed_count = 0
-    skipped_count = 0
+    skips = Counter()  # 依原因統計略過的行數
+    batch = records.QuoteBatch(target_dir, date_str)  # 當日批次，整個檔案處理完後每支股票只開檔一次
     
     # 從標題行下一行開始處理每一行數據
     for i in range(header_idx + 1, len(lines)):
-        line = lines[i].strip()
+        line = lines[i] if is_json else lines[i].strip()
         if not line:  # 跳過空行
             continue
         
-        # 使用CSV解析器來正確處理引號和逗號
+        # 使用CSV解析器來正確處理引號和逗號（JSON格式的資料列已是欄位列表）
         try:
-            csv_reader = csv.reader(io.StringIO(line))
-            row = next(csv_reader)
+            row = line if is_json else next(csv.reader(io.StringIO(line)))
             
             # 如果行的元素數量不足，則跳過
             max_idx = max(required_indices)
             if len(row) <= max_idx:
-                skipped_count += 1
+                skips['short_row'] += 1
                 continue
             
             # 獲取公司代碼
@@ -231,7 +257,12 @@ def process_stock_data(csv_file_path, date_str, is_otc=False):
             
             # 忽略非股票代碼格式的行
             if not (company_code.isdigit() or (len(company_code) > 0 and company_code[0].isdigit())):
-                skipped_count += 1
+                skips['not_stock'] += 1
+                continue
+
+            # 略過不需要的商品類別（預設為權證，見 security_master.SKIP_TYPES）
+            if security_master.skipped(company_code):
+                skips['filtered'] += 1
                 continue
                 
             # 獲取價格和成交量數據，移除引號和千分位逗號
@@ -244,70 +275,62 @@ def process_stock_data(csv_file_path, date_str, is_otc=False):
                 
                 # 跳過無效數據
                 if '--' in [open_price, high_price, low_price, close_price] or not volume:
-                    skipped_count += 1
+                    skips['invalid_value'] += 1
                     continue
                 
-                # 轉換成浮點數和整數以驗證（僅驗證，不改變原始字符串）
+                # 轉換成數值存入當日批次（報價保留原本的小數位數，寫入時才轉回文字）
                 try:
-                    float(open_price)
-                    float(high_price)
-                    float(low_price)
-                    float(close_price)
-                    volume = round(int(volume)/1000)
+                    batch.add(company_code, open_price, high_price, low_price, close_price, round(int(volume)/1000))
                 except ValueError:
-                    skipped_count += 1
+                    skips['bad_number'] += 1
                     continue
                 
-                # 準備寫入的數據行
-                taiwan_date = str(int(date_str[:4]) - 1911) + date_str[4:]
-                data_line = f'"{taiwan_date}","{open_price}","{high_price}","{low_price}","{close_price}","{volume}"\n'
-                
-                # 直接寫入對應公司代碼的檔案
-                file_path = os.path.join(target_dir, f"{company_code}.txt")
-                
-                # 檢查檔案是否存在，如果存在則附加，否則創建新檔案
-                with open(file_path, 'a', encoding='utf-8') as stock_file:
-                    stock_file.write(data_line)
-                
                 processed_count += 1
                 if processed_count % 50 == 0:
-                    print(f"已處理 {processed_count} 支{'上櫃' if is_otc else '上市'}股票")
+                    stock_common.log(f"已處理 {processed_count} 支{'上櫃' if is_otc else '上市'}股票")
                     
             except Exception as e:
-                print(f"處理代碼 {company_code} 時出錯: {str(e)}")
-                skipped_count += 1
+                stock_common.log(f"處理代碼 {company_code} 時出錯: {str(e)}")
+                skips['code_error'] += 1
                 continue
             
         except Exception as e:
-            print(f"處理行 {i} 時出錯: {str(e)}")
-            skipped_count += 1
+            stock_common.log(f"處理行 {i} 時出錯: {str(e)}")
+            skips['row_error'] += 1
     
-    print(f"處理完成! 成功處理 {processed_count} 支{'上櫃' if is_otc else '上市'}股票，跳過 {skipped_count} 行")
+    writer.add_batch(batch)
+    metrics.record(source, date_str, 'rows', time.perf_counter() - started, rows=processed_count, skipped=dict(skips))
+    stock_common.log(f"處理完成! 成功處理 {processed_count} 支{'上櫃' if is_otc else '上市'}股票，跳過 {sum(skips.values())} 行")
 
-def process_index_5sec_data(index_csv_file_path, date_str):
+@stock_common.batched
+def process_index_5sec_data(index_csv_file_path, date_str, writer=None):
     """處理台灣證券交易所的每日大盤5秒資料，從9:03:00到13:30:00的資料"""
-    print(f"開始處理大盤5秒資料，檔案: {index_csv_file_path}")
+    stock_common.log(f"開始處理大盤5秒資料，檔案: {index_csv_file_path}")
     
     # 嘗試不同的編碼讀取CSV文件內容
     encodings_to_try = ['big5', 'cp950', 'utf-8-sig', 'utf-8', 'gbk']
     lines = None
     
     
+    source, _ = stock_common.source_of(index_csv_file_path)
+    started = time.perf_counter()
     for encoding in encodings_to_try:
         try:
-            print(f"嘗試使用 {encoding} 編碼讀取檔案...")
+            stock_common.log(f"嘗試使用 {encoding} 編碼讀取檔案...")
             with open(index_csv_file_path, 'r', encoding=encoding) as file:
                 lines = file.readlines()
-                print(f"成功使用 {encoding} 編碼讀取檔案，共 {len(lines)} 行")
+                stock_common.log(f"成功使用 {encoding} 編碼讀取檔案，共 {len(lines)} 行")
                 break  # 如果成功讀取則跳出迴圈
         except UnicodeDecodeError:
-            print(f"{encoding} 編碼無法讀取檔案")
+            stock_common.log(f"{encoding} 編碼無法讀取檔案")
         except Exception as e:
             print(f"使用 {encoding} 編碼讀取時發生錯誤: {str(e)}")
     
     if lines is None:
         print("所有讀取方式均失敗，無法處理檔案")
         return
+    metrics.record(source, date_str, 'decode', time.perf_counter() - started,
+                   bytes=os.path.getsize(index_csv_file_path), rows=len(lines))
     
     # 找到標題行
     header_idx = -1
@@ -320,8 +343,8 @@ def process_index_5sec_data(index_csv_file_path, date_str):
         print("無法在CSV文件中找到標題行")
         return
     
-    print(f"找到標題行，行號: {header_idx}")
-    print(f"標題行內容: {lines[header_idx].strip()}")
+    stock_common.log(f"找到標題行，行號: {header_idx}")
+    stock_common.log(f"標題行內容: {lines[header_idx].strip()}")
     
     # 解析標題行找出成交量欄位位置
     header_parts = lines[header_idx].strip().split(',')
@@ -336,7 +359,7 @@ def process_index_5sec_data(index_csv_file_path, date_str):
     if volume_idx == -1:
         print("警告: 找不到成交量欄位，將使用預設值")
     else:
-        print(f"找到成交量欄位在第 {volume_idx} 欄")
+        stock_common.log(f"找到成交量欄位在第 {volume_idx} 欄")
     
     # 尋找開盤時間9:03:00的記錄
     start_time = "09:03:00"
@@ -348,7 +371,8 @@ def process_index_5sec_data(index_csv_file_path, date_str):
     final_volume = None 
     found_start = False
     
-    print(f"開始尋找時間範圍 {start_time} 到 {end_time} 的記錄")
+    started = time.perf_counter()
+    stock_common.log(f"開始尋找時間範圍 {start_time} 到 {end_time} 的記錄")
     
     # 從標題行後開始處理每一行數據
     for i in range(header_idx + 1, len(lines)):
@@ -390,7 +414,7 @@ def process_index_5sec_data(index_csv_file_path, date_str):
                 high_index = index_value
                 low_index = index_value
                 found_start = True
-                print(f"找到開盤時間 {start_time}，指數: {open_index}")
+                stock_common.log(f"找到開盤時間 {start_time}，指數: {open_index}")
                 continue
             
             # 更新最高價和最低價
@@ -403,28 +427,24 @@ def process_index_5sec_data(index_csv_file_path, date_str):
                 # 找到收盤時間
                 if end_time in time_value:
                     close_index = index_value
-                    print(f"找到收盤時間 {end_time}，指數: {close_index}")
-                    print(f"最後成交量: {final_volume}")
+                    stock_common.log(f"找到收盤時間 {end_time}，指數: {close_index}")
+                    stock_common.log(f"最後成交量: {final_volume}")
                     break
                     
         except Exception as e:
-            print(f"處理行 {i} 時出錯: {str(e)}")
+            stock_common.log(f"處理行 {i} 時出錯: {str(e)}")
             continue
     
     if open_index and close_index:
-        print(f"大盤5秒資料處理完成!")
-        print(f"開盤: {open_index}")
-        print(f"最高: {high_index}")
-        print(f"最低: {low_index}")
-        print(f"收盤: {close_index}")
-        print(f"成交量: {final_volume}")
+        stock_common.log(f"大盤5秒資料處理完成!")
+        stock_common.log(f"開盤: {open_index}")
+        stock_common.log(f"最高: {high_index}")
+        stock_common.log(f"最低: {low_index}")
+        stock_common.log(f"收盤: {close_index}")
+        stock_common.log(f"成交量: {final_volume}")
         
         # 儲存到檔案
-        output_dir = "D:/stock/txt"
-        import os
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-            print(f"已創建目錄: {output_dir}")
+        output_dir = stock_common.output_dir('txt')
         
         # 格式化數據，去掉小數點
         open_str = str(int(open_index))
@@ -433,30 +453,15 @@ def process_index_5sec_data(index_csv_file_path, date_str):
         close_str = str(int(close_index))
         volume_str = final_volume  # 使用抓取到的成交量
         
-        # 使用append模式寫入到1000.txt檔案
+        # 追加到1000.txt檔案（舊檔最後沒有換行時由寫入器補上）
         output_file = os.path.join(output_dir, "1000.txt")
+        taiwan_date = str(int(date_str[:4]) - 1911) + date_str[4:]
+        writer.append(output_file, f'"{taiwan_date}","{open_str}","{high_str}","{low_str}","{close_str}","{volume_str}"')
         
-        # 檢查檔案是否存在且不為空
-        file_exists = os.path.exists(output_file) and os.path.getsize(output_file) > 0
-        
-        with open(output_file, 'a', encoding='utf-8') as f:  # 使用'a'模式進行追加
-            # 如果檔案不是空的且最後沒有換行符，則先添加一個換行符
-            if file_exists:
-                # 讀取檔案最後一個字符
-                with open(output_file, 'r', encoding='utf-8') as check_file:
-                    check_file.seek(0, os.SEEK_END)
-                    pos = check_file.tell() - 1
-                    if pos > 0:
-                        check_file.seek(pos, os.SEEK_SET)
-                        last_char = check_file.read(1)
-                        if last_char != '\n':
-                            f.write('\n')
-            # 寫入新記錄
-            taiwan_date = str(int(date_str[:4]) - 1911) + date_str[4:]
-            f.write(f'"{taiwan_date}","{open_str}","{high_str}","{low_str}","{close_str}","{volume_str}"')
-        
-        print(f"已追加大盤指數到文件: {output_file}")
+        stock_common.log(f"已追加大盤指數到文件: {output_file}")
+        metrics.record(source, date_str, 'rows', time.perf_counter() - started, rows=1)
     else:
+        metrics.record(source, date_str, 'rows', time.perf_counter() - started, rows=0, skipped={'incomplete_session': 1})
         print(f"未能找到完整的開盤至收盤資料")
 
 def main():
@@ -494,9 +499,21 @@ def main():
     
     print("=" * 50)
     
+    run(date_str)
+
+
+def run(date_str):
+    """下載並處理指定日期的資料（不需互動輸入，可供排程呼叫）
+
+    參數:
+        date_str: 日期字串 (YYYYMMDD格式)
+
+    回傳:
+        所有原始檔都下載成功時回傳True，否則回傳False
+    """
     # 下載資料並取得資料夾路徑
-    print("開始下載資料...")
-    date_folder = download(date_str)
+    stock_common.log("開始下載資料...")
+    date_folder = download(date_str, stock_common.get_session())
     
     # 檢查資料夾是否存在
     current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -506,14 +523,14 @@ def main():
         date_folder = current_dir
     
     # 處理上市股票資料
-    twse_csv_path = os.path.join(date_folder, f'上市_{date_str}.csv')
+    twse_csv_path = os.path.join(date_folder, os.path.basename(stock_common.source_path('twse_quotes', date_str)))
     if os.path.exists(twse_csv_path):
         process_stock_data(twse_csv_path, date_str, is_otc=False)
     else:
         print(f"找不到上市公司檔案: {twse_csv_path}")
 
     # 處理上櫃股票資料
-    tpex_csv_path = os.path.join(date_folder, f'櫃買_{date_str}.csv')
+    tpex_csv_path = os.path.join(date_folder, os.path.basename(stock_common.source_path('tpex_quotes', date_str)))
     if os.path.exists(tpex_csv_path):
         process_stock_data(tpex_csv_path, date_str, is_otc=True)
     else:
@@ -526,7 +543,15 @@ def main():
     else:
         print(f"找不到大盤5秒檔案: {index_csv_path}")
     
-    print("資料處理完成!")
+    # 用當日行情更新證券主檔（代號、名稱、市場、掛牌期間）
+    security_master.update(date_str)
+
+    stock_common.log("資料處理完成!")
+
+    # 寫出本次各階段的耗時與數量（JSON lines + Prometheus textfile）
+    metrics.emit()
+
+    return all(stock_common.raw_file_ok(path) for path in (twse_csv_path, tpex_csv_path, index_csv_path))
 
 
 if __name__ == "__main__":
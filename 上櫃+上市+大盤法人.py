@@ -1,18 +1,24 @@
-import requests
-import urllib3
 import os
-import urllib.parse
 from datetime import datetime
 import csv
 import io
+import time
+from collections import Counter
+import stock_common
+import json_decode
+import metrics
+import records
+import security_master
 
-def download(date_str=None):
+def download(date_str=None, session=None):
     """下載法人資料（上市、上櫃、大盤）
     
     參數:
         date_str: 日期字串 (YYYYMMDD格式)，若為None則使用當天日期
+        session: 共用的連線池 (requests.Session)，未指定時每個檔案各自連線
     """
-    # 禁用SSL驗證警告
+    # 禁用SSL驗證警告（requests/urllib3 到下載時才載入，只處理已下載的原始檔時不需要）
+    import urllib3
     urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
     # 如果未提供日期，使用當天日期
@@ -20,12 +26,7 @@ def download(date_str=None):
         today = datetime.now()
         date_str = today.strftime('%Y%m%d')
     
-    print(f"下載日期: {date_str}")
-
-    # 獲取上櫃法人所需的格式化日期
-    formatted_date = f"{date_str[:4]}/{date_str[4:6]}/{date_str[6:8]}"
-    encoded_date = urllib.parse.quote(formatted_date)  # URL編碼
-    print(f"格式化日期: {formatted_date}, 編碼: {encoded_date}")
+    stock_common.log(f"下載日期: {date_str}")
 
     # 設定保存目錄和檔名 - 使用相對路徑
     # 獲取當前腳本所在目錄
@@ -35,62 +36,60 @@ def download(date_str=None):
     date_folder = os.path.join(current_dir, date_str)
     if not os.path.exists(date_folder):
         os.makedirs(date_folder)
-        print(f"創建日期資料夾: {date_folder}")
-
-    # 1. 下載上櫃法人資料
-    print("開始下載上櫃法人資料...")
-    otc_save_path = os.path.join(date_folder, f'櫃買法人_{date_str}.csv')
-    otc_url = f"https://www.tpex.org.tw/www/zh-tw/insti/dailyTrade?type=Daily&sect=EW&date={encoded_date}&id=&response=csv"
-    download_file(otc_url, otc_save_path, "上櫃法人")
-
-    # 2. 下載大盤法人資料
-    print("開始下載大盤法人資料...")
-    index_save_path = os.path.join(date_folder, f'大盤法人_{date_str}.csv')
-    index_url = f"https://www.twse.com.tw/rwd/zh/fund/BFI82U?type=day&dayDate={date_str}&response=csv"
-    download_file(index_url, index_save_path, "大盤法人")
+        stock_common.log(f"創建日期資料夾: {date_folder}")
 
-    # 3. 下載上市資料
-    print("開始下載上市法人資料...")
-    twse_save_path = os.path.join(date_folder, f'上市法人_{date_str}.csv')
-    twse_url = f"https://www.twse.com.tw/rwd/zh/fund/T86?date={date_str}&selectType=ALLBUT0999&response=csv"
-    download_file(twse_url, twse_save_path, "上市法人")
+    # 依序下載各來源資料（網址與檔名定義在 stock_common.SOURCES）
+    for key in stock_common.dataset_sources('institutional'):
+        label = stock_common.SOURCES[key]['label']
+        stock_common.log(f"開始下載{label}資料...")
+        save_path = stock_common.source_path(key, date_str)
+        download_file(stock_common.source_url(key, date_str), save_path, label, session)
 
-    print("所有資料下載完成")
+    stock_common.log("所有資料下載完成")
     return date_folder
 
 
-def download_file(url, save_path, file_type):
+def download_file(url, save_path, file_type, session=None):
     """下載檔案並儲存
     
     參數:
         url: 下載連結
         save_path: 儲存路徑
         file_type: 檔案類型描述（用於日誌顯示）
+        session: 共用的連線池 (requests.Session)，未指定時每次建立新連線
+
+    回傳:
+        下載成功且檔案大小正常時回傳True
     """
+    import requests
     try:
-        print(f"下載{file_type}資料，URL: {url}")
+        stock_common.log(f"下載{file_type}資料，URL: {url}")
         # 設定請求標頭和超時
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8'
-        }
-    
-        response = requests.get(url, headers=headers, verify=False, timeout=20)
-        print(f"{file_type}資料請求完成，狀態碼: {response.status_code}")
+        key, date_str = stock_common.source_of(save_path)
+        started = time.perf_counter()
+        # stream=True 時收到回應標頭就返回：前段為連線+等待首位元組，後段為下載內容
+        response = (session or requests).get(url, headers=stock_common.HEADERS, verify=False, timeout=20, stream=True)
+        ttfb = time.perf_counter() - started
+        content = response.content
+        metrics.record(key, date_str, 'http_ttfb', ttfb, status=response.status_code)
+        metrics.record(key, date_str, 'http_body', time.perf_counter() - started - ttfb, bytes=len(content))
+        stock_common.log(f"{file_type}資料請求完成，狀態碼: {response.status_code}")
 
         # 檢查是否成功
         if response.status_code == 200:
             # 保存檔案
             with open(save_path, 'wb') as f:
-                f.write(response.content)
-            print(f"已下載{file_type}資料到: {save_path}")
+                f.write(content)
+            stock_common.log(f"已下載{file_type}資料到: {save_path}")
 
             # 檢查檔案大小
             file_size = os.path.getsize(save_path)
-            print(f"{file_type}檔案大小: {file_size} 字節")
+            stock_common.log(f"{file_type}檔案大小: {file_size} 字節")
             
-            if file_size < 100:
+            if file_size < stock_common.MIN_RAW_SIZE:
                 print(f"警告: {file_type}檔案大小異常小，請檢查內容是否正確")
+                return False
+            return True
         else:
             print(f"{file_type}資料下載失敗，狀態碼: {response.status_code}")
             print(f"回應內容: {response.text[:500]}")
@@ -100,66 +99,90 @@ def download_file(url, save_path, file_type):
         print(f"{file_type}資料下載出現SSL錯誤: {e}")
     except Exception as e:
         print(f"{file_type}資料下載時發生錯誤: {str(e)}")
+    return False
 
 
-def process_stock_data(csv_file_path, date_str, is_otc=False):
+@stock_common.batched
+def process_stock_data(csv_file_path, date_str, is_otc=False, writer=None):
     """處理台灣股市資料函數
     
     參數:
         csv_file_path: CSV檔案路徑
         date_str: 日期字串 (YYYYMMDD格式)
         is_otc: 是否為上櫃資料 (預設False為上市資料)
+        writer: 批次寫入器，未指定時處理完畢後直接寫入檔案
     """
-    print(f"開始處理{'上櫃法人' if is_otc else '上市法人'}公司資料，檔案: {csv_file_path}")
+    stock_common.log(f"開始處理{'上櫃法人' if is_otc else '上市法人'}公司資料，檔案: {csv_file_path}")
     
     # 確保目標目錄存在
-    target_dir = "D:/stock/law"
+    target_dir = stock_common.output_dir('law')
     if not os.path.exists(target_dir):
         os.makedirs(target_dir)
-        print(f"創建目標目錄: {target_dir}")
+        stock_common.log(f"創建目標目錄: {target_dir}")
     
-    # 嘗試不同的編碼讀取CSV文件內容
-    encodings_to_try = ['big5', 'cp950', 'utf-8-sig', 'utf-8', 'gbk']
-    lines = None
+    source, _ = stock_common.source_of(csv_file_path)
+    is_json = stock_common.is_json(csv_file_path)
+    if is_json:
+        # JSON格式：欄位名稱與資料列已分開，不需猜測編碼、尋找標題行與去除引號
+        started = time.perf_counter()
+        table = json_decode.read_table(csv_file_path, stock_common.SOURCES[source]['header'])
+        if table is None:
+            print(f"JSON檔案中找不到資料表: {csv_file_path}")
+            return
+        lines = [table[0]] + table[1]
+        metrics.record(source, date_str, 'decode', time.perf_counter() - started,
+                       bytes=os.path.getsize(csv_file_path), rows=len(lines))
+    else:
+        # 嘗試不同的編碼讀取CSV文件內容
+        encodings_to_try = ['big5', 'cp950', 'utf-8-sig', 'utf-8', 'gbk']
+        lines = None
     
-    for encoding in encodings_to_try:
-        try:
-            print(f"嘗試使用 {encoding} 編碼讀取檔案...")
-            with open(csv_file_path, 'r', encoding=encoding) as file:
-                lines = file.readlines()
-                print(f"成功使用 {encoding} 編碼讀取檔案，共 {len(lines)} 行")
-                break  # 如果成功讀取則跳出迴圈
-        except UnicodeDecodeError:
-            print(f"{encoding} 編碼無法讀取檔案")
-        except Exception as e:
-            print(f"使用 {encoding} 編碼讀取時發生錯誤: {str(e)}")
+        started = time.perf_counter()
+        for encoding in encodings_to_try:
+            try:
+                stock_common.log(f"嘗試使用 {encoding} 編碼讀取檔案...")
+                with open(csv_file_path, 'r', encoding=encoding) as file:
+                    lines = file.readlines()
+                    stock_common.log(f"成功使用 {encoding} 編碼讀取檔案，共 {len(lines)} 行")
+                    break  # 如果成功讀取則跳出迴圈
+            except UnicodeDecodeError:
+                stock_common.log(f"{encoding} 編碼無法讀取檔案")
+            except Exception as e:
+                print(f"使用 {encoding} 編碼讀取時發生錯誤: {str(e)}")
     
-    if lines is None:
-        print("所有讀取方式均失敗，無法處理檔案")
-        return
+        if lines is None:
+            print("所有讀取方式均失敗，無法處理檔案")
+            return
+        metrics.record(source, date_str, 'decode', time.perf_counter() - started,
+                       bytes=os.path.getsize(csv_file_path), rows=len(lines))
     
     # 尋找標題行 (上市和上櫃的標題行格式不同)
-    header_idx = -1
-    for i, line in enumerate(lines):
-        if is_otc:  # 上櫃資料
-            if "代號" in line and "名稱" in line:
-                header_idx = i
-                break
-        else:  # 上市資料
-            if "代號" in line and "名稱" in line:
-                header_idx = i
-                break
+    started = time.perf_counter()
+    if is_json:
+        header_idx = 0
+        header_parts = lines[0]
+    else:
+        header_idx = -1
+        for i, line in enumerate(lines):
+            if is_otc:  # 上櫃資料
+                if "代號" in line and "名稱" in line:
+                    header_idx = i
+                    break
+            else:  # 上市資料
+                if "代號" in line and "名稱" in line:
+                    header_idx = i
+                    break
     
-    if header_idx == -1:
-        print(f"無法在CSV文件中找到{'上櫃法人' if is_otc else '上市法人'}資料的標題行")
-        return
+        if header_idx == -1:
+            print(f"無法在CSV文件中找到{'上櫃法人' if is_otc else '上市法人'}資料的標題行")
+            return
     
-    print(f"找到標題行，行號: {header_idx}")
-    print(f"標題行內容: {lines[header_idx].strip()}")
+        stock_common.log(f"找到標題行，行號: {header_idx}")
+        stock_common.log(f"標題行內容: {lines[header_idx].strip()}")
     
-    # 解析標題行
-    header_parts = lines[header_idx].strip().split(',')
-    header_parts = [part.strip('"') for part in header_parts]
+        # 解析標題行
+        header_parts = lines[header_idx].strip().split(',')
+        header_parts = [part.strip('"') for part in header_parts]
     
     # 尋找需要的列索引
     try:
@@ -189,7 +212,7 @@ def process_stock_data(csv_file_path, date_str, is_otc=False):
                 prsell_idx = i
 
     
-        print(f"欄位索引: 代號({code_idx}) 外資買進({fbuy_idx}) 外資賣出({fsell_idx}) 投信買進({itbuy_idx}) 投信賣出({itsell_idx}) 自營商買進({prbuy_idx}) 自營商賣出({prsell_idx}))")
+        stock_common.log(f"欄位索引: 代號({code_idx}) 外資買進({fbuy_idx}) 外資賣出({fsell_idx}) 投信買進({itbuy_idx}) 投信賣出({itsell_idx}) 自營商買進({prbuy_idx}) 自營商賣出({prsell_idx}))")
         
         # 確認所有需要的列都找到了
         required_indices = [code_idx, fbuy_idx, fsell_idx,itbuy_idx, itsell_idx,prbuy_idx, prsell_idx]
@@ -210,25 +233,28 @@ def process_stock_data(csv_file_path, date_str, is_otc=False):
         print(f"處理標題行時出錯: {str(e)}")
         return
     
+    metrics.record(source, date_str, 'header', time.perf_counter() - started, line=header_idx)
+
     # 從標題行後開始處理數據
+    started = time.perf_counter()
     processed_count = 0
-    skipped_count = 0
+    skips = Counter()  # 依原因統計略過的行數
+    batch = records.InstitutionalBatch(target_dir, date_str)  # 當日批次，整個檔案處理完後每支股票只開檔一次
     
     # 從標題行下一行開始處理每一行數據
     for i in range(header_idx + 1, len(lines)):
-        line = lines[i].strip()
+        line = lines[i] if is_json else lines[i].strip()
         if not line:  # 跳過空行
             continue
         
-        # 使用CSV解析器來正確處理引號和逗號
+        # 使用CSV解析器來正確處理引號和逗號（JSON格式的資料列已是欄位列表）
         try:
-            csv_reader = csv.reader(io.StringIO(line))
-            row = next(csv_reader)
+            row = line if is_json else next(csv.reader(io.StringIO(line)))
             
             # 如果行的元素數量不足，則跳過
             max_idx = max(required_indices)
             if len(row) <= max_idx:
-                skipped_count += 1
+                skips['short_row'] += 1
                 continue
             
             # 獲取公司代碼
@@ -236,7 +262,12 @@ def process_stock_data(csv_file_path, date_str, is_otc=False):
             
             # 忽略非股票代碼格式的行
             if not (company_code.isdigit() or (len(company_code) > 0 and company_code[0].isdigit())):
-                skipped_count += 1
+                skips['not_stock'] += 1
+                continue
+
+            # 略過不需要的商品類別（預設為權證，見 security_master.SKIP_TYPES）
+            if security_master.skipped(company_code):
+                skips['filtered'] += 1
                 continue
                 
             # 獲取價格和成交量數據，移除引號和千分位逗號
@@ -250,78 +281,66 @@ def process_stock_data(csv_file_path, date_str, is_otc=False):
                 
                 # 跳過無效數據
                 if '--' in [fbuy_price,fsell_price,itbuy_price,itsell_price,prbuy_price,prsell_price]:
-                    skipped_count += 1
+                    skips['invalid_value'] += 1
                     continue
                 
-                # 轉換成浮點數和整數以驗證（僅驗證，不改變原始字符串）
+                # 轉換成股數存入當日批次（寫入時才除以1000，並略過買賣皆為0的法人）
                 try:
-                    fbuy_price=round(float(fbuy_price))/1000
-                    fsell_price=round(float(fsell_price))/1000
-                    itbuy_price=round(float(itbuy_price))/1000
-                    itsell_price=round(float(itsell_price))/1000
-                    prbuy_price=round(float(prbuy_price))/1000
-                    prsell_price=round(float(prsell_price))/1000
+                    batch.add(company_code,
+                              round(float(fbuy_price)), round(float(fsell_price)),
+                              round(float(itbuy_price)), round(float(itsell_price)),
+                              round(float(prbuy_price)), round(float(prsell_price)))
                 except ValueError:
-                    skipped_count += 1
+                    skips['bad_number'] += 1
                     continue
-
-                # 準備寫入的數據行
-                taiwan_date = str(int(date_str[:4]) - 1911) + date_str[4:]
-                fdata_line = f'"{taiwan_date}","{fbuy_price}","{fsell_price}","1"\n'
-                itdata_line = f'"{taiwan_date}","{itbuy_price}","{itsell_price}","2"\n'
-                prdata_line = f'"{taiwan_date}","{prbuy_price}","{prsell_price}","3"\n'
-                
-                # 直接寫入對應公司代碼的檔案
-                file_path = os.path.join(target_dir, f"{company_code}.law")
-                
-                # 檢查檔案是否存在，如果存在則附加，否則創建新檔案
-                with open(file_path, 'a', encoding='utf-8') as stock_file:
-                    if fbuy_price!=0 or fsell_price!=0:
-                        stock_file.write(fdata_line)
-                    if itbuy_price!=0 or itsell_price!=0:
-                        stock_file.write(itdata_line)
-                    if prbuy_price!=0 or prsell_price!=0:
-                        stock_file.write(prdata_line)
                 
                 processed_count += 1
                 if processed_count % 50 == 0:
-                    print(f"已處理 {processed_count} 支{'上櫃' if is_otc else '上市'}股票")
+                    stock_common.log(f"已處理 {processed_count} 支{'上櫃' if is_otc else '上市'}股票")
                     
             except Exception as e:
-                print(f"處理代碼 {company_code} 時出錯: {str(e)}")
-                skipped_count += 1
+                stock_common.log(f"處理代碼 {company_code} 時出錯: {str(e)}")
+                skips['code_error'] += 1
                 continue
             
         except Exception as e:
-            print(f"處理行 {i} 時出錯: {str(e)}")
-            skipped_count += 1
+            stock_common.log(f"處理行 {i} 時出錯: {str(e)}")
+            skips['row_error'] += 1
     
-    print(f"處理完成! 成功處理 {processed_count} 支{'上櫃' if is_otc else '上市'}股票，跳過 {skipped_count} 行")
+    writer.add_batch(batch)
+    metrics.record(source, date_str, 'rows', time.perf_counter() - started, rows=processed_count, skipped=dict(skips))
+    stock_common.log(f"處理完成! 成功處理 {processed_count} 支{'上櫃' if is_otc else '上市'}股票，跳過 {sum(skips.values())} 行")
 
-def process_index_data(index_csv_file_path, date_str):
+@stock_common.batched
+def process_index_data(index_csv_file_path, date_str, writer=None):
     """處理大盤法人資料"""
-    print(f"開始處理大盤法人資料，檔案: {index_csv_file_path}")
+    stock_common.log(f"開始處理大盤法人資料，檔案: {index_csv_file_path}")
     
     # 嘗試不同的編碼讀取CSV文件內容
     encodings_to_try = ['big5', 'cp950', 'utf-8-sig', 'utf-8', 'gbk']
     lines = None
     
+    source, _ = stock_common.source_of(index_csv_file_path)
+    started = time.perf_counter()
     for encoding in encodings_to_try:
         try:
-            print(f"嘗試使用 {encoding} 編碼讀取檔案...")
+            stock_common.log(f"嘗試使用 {encoding} 編碼讀取檔案...")
             with open(index_csv_file_path, 'r', encoding=encoding) as file:
                 lines = file.readlines()
-                print(f"成功使用 {encoding} 編碼讀取檔案，共 {len(lines)} 行")
+                stock_common.log(f"成功使用 {encoding} 編碼讀取檔案，共 {len(lines)} 行")
                 break  # 如果成功讀取則跳出迴圈
         except UnicodeDecodeError:
-            print(f"{encoding} 編碼無法讀取檔案")
+            stock_common.log(f"{encoding} 編碼無法讀取檔案")
         except Exception as e:
             print(f"使用 {encoding} 編碼讀取時發生錯誤: {str(e)}")
     
     if lines is None:
         print("所有讀取方式均失敗，無法處理檔案")
         return
+    metrics.record(source, date_str, 'decode', time.perf_counter() - started,
+                   bytes=os.path.getsize(index_csv_file_path), rows=len(lines))
     
+    started = time.perf_counter()
     # 檢查檔案是否有足夠的行數
     if len(lines) < 6:
         print(f"檔案行數不足({len(lines)}行)，可能是放假日或資料格式異常，跳過處理")
@@ -375,24 +394,17 @@ def process_index_data(index_csv_file_path, date_str):
         itdata_line = f'"{taiwan_date}","{itbuy_price}","{itsell_price}","2"\n'
         prdata_line = f'"{taiwan_date}","{prbuy_price}","{prsell_price}","3"\n'
                 
-        # 確保目標目錄存在
-        target_dir = "D:/stock/law"
-        if not os.path.exists(target_dir):
-            os.makedirs(target_dir)
-        
-        # 直接寫入對應公司代碼的檔案
-        file_path = os.path.join(target_dir, "1000.law")
-                
-        # 檢查檔案是否存在，如果存在則附加，否則創建新檔案
-        with open(file_path, 'a', encoding='utf-8') as stock_file:
-            if fbuy_price != 0 or fsell_price != 0:
-                stock_file.write(fdata_line)
-            if itbuy_price != 0 or itsell_price != 0:
-                stock_file.write(itdata_line)
-            if prbuy_price != 0 or prsell_price != 0:
-                stock_file.write(prdata_line)
+        # 加入批次寫入（目錄由寫入器建立）
+        file_path = os.path.join(stock_common.output_dir('law'), "1000.law")
+        if fbuy_price != 0 or fsell_price != 0:
+            writer.append(file_path, fdata_line)
+        if itbuy_price != 0 or itsell_price != 0:
+            writer.append(file_path, itdata_line)
+        if prbuy_price != 0 or prsell_price != 0:
+            writer.append(file_path, prdata_line)
         
-        print("大盤法人資料處理完成")
+        metrics.record(source, date_str, 'rows', time.perf_counter() - started, rows=1)
+        stock_common.log("大盤法人資料處理完成")
         
     except IndexError as e:
         print(f"索引錯誤，可能是放假日或資料格式異常: {e}")
@@ -437,9 +449,21 @@ def main():
     
     print("=" * 50)
     
+    run(date_str)
+
+
+def run(date_str):
+    """下載並處理指定日期的資料（不需互動輸入，可供排程呼叫）
+
+    參數:
+        date_str: 日期字串 (YYYYMMDD格式)
+
+    回傳:
+        所有原始檔都下載成功時回傳True，否則回傳False
+    """
     # 下載資料並取得資料夾路徑
-    print("開始下載資料...")
-    date_folder = download(date_str)
+    stock_common.log("開始下載資料...")
+    date_folder = download(date_str, stock_common.get_session())
     
     # 檢查資料夾是否存在
     current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -449,14 +473,14 @@ def main():
         date_folder = current_dir
     
     # 處理上市法人資料
-    twse_csv_path = os.path.join(date_folder, f'上市法人_{date_str}.csv')
+    twse_csv_path = os.path.join(date_folder, os.path.basename(stock_common.source_path('twse_institutional', date_str)))
     if os.path.exists(twse_csv_path):
         process_stock_data(twse_csv_path, date_str, is_otc=False)
     else:
         print(f"找不到上市公司檔案: {twse_csv_path}")
 
     # 處理上櫃法人資料
-    tpex_csv_path = os.path.join(date_folder, f'櫃買法人_{date_str}.csv')
+    tpex_csv_path = os.path.join(date_folder, os.path.basename(stock_common.source_path('tpex_institutional', date_str)))
     if os.path.exists(tpex_csv_path):
         process_stock_data(tpex_csv_path, date_str, is_otc=True)
     else:
@@ -469,6 +493,12 @@ def main():
     else:
         print(f"找不到上市公司檔案: {index_csv_file_path}")
 
+    # 寫出本次各階段的耗時與數量（JSON lines + Prometheus textfile）
+    metrics.emit()
+
+    return all(stock_common.raw_file_ok(path) for path in (twse_csv_path, tpex_csv_path, index_csv_file_path))
+
+
 if __name__ == "__main__":
     while True:
         main()
\ No newline at end of file